@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  AdaptiveRate.py
+#
+#  Scale scan window and advertising interval with how crowded it is:
+#  back off when no peers are around, speed up when they show up
+#
+#  Author: E-Motion Inc
+#
+#  Copyright (c) 2020, E-Motion, Inc.  All Rights Researcved
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#=============================================================================
+
+
+#-----------------------------------------------------------------------------
+#
+#  Bounds and tuning (times in ms)
+#
+#  crowdNeighbors  neighbors that count as a crowd (full rate)
+#  crowdRate       sightings per second that count as a crowd
+#  decay           fraction of the way back to idle per update; a rise in
+#                  activity is followed at once, a drop only slowly
+#  step            changes smaller than this are not applied
+#
+#-----------------------------------------------------------------------------
+DEFAULT_RATE_BOUNDS = {
+  'scanInterval'      : 100.0,
+  'minScanWindow'     : 10.0,
+  'maxScanWindow'     : 100.0,
+  'minAdvertInterval' : 100.0,
+  'maxAdvertInterval' : 1000.0,
+  'crowdNeighbors'    : 5,
+  'crowdRate'         : 20.0,
+  'decay'             : 0.2,
+  'step'              : 10.0,
+}
+
+
+#-----------------------------------------------------------------------------
+#
+#  AdaptiveRate
+#
+#  update() is called periodically with the neighbor count and sighting
+#  rate, and calls setScan(interval, window) / setAdvertInterval(ms) when
+#  the target moves by at least 'step'.
+#
+#-----------------------------------------------------------------------------
+class AdaptiveRate:
+
+  #----------------------------------------------
+  #  Constructor
+  #
+  #  bounds overrides DEFAULT_RATE_BOUNDS
+  #----------------------------------------------
+  def __init__(self, setScan, setAdvertInterval, bounds={}):
+    self.bounds = dict(DEFAULT_RATE_BOUNDS, **bounds)
+    b = self.bounds
+    if not (0 < b['minScanWindow'] <= b['maxScanWindow'] <= b['scanInterval']):
+      raise ValueError("scan window bounds must be 0 < min <= max <= interval")
+    if not (0 < b['minAdvertInterval'] <= b['maxAdvertInterval']):
+      raise ValueError("advertising interval bounds must be 0 < min <= max")
+
+    self.setScan = setScan
+    self.setAdvertInterval = setAdvertInterval
+
+    # 0.0 = idle, 1.0 = crowd; start at full rate until we know better
+    self.level = 1.0
+    self.scanWindow = None
+    self.advertInterval = None
+    self.changes = 0
+
+  #----------------------------------------------
+  #  Level of activity from the measurements
+  #----------------------------------------------
+  def _target(self, neighbors, rate):
+    b = self.bounds
+    return min(1.0, max(neighbors / b['crowdNeighbors'], rate / b['crowdRate']))
+
+  #----------------------------------------------
+  #  Feed one measurement, apply what changed
+  #----------------------------------------------
+  def update(self, neighbors, rate):
+    b = self.bounds
+    target = self._target(neighbors, rate)
+    if target >= self.level:
+      self.level = target
+    else:
+      self.level = self.level - (self.level - target) * b['decay']
+
+    window = b['minScanWindow'] + (b['maxScanWindow'] - b['minScanWindow']) * self.level
+    interval = b['maxAdvertInterval'] - (b['maxAdvertInterval'] - b['minAdvertInterval']) * self.level
+
+    if self.scanWindow is None or abs(window - self.scanWindow) >= b['step']:
+      self.scanWindow = window
+      self.setScan(b['scanInterval'], window)
+      self.changes = self.changes + 1
+
+    if self.advertInterval is None or abs(interval - self.advertInterval) >= b['step']:
+      self.advertInterval = interval
+      self.setAdvertInterval(interval)
+      self.changes = self.changes + 1
+
+  #----------------------------------------------
+  #  Current state
+  #----------------------------------------------
+  def stats(self):
+    return {'level': round(self.level, 3),
+            'scanWindow': self.scanWindow,
+            'advertInterval': self.advertInterval,
+            'changes': self.changes}
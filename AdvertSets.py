@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+#=======================================================================
+#
+#  AdvertSets
+#
+#  Advertisement set definitions (iBeacon, Eddystone, custom) shared by
+#  the D-Bus and the direct HCI advertising backends.
+#
+#  Copyright (C) 2020, E-Motion, Inc - All Rights Reserved.
+#  Unauthorized copying of this file, via any medium is
+#  strictly prohibited
+#
+#  Proprietary and confidential
+#  larry@e-motion.ai
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, 
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF 
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  
+#  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY 
+#  CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+#  TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE 
+#  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#=======================================================================
+
+
+#-----------------------------------------------------------------------
+#  iBeacon manufacturer data (after the Apple company id)
+#-----------------------------------------------------------------------
+def iBeaconData(beacon_type, uuid, major, minor, tx_power):
+  return (list(beacon_type) + list(uuid.bytes) +
+          [major // 256, major % 256] +
+          [minor // 256, minor % 256] +
+          list(tx_power))
+
+
+#=======================================================================
+#
+#   Advertisement sets
+#
+#   Interval and tx power are part of a set so a backend that can
+#   program them does; bluetoothd 5.54 has no D-Bus property for
+#   either and uses its own defaults.
+#
+#=======================================================================
+EDDYSTONE_UUID = 'FEAA'
+
+class AdvertSet:
+
+  #--------------------------------------------------------------
+  #  Constructor
+  #
+  #  priority  lower registers first when slots are short
+  #  interval  advertising interval in ms
+  #  tx_power  dBm
+  #--------------------------------------------------------------
+  def __init__(self, name, priority=0, interval=100, tx_power=-7,
+               ad_type='peripheral'):
+    self.name = name
+    self.priority = priority
+    self.interval = interval
+    self.tx_power = tx_power
+    self.ad_type = ad_type
+    self.index = None
+    self.manufacturer = None
+    self.service = None
+    self.advertisement = None
+    self.status = 'idle'
+
+  #--------------------------------------------------------------
+  #  Raw AD structures (legacy advertising, max 31 bytes) for
+  #  backends that program the controller directly
+  #--------------------------------------------------------------
+  def adData(self):
+    if self.ad_type == 'peripheral':
+      data = [0x02, 0x01, 0x06]     # LE general discoverable, no BR/EDR
+    else:
+      data = [0x02, 0x01, 0x04]     # no BR/EDR
+    if self.manufacturer is not None:
+      company_id, payload = self.manufacturer
+      data = data + [len(payload) + 3, 0xff, company_id & 0xff, company_id >> 8] + list(payload)
+    if self.service is not None:
+      uuid16 = int(self.service[0], 16)
+      payload = self.service[1]
+      data = data + [0x03, 0x03, uuid16 & 0xff, uuid16 >> 8]
+      data = data + [len(payload) + 3, 0x16, uuid16 & 0xff, uuid16 >> 8] + list(payload)
+    if len(data) > 31:
+      raise ValueError(f"advertisement set {self.name} is {len(data)} bytes, max 31")
+    return bytes(data)
+
+
+#-----------------------------------------------------------------------
+#  iBeacon set
+#-----------------------------------------------------------------------
+def iBeaconSet(name, uuid, major, minor, tx_power=[0xb3], **kwargs):
+  s = AdvertSet(name, **kwargs)
+  s.manufacturer = (0x004c, iBeaconData([0x02, 0x15], uuid, major, minor, tx_power))
+  return s
+
+#-----------------------------------------------------------------------
+#  Eddystone-UID set, namespace 10 bytes, instance 6 bytes (hex strings)
+#  ranging_power is the calibrated power at 0 m in dBm
+#-----------------------------------------------------------------------
+def eddystoneUidSet(name, namespace, instance, ranging_power=-20, **kwargs):
+  s = AdvertSet(name, **kwargs)
+  frame = ([0x00, ranging_power & 0xff] + list(bytes.fromhex(namespace)) +
+           list(bytes.fromhex(instance)) + [0x00, 0x00])
+  s.service = (EDDYSTONE_UUID, frame)
+  return s
+
+#-----------------------------------------------------------------------
+#  Eddystone-TLM (unencrypted) frame data
+#-----------------------------------------------------------------------
+def eddystoneTlmFrame(voltage_mv=0, temperature=-128.0, adv_count=0, uptime_s=0):
+  temp = int(temperature * 256) & 0xffff
+  secs = int(uptime_s * 10)
+  return ([0x20, 0x00, voltage_mv >> 8, voltage_mv & 0xff, temp >> 8, temp & 0xff] +
+          list(adv_count.to_bytes(4, 'big')) + list(secs.to_bytes(4, 'big')))
+
+#-----------------------------------------------------------------------
+#  Eddystone-TLM set; the owner refreshes the frame with update() as the
+#  telemetry changes (0 mV and -128 C mean "not supported")
+#-----------------------------------------------------------------------
+def eddystoneTlmSet(name, voltage_mv=0, temperature=-128.0, adv_count=0,
+                    uptime_s=0, **kwargs):
+  s = AdvertSet(name, **kwargs)
+  s.service = (EDDYSTONE_UUID,
+               eddystoneTlmFrame(voltage_mv, temperature, adv_count, uptime_s))
+  return s
+
+#-----------------------------------------------------------------------
+#  Custom manufacturer specific frame (0xffff = no company id)
+#-----------------------------------------------------------------------
+def customSet(name, data, company_id=0xffff, **kwargs):
+  s = AdvertSet(name, **kwargs)
+  s.manufacturer = (company_id, list(data))
+  return s
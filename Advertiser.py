@@ -0,0 +1,595 @@
+#!/usr/bin/python3
+#=======================================================================
+#
+#  Advertiser
+#
+#  BLE advertisement D-Bus object and a long lived iBeacon advertiser
+#  that keeps the system bus, adapter and GLib main loop between
+#  advertisements and updates the advertised data in place.
+#
+#  Copyright (C) 2020, E-Motion, Inc - All Rights Reserved.
+#  Unauthorized copying of this file, via any medium is
+#  strictly prohibited
+#
+#  Proprietary and confidential
+#  larry@e-motion.ai
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, 
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF 
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  
+#  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY 
+#  CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, 
+#  TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE 
+#  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#=======================================================================
+from __future__ import print_function
+import time
+import threading
+from AdvertSets import AdvertSet, iBeaconData
+from BluezObjects import objectCache
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
+
+
+try:
+    from gi.repository import GLib  # python3
+except ImportError:
+    import gobject as GLib  # python2
+
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+
+LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+
+
+#=======================================================================
+#
+#   Exception handling classes
+#
+#=======================================================================
+class InvalidArgsException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+
+class NotSupportedException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotSupported'
+
+
+class NotPermittedException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotPermitted'
+
+
+class InvalidValueLengthException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidValueLength'
+
+
+class FailedException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.Failed'
+
+
+#=======================================================================
+#
+#   BLE Advertisement Class
+#
+#=======================================================================
+class Advertisement(dbus.service.Object):
+  PATH_BASE = '/org/bluez/example/advertisement'
+
+  #--------------------------------------------------------------
+  #  Constrctor
+  #--------------------------------------------------------------
+  def __init__(self, bus, index, advertising_type):
+    self.path = self.PATH_BASE + str(index)
+    self.bus = bus
+    self.ad_type = advertising_type
+    self.service_uuids = None
+    self.manufacturer_data = None
+    self.solicit_uuids = None
+    self.service_data = None
+    self.local_name = None
+    self.include_tx_power = None
+    self.data = None
+    dbus.service.Object.__init__(self, bus, self.path)
+    
+  #--------------------------------------------------------------
+  #  Get properties
+  #--------------------------------------------------------------
+  def get_properties(self):
+    properties = dict()
+    properties['Type'] = self.ad_type
+
+    if self.service_uuids is not None:
+      properties['ServiceUUIDs'] = dbus.Array(
+            self.service_uuids, signature='s')
+
+    if self.solicit_uuids is not None:
+      properties['SolicitUUIDs'] = dbus.Array(
+            self.solicit_uuids, signature='s')
+                
+    if self.manufacturer_data is not None:
+      properties['ManufacturerData'] = dbus.Dictionary(
+            self.manufacturer_data, signature='qv')
+                
+    if self.service_data is not None:
+      properties['ServiceData'] = dbus.Dictionary(
+            self.service_data, signature='sv')
+                
+    if self.local_name is not None:
+      properties['LocalName'] = dbus.String(
+            self.local_name)
+            
+    if self.include_tx_power is not None:
+      properties['IncludeTxPower'] = dbus.Boolean(
+            self.include_tx_power)
+                
+    if self.data is not None:
+      properties['Data'] = dbus.Dictionary(
+            self.data, signature='yv')
+                
+    return {LE_ADVERTISEMENT_IFACE: properties}
+
+
+  #--------------------------------------------------------------
+  #  Get path 
+  #--------------------------------------------------------------
+  def get_path(self):
+    return dbus.ObjectPath(self.path)
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def add_service_uuid(self, uuid):
+    if not self.service_uuids:
+      self.service_uuids = []
+    self.service_uuids.append(uuid)
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def add_solicit_uuid(self, uuid):
+    if not self.solicit_uuids:
+      self.solicit_uuids = []
+    self.solicit_uuids.append(uuid)
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def add_manufacturer_data(self, manuf_code, data):
+    if not self.manufacturer_data:
+      self.manufacturer_data = dbus.Dictionary({}, signature='qv')
+    self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
+
+
+  #--------------------------------------------------------------
+  #  Replace the manufacturer data of a registered advertisement;
+  #  bluetoothd picks the change up from PropertiesChanged
+  #--------------------------------------------------------------
+  def set_manufacturer_data(self, manuf_code, data):
+    self.manufacturer_data = None
+    self.add_manufacturer_data(manuf_code, data)
+    self.PropertiesChanged(LE_ADVERTISEMENT_IFACE,
+                           {'ManufacturerData': dbus.Dictionary(
+                                self.manufacturer_data, signature='qv')},
+                           [])
+
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def add_service_data(self, uuid, data):
+    if not self.service_data:
+      self.service_data = dbus.Dictionary({}, signature='sv')
+    self.service_data[uuid] = dbus.Array(data, signature='y')
+
+
+  #--------------------------------------------------------------
+  #  Replace the service data of a registered advertisement
+  #--------------------------------------------------------------
+  def set_service_data(self, uuid, data):
+    self.service_data = None
+    self.add_service_data(uuid, data)
+    self.PropertiesChanged(LE_ADVERTISEMENT_IFACE,
+                           {'ServiceData': dbus.Dictionary(
+                                self.service_data, signature='sv')},
+                           [])
+
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def add_local_name(self, name):
+    if not self.local_name:
+      self.local_name = ""
+    self.local_name = dbus.String(name)
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def add_data(self, ad_type, data):
+    if not self.data:
+      self.data = dbus.Dictionary({}, signature='yv')
+    self.data[ad_type] = dbus.Array(data, signature='y')
+
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  @dbus.service.method(DBUS_PROP_IFACE,
+                       in_signature='s',
+                       out_signature='a{sv}')
+                         
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def GetAll(self, interface):
+    if interface != LE_ADVERTISEMENT_IFACE:
+      raise InvalidArgsException()
+    return self.get_properties()[LE_ADVERTISEMENT_IFACE]
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  @dbus.service.method(LE_ADVERTISEMENT_IFACE,
+                      in_signature='',
+                      out_signature='')
+                       
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def Release(self):
+    print('%s: Released!' % self.path)
+
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  @dbus.service.signal(DBUS_PROP_IFACE,
+                       signature='sa{sv}as')
+
+  #--------------------------------------------------------------
+  #--------------------------------------------------------------
+  def PropertiesChanged(self, interface, changed, invalidated):
+    pass
+
+
+#-----------------------------------------------------------------------
+#  Find the adapter implementing LEAdvertisingManager1
+#-----------------------------------------------------------------------
+def find_adapter(bus):
+  return objectCache(bus).findAdapter(LE_ADVERTISING_MANAGER_IFACE)
+
+
+#=======================================================================
+#
+#   Long lived advertiser
+#
+#   open() connects to the system bus, finds and powers the adapter and
+#   starts the GLib main loop once.  start()/stop() only register and
+#   unregister the advertisement, and update() swaps the manufacturer
+#   data of the registered advertisement in place.
+#
+#=======================================================================
+class BeaconAdvertiser:
+
+  #--------------------------------------------------------------
+  #  Constructor
+  #--------------------------------------------------------------
+  def __init__(self, index=0):
+    self.index = index
+    self.bus = None
+    self.adapter = None
+    self.adapter_props = None
+    self.ad_manager = None
+    self.advertLoop = None
+    self.advertThread = None
+    self.advertisement = None
+
+  #--------------------------------------------------------------
+  #  Advertiser registration callback
+  #--------------------------------------------------------------
+  def register_ad_cb(self):
+    return
+
+  #--------------------------------------------------------------
+  #  Advertiser registration error callback
+  #--------------------------------------------------------------
+  def register_ad_error_cb(self, error):
+    print('Failed to register advertisement: ' + str(error))
+
+  #--------------------------------------------------------------
+  #  Connect to bluez and start the main loop (once)
+  #--------------------------------------------------------------
+  def open(self):
+    if self.bus is not None:
+      return True
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    bus = dbus.SystemBus()
+    adapter = find_adapter(bus)
+    if not adapter:
+      print('LEAdvertisingManager1 interface not found')
+      return False
+
+    adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
+                                   DBUS_PROP_IFACE)
+    adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
+    self.ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
+                                     LE_ADVERTISING_MANAGER_IFACE)
+    self.bus = bus
+    self.adapter = adapter
+    self.adapter_props = adapter_props
+
+    self.advertLoop = GLib.MainLoop()
+    self.advertThread = threading.Thread(target=self.advertLoop.run)
+    self.advertThread.setDaemon(True)
+    self.advertThread.start()
+    return True
+
+  #--------------------------------------------------------------
+  #  Start advertising the given manufacturer data
+  #--------------------------------------------------------------
+  def start(self, company_id, data):
+    if not self.open():
+      return False
+
+    if self.advertisement is not None:
+      self.update(company_id, data)
+      return True
+
+    self.advertisement = Advertisement(self.bus, self.index, 'peripheral')
+    self.advertisement.add_manufacturer_data(company_id, data)
+    self.ad_manager.RegisterAdvertisement(self.advertisement.get_path(), {},
+                                          reply_handler=self.register_ad_cb,
+                                          error_handler=self.register_ad_error_cb)
+    print("Start advertising")
+    return True
+
+  #--------------------------------------------------------------
+  #  Change the advertised data without re-registering
+  #--------------------------------------------------------------
+  def update(self, company_id, data):
+    if self.advertisement is None:
+      return False
+
+    def _update():
+      self.advertisement.set_manufacturer_data(company_id, data)
+      return False
+
+    # Emit the signal from the main loop thread
+    GLib.idle_add(_update)
+    return True
+
+  #--------------------------------------------------------------
+  #  Stop advertising; bus and main loop stay up
+  #--------------------------------------------------------------
+  def stop(self):
+    if self.advertisement is None:
+      return
+
+    self.ad_manager.UnregisterAdvertisement(self.advertisement)
+    dbus.service.Object.remove_from_connection(self.advertisement)
+    self.advertisement = None
+    print('Stopped advertising')
+
+  #--------------------------------------------------------------
+  #  Stop advertising and shut the main loop down
+  #--------------------------------------------------------------
+  def close(self):
+    self.stop()
+    if self.advertLoop is not None:
+      self.advertLoop.quit()
+      self.advertThread.join()
+    self.advertLoop = None
+    self.advertThread = None
+    self.ad_manager = None
+    self.adapter_props = None
+    self.adapter = None
+    self.bus = None
+
+
+#=======================================================================
+#
+#   Advertising manager
+#
+#   Registers several advertisement sets on one adapter at once.  The
+#   kernel/controller rotates between registered instances, so one radio
+#   serves iBeacon and Eddystone scanners without switching in Python.
+#   Sets are registered in priority order until the adapter's free slots
+#   (SupportedInstances) run out; status() reports what was accepted.
+#
+#   Uses a BeaconAdvertiser for the bus, adapter and main loop only;
+#   its single-advertisement start/update are not part of this API.
+#
+#=======================================================================
+class AdvertisingManager:
+
+  #--------------------------------------------------------------
+  #  Constructor
+  #--------------------------------------------------------------
+  def __init__(self):
+    self.connection = BeaconAdvertiser()
+    self.sets = {}
+    self.nextIndex = 0
+    # status changes come from the main loop thread too
+    self.mutex = threading.Lock()
+
+  #--------------------------------------------------------------
+  #  Connect to bluez and start the main loop (once)
+  #--------------------------------------------------------------
+  def open(self):
+    return self.connection.open()
+
+  #--------------------------------------------------------------
+  #  Add (or replace) a set; takes effect on the next start()
+  #--------------------------------------------------------------
+  def addSet(self, advertSet):
+    prev = self.sets.get(advertSet.name)
+    if prev is not None:
+      advertSet.index = prev.index
+    else:
+      advertSet.index = self.nextIndex
+      self.nextIndex = self.nextIndex + 1
+    self.sets[advertSet.name] = advertSet
+
+  #--------------------------------------------------------------
+  #  Free advertising instances on the adapter
+  #--------------------------------------------------------------
+  def freeSlots(self):
+    try:
+      return int(self.connection.adapter_props.Get(LE_ADVERTISING_MANAGER_IFACE,
+                                                   'SupportedInstances'))
+    except dbus.exceptions.DBusException:
+      return 1
+
+  #--------------------------------------------------------------
+  #  Build the D-Bus advertisement object for a set
+  #--------------------------------------------------------------
+  def _build(self, advertSet):
+    ad = Advertisement(self.connection.bus, advertSet.index, advertSet.ad_type)
+    if advertSet.manufacturer is not None:
+      ad.add_manufacturer_data(*advertSet.manufacturer)
+    if advertSet.service is not None:
+      ad.add_service_uuid(advertSet.service[0])
+      ad.add_service_data(*advertSet.service)
+    advertSet.advertisement = ad
+    return ad
+
+  #--------------------------------------------------------------
+  #  Push the set's data to its registered advertisement
+  #--------------------------------------------------------------
+  def _apply(self, advertSet):
+    if advertSet.advertisement is None:
+      return
+    if advertSet.manufacturer is not None:
+      advertSet.advertisement.set_manufacturer_data(*advertSet.manufacturer)
+    if advertSet.service is not None:
+      advertSet.advertisement.set_service_data(*advertSet.service)
+
+  #--------------------------------------------------------------
+  #  Drop a set's advertisement object (mutex held)
+  #--------------------------------------------------------------
+  def _release(self, advertSet):
+    dbus.service.Object.remove_from_connection(advertSet.advertisement)
+    advertSet.advertisement = None
+    advertSet.status = 'idle'
+
+  #--------------------------------------------------------------
+  #  Register all sets that fit
+  #--------------------------------------------------------------
+  def start(self):
+    if not self.open():
+      return False
+
+    slots = self.freeSlots()
+    ordered = sorted(self.sets.values(), key=lambda s: s.priority)
+    self.mutex.acquire()
+    for advertSet in ordered:
+      if advertSet.status == 'cancelled':
+        # stop() came before the registration finished; keep it
+        advertSet.status = 'pending'
+      if advertSet.advertisement is not None:
+        continue
+      if slots <= 0:
+        advertSet.status = 'no slot'
+        continue
+      slots = slots - 1
+
+      self._build(advertSet)
+      advertSet.status = 'pending'
+      self.connection.ad_manager.RegisterAdvertisement(
+        advertSet.advertisement.get_path(), {},
+        reply_handler=self._replyHandler(advertSet),
+        error_handler=self._errorHandler(advertSet))
+    self.mutex.release()
+    print(f"Start advertising {self.status()}")
+    return True
+
+  #--------------------------------------------------------------
+  #  Per set registration callbacks.  A set stopped while its
+  #  registration was in flight is unregistered here.
+  #--------------------------------------------------------------
+  def _replyHandler(self, advertSet):
+    def reply():
+      self.mutex.acquire()
+      if advertSet.status == 'cancelled':
+        self.connection.ad_manager.UnregisterAdvertisement(
+          advertSet.advertisement,
+          reply_handler=lambda: None,
+          error_handler=lambda e: print(f"Failed to unregister {advertSet.name}: {e}"))
+        self._release(advertSet)
+      else:
+        advertSet.status = 'active'
+      self.mutex.release()
+    return reply
+
+  def _errorHandler(self, advertSet):
+    def error(e):
+      self.mutex.acquire()
+      if advertSet.status == 'cancelled':
+        self._release(advertSet)
+      else:
+        advertSet.status = 'rejected: ' + str(e)
+      self.mutex.release()
+      print(f"Failed to register advertisement {advertSet.name}: {e}")
+    return error
+
+  #--------------------------------------------------------------
+  #  Change the data of one set in place
+  #--------------------------------------------------------------
+  def update(self, name, manufacturer=None, service=None):
+    advertSet = self.sets[name]
+    if manufacturer is not None:
+      advertSet.manufacturer = manufacturer
+    if service is not None:
+      advertSet.service = service
+
+    if advertSet.advertisement is None:
+      return False
+
+    def _update():
+      self._apply(advertSet)
+      return False
+
+    GLib.idle_add(_update)
+    return True
+
+  #--------------------------------------------------------------
+  #  Change the advertising interval (ms) of one set.  Kept for
+  #  other backends; bluetoothd 5.54 cannot apply it.
+  #--------------------------------------------------------------
+  def setInterval(self, name, interval):
+    self.sets[name].interval = interval
+    return False
+
+  #--------------------------------------------------------------
+  #  Unregister all sets; bus and main loop stay up.  Sets still
+  #  pending are unregistered when bluetoothd answers.
+  #--------------------------------------------------------------
+  def stop(self):
+    self.mutex.acquire()
+    for advertSet in self.sets.values():
+      if advertSet.advertisement is None:
+        continue
+      if advertSet.status == 'pending':
+        advertSet.status = 'cancelled'
+        continue
+      if advertSet.status == 'active':
+        self.connection.ad_manager.UnregisterAdvertisement(advertSet.advertisement)
+      if advertSet.status != 'cancelled':
+        self._release(advertSet)
+    self.mutex.release()
+
+  #--------------------------------------------------------------
+  #  Stop advertising and shut the main loop down, after giving
+  #  cancelled registrations up to 'timeout' seconds to finish
+  #--------------------------------------------------------------
+  def close(self, timeout=1.0):
+    self.stop()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and \
+          any(s.status == 'cancelled' for s in self.sets.values()):
+      time.sleep(0.01)
+    self.connection.close()
+
+  #--------------------------------------------------------------
+  #  Status of every set: active, pending, cancelled, no slot or
+  #  rejected
+  #--------------------------------------------------------------
+  def status(self):
+    return {name: s.status for name, s in self.sets.items()}
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+#============================================================================
+#
+#  asyncio PiSugar2 client
+#
+#  Same methods as PiSugar2.PiSugar2, as coroutines, so battery and RTC
+#  queries can share an event loop with an async scanner and UI instead
+#  of blocking a thread.
+#
+#  The connection is opened on first use and re-opened, with exponential
+#  backoff, when pisugar-server goes away; a query that hits a dropped
+#  connection is retried on the new one (actions only if they were not
+#  sent yet).  A reply that does not arrive within 'timeout' raises
+#  asyncio.TimeoutError and drops the connection, so the late reply is
+#  never read as the answer to a later request.
+#
+#============================================================================
+
+from __future__ import annotations
+import sys
+import socket
+import asyncio
+from collections import deque
+from datetime import datetime
+from PiSugar2 import PiSugarStatus, STATUS_QUERIES, BUTTON_PRESSES, EVENT_QUEUE_SIZE
+
+
+#---------------------------------------------------------------------------
+#
+#  AsyncPiSugar2
+#
+#---------------------------------------------------------------------------
+
+class AsyncPiSugar2:
+
+    #------------------------------------------------
+    #
+    #  Constructor - does not connect yet
+    #
+    #  timeout     seconds to wait for a reply
+    #  retries     reconnects per request
+    #  maxBackoff  longest wait between reconnects
+    #
+    #------------------------------------------------
+    def __init__(self, ip="127.0.0.1", port=8423, timeout: float = 1.0,
+                 retries: int = 3, maxBackoff: float = 5.0):
+      self.ip = ip
+      self.port = port
+      self.timeout = timeout
+      self.retries = retries
+      self.minBackoff = 0.1
+      self.maxBackoff = maxBackoff
+      self.backoff = self.minBackoff
+
+      self.reader = None
+      self.writer = None
+      # Created in pipeline(), on the loop that runs it
+      self.lock = None
+      self.events = deque(maxlen=EVENT_QUEUE_SIZE)
+      self.reconnects = 0
+
+    #------------------------------------------------
+    #  Open the connection
+    #------------------------------------------------
+    async def connect(self):
+      self.reader, self.writer = await asyncio.wait_for(
+        asyncio.open_connection(self.ip, self.port), self.timeout)
+      sock = self.writer.get_extra_info('socket')
+      if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.backoff = self.minBackoff
+
+    #------------------------------------------------
+    #  Drop the connection
+    #------------------------------------------------
+    def _drop(self):
+      if self.writer is not None:
+        self.writer.close()
+      self.reader = None
+      self.writer = None
+
+    async def close(self):
+      if self.writer is not None:
+        writer = self.writer
+        self._drop()
+        try:
+          await writer.wait_closed()
+        except OSError:
+          pass
+
+    #------------------------------------------------
+    #
+    #  Key in front of the reply to a command, see
+    #  Netcat.reply_key
+    #
+    #------------------------------------------------
+    def _reply_key(self, command: str) -> str:
+      words = command.split()
+      if words[0] == "get" and len(words) > 1:
+        return words[1]
+      return words[0]
+
+    #------------------------------------------------
+    #
+    #  Next line starting with 'key:'; pushed button
+    #  presses are queued.  Another line without a
+    #  key ("Invalid request.") answers this request
+    #  and gives "", see Netcat.reply
+    #
+    #------------------------------------------------
+    async def _reply(self, key: str) -> str:
+      while True:
+        line = await self.reader.readline()
+        if not line:
+          raise ConnectionResetError(f"pisugar-server at {self.ip}:{self.port} closed the connection")
+        line = line.decode('utf-8').rstrip()
+        if line.startswith(key + ":"):
+          return line
+        if line in BUTTON_PRESSES:
+          self.events.append(line)
+        elif line and ":" not in line:
+          return ""
+
+    #------------------------------------------------
+    #
+    #  Send commands in one write and return their
+    #  replies in order, reconnecting as needed.
+    #
+    #  If the connection drops after the write only
+    #  'get' queries are resent; an action may
+    #  already have run.
+    #
+    #------------------------------------------------
+    async def pipeline(self, commands: list) -> list:
+      idempotent = all(c.split()[0] == "get" for c in commands)
+      if self.lock is None:
+        self.lock = asyncio.Lock()
+
+      async with self.lock:
+        attempt = 0
+        while True:
+          sent = False
+          try:
+            if self.writer is None:
+              await self.connect()
+            self.writer.write("".join(c + "\n" for c in commands).encode("UTF-8"))
+            await self.writer.drain()
+            sent = True
+
+            results = []
+            for c in commands:
+              results.append(await asyncio.wait_for(self._reply(self._reply_key(c)),
+                                                    self.timeout))
+            return results
+
+          except asyncio.TimeoutError:
+            self._drop()
+            if not sent:
+              if attempt < self.retries:
+                attempt = await self._backoff(attempt)
+                continue
+              raise ConnectionError(f"pisugar-server at {self.ip}:{self.port}: connect timed out")
+            raise
+
+          except OSError as e:
+            self._drop()
+            if attempt >= self.retries or (sent and not idempotent):
+              raise ConnectionError(f"pisugar-server at {self.ip}:{self.port}: {e}")
+            attempt = await self._backoff(attempt)
+
+    #------------------------------------------------
+    #  Wait before the next reconnect
+    #------------------------------------------------
+    async def _backoff(self, attempt: int) -> int:
+      self.reconnects = self.reconnects + 1
+      await asyncio.sleep(self.backoff)
+      self.backoff = min(self.backoff * 2, self.maxBackoff)
+      return attempt + 1
+
+    #------------------------------------------------
+    #  Send one command, return its reply line
+    #------------------------------------------------
+    async def query(self, data: str) -> str:
+      return (await self.pipeline([data]))[0]
+
+    #------------------------------------------------
+    #  Reply parsing
+    #------------------------------------------------
+    async def _value(self, command: str) -> str:
+      output = await self.query(command)
+      return output.split(": ", 1)[1]
+
+    async def _true(self, command: str) -> bool:
+      return await self._value(command) == "true"
+
+    async def _done(self, command: str) -> bool:
+      return await self._value(command) == "done"
+
+    #------------------------------------------------
+    #  Getters, see PiSugar2
+    #------------------------------------------------
+    async def get_model(self) -> str:
+      return await self._value("get model")
+
+    async def get_battery_percentage(self) -> float:
+      return float(await self._value("get battery"))
+
+    async def get_voltage(self) -> float:
+      return float(await self._value("get battery_v"))
+
+    async def get_amperage(self) -> float:
+      return float(await self._value("get battery_i"))
+
+    async def get_charging_status(self) -> bool:
+      return await self._true("get battery_charging")
+
+    async def get_status(self) -> PiSugarStatus:
+      outputs = await self.pipeline([q for q, _ in STATUS_QUERIES])
+      values = []
+      for output, (_, convert) in zip(outputs, STATUS_QUERIES):
+        tup = output.split(": ", 1)
+        values.append(convert(tup[1]) if len(tup) == 2 else None)
+      return PiSugarStatus(*values)
+
+    async def get_time(self) -> datetime:
+      return datetime.fromisoformat(await self._value("get rtc_time"))
+
+    async def get_alarm_enabled(self) -> bool:
+      return await self._true("get rtc_alarm_enabled")
+
+    async def get_alarm_time(self) -> datetime:
+      return datetime.fromisoformat(await self._value("get rtc_alarm_time"))
+
+    async def get_alarm_repeat(self) -> int:
+      return int(await self._value("get alarm_repeat"))
+
+    async def get_button_enable(self, press: str) -> bool:
+      output = await self.query(f"get button_enable {press}")
+      return output.split(" ")[2] == "true"
+
+    async def get_button_shell(self, press: str) -> str:
+      output = await self.query(f"get button_shell {press}")
+      split = output.split(" ", 2)
+      return split[2] if len(split) > 2 else None
+
+    async def get_safe_shutdown_level(self) -> float:
+      return float(await self._value("get safe_shutdown_level"))
+
+    async def get_battery_allow_charging(self) -> bool:
+      return await self._true("get battery_allow_charging")
+
+    async def get_battery_power_plugged(self) -> bool:
+      return await self._true("get battery_power_plugged")
+
+    async def get_battery_led_amount(self) -> int:
+      return int(await self._value("get battery_led_amount"))
+
+    async def get_safe_shutdown_delay(self) -> float:
+      return float(await self._value("get safe_shutdown_delay"))
+
+    async def get_alarm_flag(self) -> bool:
+      return await self._true("get rtc_alarm_flag")
+
+    async def get_button_press(self) -> str:
+      output = await self.query("get button_press")
+      if self.events:
+        return self.events.popleft()
+      return output.partition(":")[2].strip()
+
+    #------------------------------------------------
+    #  Setters and actions, see PiSugar2
+    #------------------------------------------------
+    async def set_rtc_from_pi(self) -> bool:
+      return await self._done("rtc_pi2rtc")
+
+    async def set_pi_from_rtc(self) -> bool:
+      return await self._done("rtc_rtc2pi")
+
+    async def set_time_from_web(self) -> bool:
+      return await self._done("rtc_web")
+
+    async def set_rtc_alarm(self, time: datetime, repeat: list = [0, 0, 0, 0, 0, 0, 0]) -> bool:
+      timestr = datetime.isoformat(time)
+      if datetime.utcoffset(time) is None:
+          timestr += "-06:00"
+      if any(x not in [0, 1] for x in repeat):
+        return False
+      repeat_dec = int("".join(str(x) for x in repeat), 2)
+      return await self._done(f"rtc_alarm_set {timestr} {repeat_dec}")
+
+    async def disable_alarm(self) -> bool:
+      return await self._done("rtc_alarm_disable")
+
+    async def set_button_enable(self, press: str, enable: bool = True) -> bool:
+      return await self._done(f"set_button_enable {press} {int(enable)}")
+
+    async def set_button_shell(self, press: str, shell: str, enable: bool = True) -> bool:
+      if not await self.set_button_enable(press, enable):
+        return False
+      return await self._done(f"set_button_shell {press} {shell}")
+
+    async def set_safe_shutdown_level(self, level: int) -> bool:
+      level = int(level)
+      if level > 30 or level < 0:
+        return False
+      return await self._done(f"set_safe_shutdown_level {level}")
+
+    async def set_safe_shutdown_delay(self, delay: int) -> bool:
+      delay = int(delay)
+      if delay > 120 or delay < 0:
+        return False
+      return await self._done(f"set_safe_shutdown_delay {delay}")
+
+    async def rtc_test_wake(self) -> bool:
+      return await self._done("rtc_test_wake")
+
+    async def force_shutdown(self) -> bool:
+      return await self._done("force_shutdown")
+
+
+#------------------------------------------------
+#  Main - print the battery status every second
+#------------------------------------------------
+async def _monitor(ip, port):
+  pisugar = AsyncPiSugar2(ip, port)
+  while True:
+    try:
+      print(await pisugar.get_status())
+    except (ConnectionError, asyncio.TimeoutError) as e:
+      print(f"pisugar: {e}")
+    await asyncio.sleep(1.0)
+
+if __name__ == "__main__":
+  ip = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1"
+  port = int(sys.argv[2]) if len(sys.argv) > 2 else 8423
+  asyncio.run(_monitor(ip, port))
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+#=======================================================================
+#
+#  BluezObjects
+#
+#  Local mirror of the bluez ObjectManager tree.  GetManagedObjects()
+#  is called once; InterfacesAdded / InterfacesRemoved and
+#  PropertiesChanged keep the mirror current, so finding the adapter
+#  or a device by address does not fetch the whole tree again.
+#
+#  The signals are delivered by a GLib main loop, the mirror only stays
+#  current while one is running.
+#
+#  Copyright (C) 2020, E-Motion, Inc - All Rights Reserved.
+#  Unauthorized copying of this file, via any medium is
+#  strictly prohibited
+#
+#  Proprietary and confidential
+#  larry@e-motion.ai
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+#  CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+#  TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#=======================================================================
+import threading
+import dbus
+
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+DBUS_OM_IFACE      = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE    = 'org.freedesktop.DBus.Properties'
+ADAPTER_IFACE      = 'org.bluez.Adapter1'
+DEVICE_IFACE       = 'org.bluez.Device1'
+
+
+#=======================================================================
+#
+#   ObjectCache
+#
+#   objects     path -> {interface: {property: value}}
+#   interfaces  interface -> {path: None} (insertion ordered set)
+#   devices     upper case address -> device path
+#
+#=======================================================================
+class ObjectCache:
+
+  #--------------------------------------------------------------
+  #  Constructor - load the tree and subscribe to changes
+  #--------------------------------------------------------------
+  def __init__(self, bus):
+    self.bus = bus
+    self.mutex = threading.Lock()
+    self.objects = {}
+    self.interfaces = {}
+    self.devices = {}
+
+    self.matches = [
+      bus.add_signal_receiver(self._interfacesAdded,
+                              signal_name='InterfacesAdded',
+                              dbus_interface=DBUS_OM_IFACE,
+                              bus_name=BLUEZ_SERVICE_NAME),
+      bus.add_signal_receiver(self._interfacesRemoved,
+                              signal_name='InterfacesRemoved',
+                              dbus_interface=DBUS_OM_IFACE,
+                              bus_name=BLUEZ_SERVICE_NAME),
+      bus.add_signal_receiver(self._propertiesChanged,
+                              signal_name='PropertiesChanged',
+                              dbus_interface=DBUS_PROP_IFACE,
+                              bus_name=BLUEZ_SERVICE_NAME,
+                              path_keyword='path'),
+    ]
+
+    # Subscribe first so nothing between the load and the
+    # subscription is missed; a signal for an object already
+    # loaded just overwrites it with the same values
+    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'),
+                               DBUS_OM_IFACE)
+    for path, ifaces in remote_om.GetManagedObjects().items():
+      self._interfacesAdded(path, ifaces)
+
+  #--------------------------------------------------------------
+  #  Signal handlers
+  #--------------------------------------------------------------
+  def _interfacesAdded(self, path, ifaces):
+    path = str(path)
+    self.mutex.acquire()
+    obj = self.objects.setdefault(path, {})
+    for iface, props in ifaces.items():
+      iface = str(iface)
+      obj[iface] = dict(props)
+      self.interfaces.setdefault(iface, {})[path] = None
+      if iface == DEVICE_IFACE and 'Address' in props:
+        self.devices[str(props['Address']).upper()] = path
+    self.mutex.release()
+
+  def _interfacesRemoved(self, path, ifaces):
+    path = str(path)
+    self.mutex.acquire()
+    obj = self.objects.get(path, {})
+    for iface in ifaces:
+      iface = str(iface)
+      props = obj.pop(iface, None)
+      self.interfaces.get(iface, {}).pop(path, None)
+      if iface == DEVICE_IFACE and props is not None and 'Address' in props:
+        self.devices.pop(str(props['Address']).upper(), None)
+    if not obj:
+      self.objects.pop(path, None)
+    self.mutex.release()
+
+  def _propertiesChanged(self, iface, changed, invalidated, path=None):
+    iface = str(iface)
+    self.mutex.acquire()
+    props = self.objects.get(str(path), {}).get(iface)
+    if props is not None:
+      props.update(changed)
+      for name in invalidated:
+        props.pop(name, None)
+    self.mutex.release()
+
+  #--------------------------------------------------------------
+  #  First object path implementing 'iface', or None
+  #--------------------------------------------------------------
+  def findAdapter(self, iface=ADAPTER_IFACE):
+    self.mutex.acquire()
+    path = next(iter(self.interfaces.get(iface, {})), None)
+    self.mutex.release()
+    return path
+
+  #--------------------------------------------------------------
+  #  Device object path for 'aa:bb:cc:dd:ee:ff', or None
+  #--------------------------------------------------------------
+  def findDevice(self, address):
+    self.mutex.acquire()
+    path = self.devices.get(address.upper())
+    self.mutex.release()
+    return path
+
+  #--------------------------------------------------------------
+  #  Copy of the cached properties of one interface, or None
+  #--------------------------------------------------------------
+  def properties(self, path, iface):
+    self.mutex.acquire()
+    props = self.objects.get(path, {}).get(iface)
+    props = dict(props) if props is not None else None
+    self.mutex.release()
+    return props
+
+  #--------------------------------------------------------------
+  #  Stop following changes
+  #--------------------------------------------------------------
+  def close(self):
+    for match in self.matches:
+      match.remove()
+    self.matches = []
+
+
+#-----------------------------------------------------------------------
+#  One shared cache per bus
+#-----------------------------------------------------------------------
+_caches = {}
+_cachesMutex = threading.Lock()
+
+def objectCache(bus):
+  _cachesMutex.acquire()
+  try:
+    cache = _caches.get(bus)
+    if cache is None:
+      cache = ObjectCache(bus)
+      _caches[bus] = cache
+  finally:
+    _cachesMutex.release()
+  return cache
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+#=======================================================================
+#
+#  HciAdvertiser
+#
+#  Advertising backend that programs the controller directly with LE
+#  Set Advertising Parameters / Data / Enable, skipping bluetoothd and
+#  D-Bus.  Same surface as Advertiser.AdvertisingManager.
+#
+#  Legacy HCI advertising has a single set: the highest priority set is
+#  advertised, the others report 'no slot'.  bluetoothd must not be
+#  advertising on the same adapter at the same time.
+#
+#  start/stop run on the RadioScheduler thread while setInterval and
+#  update come from the main loop, so every command sequence holds
+#  radioMutex (as MultiScanner does for scanning).
+#
+#  Usage:  ./HciAdvertiser.py [--backend hci|dbus|both] [--runs N]
+#          measures time-to-first-advertisement of the backends
+#
+#  Copyright (C) 2020, E-Motion, Inc - All Rights Reserved.
+#  Unauthorized copying of this file, via any medium is
+#  strictly prohibited
+#
+#  Proprietary and confidential
+#  larry@e-motion.ai
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#  MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+#  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+#  CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+#  TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+#=======================================================================
+import os
+import sys
+import time
+import uuid
+import struct
+import subprocess
+import argparse
+import threading
+import bluetooth._bluetooth as bluez
+from ScanUtility import OGF_LE_CTL, SCAN_TIME_UNIT_MS
+from AdvertSets import iBeaconSet
+
+
+OCF_LE_SET_ADVERTISING_PARAMETERS = 0x0006
+OCF_LE_SET_ADVERTISING_DATA       = 0x0008
+OCF_LE_SET_ADVERTISE_ENABLE       = 0x000A
+
+ADV_IND         = 0x00
+ADV_NONCONN_IND = 0x03
+
+# Not a controller status: hci_send_req failed or got no Command Complete
+HCI_NO_REPLY    = 0xFF
+
+HCI_TIMEOUT_MS  = 1000
+
+
+#-----------------------------------------------------------------------
+#  Send an LE controller command and wait for its Command Complete.
+#  Returns the HCI status (0 = success), HCI_NO_REPLY if the command
+#  timed out or the socket failed
+#-----------------------------------------------------------------------
+def hci_le_command(sock, ocf, params):
+  try:
+    resp = bluez.hci_send_req(sock, OGF_LE_CTL, ocf, bluez.EVT_CMD_COMPLETE, 1, params,
+                              HCI_TIMEOUT_MS)
+  except (bluez.error, OSError) as e:
+    print(f"HCI command 0x{ocf:04x} failed: {e}")
+    return HCI_NO_REPLY
+  return resp[0] if resp else HCI_NO_REPLY
+
+def hci_le_set_advertising_parameters(sock, interval_ms=100.0, adv_type=ADV_NONCONN_IND):
+  interval = max(0x0020, min(0x4000, int(interval_ms / SCAN_TIME_UNIT_MS)))
+  # min/max interval, type, own addr public, peer addr type/addr, all channels, no filter
+  params = struct.pack("<HHBBB6sBB", interval, interval, adv_type, 0x00, 0x00,
+                       bytes(6), 0x07, 0x00)
+  return hci_le_command(sock, OCF_LE_SET_ADVERTISING_PARAMETERS, params)
+
+def hci_le_set_advertising_data(sock, data):
+  params = struct.pack("<B31s", len(data), data)
+  return hci_le_command(sock, OCF_LE_SET_ADVERTISING_DATA, params)
+
+def hci_le_set_advertise_enable(sock, enable):
+  return hci_le_command(sock, OCF_LE_SET_ADVERTISE_ENABLE, struct.pack("<B", enable))
+
+
+#=======================================================================
+#
+#   Direct HCI advertiser
+#
+#=======================================================================
+class HciAdvertiser:
+
+  #--------------------------------------------------------------
+  #  Constructor
+  #--------------------------------------------------------------
+  def __init__(self, devId=0):
+    self.devId = devId
+    self.sock = None
+    self.sets = {}
+    self.nextIndex = 0
+    self.active = None
+    self.radioMutex = threading.Lock()
+
+  #--------------------------------------------------------------
+  #  Open the adapter (once)
+  #--------------------------------------------------------------
+  def open(self):
+    if self.sock is None:
+      try:
+        self.sock = bluez.hci_open_dev(self.devId)
+      except Exception as e:
+        print(f"Error accessing bluetooth hci{self.devId}: {e}")
+        return False
+    return True
+
+  #--------------------------------------------------------------
+  #  Add (or replace) a set; takes effect on the next start()
+  #--------------------------------------------------------------
+  def addSet(self, advertSet):
+    prev = self.sets.get(advertSet.name)
+    if prev is not None:
+      advertSet.index = prev.index
+    else:
+      advertSet.index = self.nextIndex
+      self.nextIndex = self.nextIndex + 1
+    self.sets[advertSet.name] = advertSet
+
+  #--------------------------------------------------------------
+  #  Advertise the highest priority set
+  #--------------------------------------------------------------
+  def start(self):
+    if not self.open() or not self.sets:
+      return False
+
+    self.radioMutex.acquire()
+    try:
+      ordered = sorted(self.sets.values(), key=lambda s: s.priority)
+      for advertSet in ordered[1:]:
+        advertSet.status = 'no slot'
+
+      advertSet = ordered[0]
+      rc = 0
+      if self.active is not None:
+        rc = hci_le_set_advertise_enable(self.sock, 0x00)
+
+      adv_type = ADV_IND if advertSet.ad_type == 'peripheral' else ADV_NONCONN_IND
+      if rc == 0:
+        rc = hci_le_set_advertising_parameters(self.sock, advertSet.interval, adv_type)
+      if rc == 0:
+        rc = hci_le_set_advertising_data(self.sock, advertSet.adData())
+      if rc == 0:
+        rc = hci_le_set_advertise_enable(self.sock, 0x01)
+
+      if rc != 0:
+        advertSet.status = f"rejected: HCI status 0x{rc:02x}"
+        print(f"Failed to start advertisement {advertSet.name}: HCI status 0x{rc:02x}")
+        self.active = None
+        return False
+
+      advertSet.status = 'active'
+      self.active = advertSet
+    finally:
+      self.radioMutex.release()
+
+    print(f"Start advertising {self.status()}")
+    return True
+
+  #--------------------------------------------------------------
+  #  Change the data of one set; the controller takes new
+  #  advertising data while advertising is enabled
+  #--------------------------------------------------------------
+  def update(self, name, manufacturer=None, service=None):
+    advertSet = self.sets[name]
+    if manufacturer is not None:
+      advertSet.manufacturer = manufacturer
+    if service is not None:
+      advertSet.service = service
+
+    self.radioMutex.acquire()
+    try:
+      if advertSet is not self.active:
+        return False
+      return hci_le_set_advertising_data(self.sock, advertSet.adData()) == 0
+    finally:
+      self.radioMutex.release()
+
+  #--------------------------------------------------------------
+  #  Change the advertising interval (ms) of one set.  The
+  #  parameters can only be set while advertising is disabled;
+  #  advertising is only re-enabled if the set is still active,
+  #  so an off or scan window is never turned back on.
+  #--------------------------------------------------------------
+  def setInterval(self, name, interval):
+    advertSet = self.sets[name]
+    advertSet.interval = interval
+
+    self.radioMutex.acquire()
+    try:
+      if advertSet is not self.active:
+        return False
+      adv_type = ADV_IND if advertSet.ad_type == 'peripheral' else ADV_NONCONN_IND
+      rc = hci_le_set_advertise_enable(self.sock, 0x00)
+      if rc != 0:
+        print(f"Failed to set interval of {name}: disable HCI status 0x{rc:02x}")
+        return False
+      rc = hci_le_set_advertising_parameters(self.sock, interval, adv_type)
+      enable = hci_le_set_advertise_enable(self.sock, 0x01)
+      if enable != 0:
+        advertSet.status = f"rejected: HCI status 0x{enable:02x}"
+        print(f"Failed to re-enable advertisement {name}: HCI status 0x{enable:02x}")
+        self.active = None
+        return False
+      if rc != 0:
+        print(f"Failed to set interval of {name}: HCI status 0x{rc:02x}")
+      return rc == 0
+    finally:
+      self.radioMutex.release()
+
+  #--------------------------------------------------------------
+  #  Stop advertising; the adapter stays open
+  #--------------------------------------------------------------
+  def stop(self):
+    self.radioMutex.acquire()
+    try:
+      if self.active is None:
+        return
+      rc = hci_le_set_advertise_enable(self.sock, 0x00)
+      for advertSet in self.sets.values():
+        advertSet.status = 'idle'
+      self.active = None
+    finally:
+      self.radioMutex.release()
+
+    if rc != 0:
+      print(f"Failed to stop advertising: HCI status 0x{rc:02x}")
+    else:
+      print('Stopped advertising')
+
+  #--------------------------------------------------------------
+  #  Stop advertising and close the adapter
+  #--------------------------------------------------------------
+  def close(self):
+    self.stop()
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+  #--------------------------------------------------------------
+  #  Status of every set
+  #--------------------------------------------------------------
+  def status(self):
+    return {name: s.status for name, s in self.sets.items()}
+
+
+#-----------------------------------------------------------------------
+#
+#  Time from a cold backend (no bus, no open adapter) to the first
+#  advertisement accepted by the controller, in ms.  For D-Bus that is
+#  the RegisterAdvertisement reply; for HCI the Command Complete of
+#  LE Set Advertise Enable.
+#
+#  Only the first call in a process is cold: dbus keeps the system bus
+#  connection and the modules stay imported.  main() runs each
+#  measurement in a fresh interpreter (coldRun).
+#
+#-----------------------------------------------------------------------
+def timeToFirstAdvert(backend, devId=0, timeout=5.0):
+  advertSet = iBeaconSet('ibeacon', uuid.UUID('{2f234454-cf6d-4a0f-adf2-f4911ba9ffa6}'),
+                         0, 0)
+
+  start = time.monotonic()
+  if backend == 'hci':
+    advertiser = HciAdvertiser(devId)
+  else:
+    from Advertiser import AdvertisingManager
+    advertiser = AdvertisingManager()
+  advertiser.addSet(advertSet)
+  advertiser.start()
+
+  while advertSet.status == 'pending' and time.monotonic() - start < timeout:
+    time.sleep(0.001)
+  elapsed = (time.monotonic() - start) * 1000.0
+
+  ok = advertSet.status == 'active'
+  advertiser.close()
+  return elapsed if ok else None
+
+
+#-----------------------------------------------------------------------
+#  One timeToFirstAdvert in a new python process, None if it failed
+#-----------------------------------------------------------------------
+def coldRun(backend, devId=0):
+  result = subprocess.run([sys.executable, os.path.abspath(__file__),
+                           '--backend', backend, '--dev', str(devId), '--once'],
+                          stdout=subprocess.PIPE, universal_newlines=True)
+  lines = result.stdout.split()
+  if result.returncode != 0 or not lines or lines[-1] == 'none':
+    return None
+  return float(lines[-1])
+
+
+#-----------------------------------------------------------------------
+#  main()
+#-----------------------------------------------------------------------
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--backend', choices=['hci', 'dbus', 'both'], default='both')
+  parser.add_argument('--runs', type=int, default=10)
+  parser.add_argument('--dev', type=int, default=0)
+  parser.add_argument('--once', action='store_true',
+                      help="measure once in this process and print the ms")
+  args = parser.parse_args(argv)
+
+  if args.once:
+    ms = timeToFirstAdvert(args.backend, args.dev)
+    print('none' if ms is None else f"{ms:.3f}")
+    return
+
+  backends = ['dbus', 'hci'] if args.backend == 'both' else [args.backend]
+  for backend in backends:
+    results = []
+    for i in range(args.runs):
+      ms = coldRun(backend, args.dev)
+      if ms is not None:
+        results.append(ms)
+      time.sleep(0.5)
+
+    if results:
+      print(f"{backend}: time to first advert {sum(results)/len(results):.1f} ms "
+            f"(min {min(results):.1f}, max {max(results):.1f}, "
+            f"{len(results)}/{args.runs} ok)")
+    else:
+      print(f"{backend}: no advertisement started")
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  MultiScanner.py
+#
+#  Scan for beacons on several HCI adapters at once and merge what they
+#  hear into one deduplicated sighting stream
+#
+#  Author: E-Motion Inc
+#
+#  Copyright (c) 2020, E-Motion, Inc.  All Rights Researcved
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#=============================================================================
+import sys
+import time
+import select
+import threading
+from collections import OrderedDict
+import bluetooth._bluetooth as bluez
+import ScanUtility
+
+
+#-----------------------------------------------------------------------------
+#
+#  Scan profiles (interval and window in ms)
+#
+#  The controller hops over advertising channels 37/38/39 once per scan
+#  interval.  HCI does not let us pin an adapter to a channel, so the
+#  'phase' of an adapter (fraction of its interval) delays its scan enable
+#  to keep the adapters' channel rotations out of step with each other.
+#
+#-----------------------------------------------------------------------------
+SCAN_PROFILES = {
+  'continuous' : {'interval': 100.0,  'window': 100.0, 'active': False},
+  'balanced'   : {'interval': 100.0,  'window': 50.0,  'active': False},
+  'lowpower'   : {'interval': 1000.0, 'window': 100.0, 'active': False},
+}
+
+DEFAULT_ADAPTERS = [{'devId': 0, 'profile': 'continuous'}]
+
+
+#-----------------------------------------------------------------------------
+#
+#  ScanAdapter - one HCI adapter and its scan settings
+#
+#-----------------------------------------------------------------------------
+class ScanAdapter:
+
+  #----------------------------------------------
+  #  Constructor
+  #
+  #  config = {'devId': 0, 'profile': 'balanced',
+  #            'interval': ms, 'window': ms, 'phase': 0.0-1.0}
+  #
+  #  Explicit interval/window override the profile
+  #----------------------------------------------
+  def __init__(self, config):
+    profile = SCAN_PROFILES[config.get('profile', 'continuous')]
+
+    self.devId    = config.get('devId', 0)
+    self.interval = config.get('interval', profile['interval'])
+    self.window   = config.get('window', profile['window'])
+    self.active   = config.get('active', profile['active'])
+    self.phase    = config.get('phase', 0.0)
+
+    self.sock = None
+    self.tsock = None
+    self.thread = None
+    self.packets = 0
+    self.unique = 0
+
+  #----------------------------------------------
+  #  Open the adapter and start LE scanning
+  #----------------------------------------------
+  def open(self):
+    self.sock = bluez.hci_open_dev(self.devId)
+    self.tsock = ScanUtility.open_timestamped(self.sock)
+    if self.tsock is None:
+      print(f"hci{self.devId}: no kernel timestamps, using receive time")
+    ScanUtility.hci_disable_le_scan(self.sock)
+    ScanUtility.hci_le_set_scan_parameters(self.sock, self.interval,
+                                           self.window, self.active)
+    if self.phase > 0.0:
+      time.sleep(self.interval * self.phase / 1000.0)
+    ScanUtility.hci_enable_le_scan(self.sock)
+
+  #----------------------------------------------
+  #  Stop LE scanning and close the adapter
+  #----------------------------------------------
+  def close(self):
+    if self.tsock is not None:
+      self.tsock.close()
+      self.tsock = None
+    if self.sock is not None:
+      ScanUtility.hci_disable_le_scan(self.sock)
+      self.sock.close()
+      self.sock = None
+
+
+#-----------------------------------------------------------------------------
+#
+#  MultiScanner
+#
+#  Runs one scan thread per adapter.  Every decoded beacon gets an
+#  'adapter' (dev id that heard it first), an 'adapters' list (every dev id
+#  that heard the same advertisement within 'dedupWindow' seconds) and a
+#  'timestamp' (kernel receive time as monotonic ns).  Only the first copy
+#  is passed to 'callback'; later copies just extend the 'adapters' list of
+#  the first one.
+#
+#-----------------------------------------------------------------------------
+class MultiScanner:
+
+  #----------------------------------------------
+  #  Constructor
+  #----------------------------------------------
+  def __init__(self, adapters=DEFAULT_ADAPTERS, callback=None, dedupWindow=0.02):
+    self.adapters = [ScanAdapter(a) for a in adapters]
+    self.callback = callback
+    self.dedupWindow = int(dedupWindow * 1e9)
+    self.pollTimeout = 0.5
+
+    self.mutex = threading.Lock()
+    self.recent = OrderedDict()
+    self.duplicates = 0
+    self.scanExit = True
+    self.paused = False
+    # pause/resume (radio scheduler) and setScanParameters (rate
+    # controller) run on different threads; each HCI sequence is atomic
+    self.radioMutex = threading.Lock()
+
+  #----------------------------------------------
+  #  Key identifying the same advertisement
+  #  heard by different adapters
+  #----------------------------------------------
+  def _sightingKey(self, beacon):
+    return (beacon['type'], beacon.get('macAddress'), beacon.get('uuid'),
+            beacon.get('major'), beacon.get('minor'),
+            beacon.get('namespace'), beacon.get('instance'), beacon.get('url'))
+
+  #----------------------------------------------
+  #  Merge a beacon into the sighting stream
+  #  Returns True if it is a new sighting
+  #----------------------------------------------
+  def _merge(self, adapter, beacon):
+    now = beacon['timestamp']
+    key = self._sightingKey(beacon)
+
+    self.mutex.acquire()
+
+    # Expire old sightings (oldest first)
+    while self.recent:
+      k, (t, b) = next(iter(self.recent.items()))
+      if now - t <= self.dedupWindow:
+        break
+      self.recent.popitem(last=False)
+
+    prev = self.recent.get(key)
+    if prev is not None and prev[1]['adapter'] != adapter.devId:
+      if adapter.devId not in prev[1]['adapters']:
+        prev[1]['adapters'].append(adapter.devId)
+      self.duplicates = self.duplicates + 1
+      isNew = False
+    else:
+      beacon['adapter'] = adapter.devId
+      beacon['adapters'] = [adapter.devId]
+      self.recent[key] = (now, beacon)
+      self.recent.move_to_end(key)
+      adapter.unique = adapter.unique + 1
+      isNew = True
+
+    self.mutex.release()
+    return isNew
+
+  #----------------------------------------------
+  #  Scan loop for one adapter
+  #----------------------------------------------
+  def _scanLoop(self, adapter):
+    while not self.scanExit:
+      r, _, _ = select.select([adapter.sock], [], [], self.pollTimeout)
+      if not r:
+        continue
+
+      beacons = ScanUtility.parse_events(adapter.sock, 1, adapter.tsock)
+
+      for beacon in beacons:
+        adapter.packets = adapter.packets + 1
+        if self._merge(adapter, beacon) and self.callback is not None:
+          self.callback(beacon)
+
+  #----------------------------------------------
+  #  Open all adapters and start scanning
+  #----------------------------------------------
+  def start(self):
+    self.scanExit = False
+    for adapter in self.adapters:
+      try:
+        adapter.open()
+      except Exception as e:
+        print(f"Error accessing bluetooth hci{adapter.devId}: {e}")
+        continue
+
+      adapter.thread = threading.Thread(target=self._scanLoop, args=(adapter,))
+      adapter.thread.setDaemon(True)
+      adapter.thread.start()
+
+  #----------------------------------------------
+  #  Stop scanning and close all adapters
+  #----------------------------------------------
+  def stop(self):
+    self.scanExit = True
+    for adapter in self.adapters:
+      if adapter.thread is not None:
+        adapter.thread.join()
+        adapter.thread = None
+      adapter.close()
+
+  #----------------------------------------------
+  #  Turn LE scanning off/on without closing the
+  #  adapters or stopping the scan threads
+  #----------------------------------------------
+  def pause(self):
+    self.radioMutex.acquire()
+    try:
+      self.paused = True
+      for adapter in self.adapters:
+        if adapter.sock is not None:
+          ScanUtility.hci_disable_le_scan(adapter.sock)
+    finally:
+      self.radioMutex.release()
+
+  def resume(self):
+    self.radioMutex.acquire()
+    try:
+      self.paused = False
+      for adapter in self.adapters:
+        if adapter.sock is not None:
+          ScanUtility.hci_enable_le_scan(adapter.sock)
+    finally:
+      self.radioMutex.release()
+
+  #----------------------------------------------
+  #  Change interval/window (ms) of all adapters;
+  #  scanning must be off while they are set
+  #----------------------------------------------
+  def setScanParameters(self, interval, window):
+    self.radioMutex.acquire()
+    try:
+      for adapter in self.adapters:
+        adapter.interval = interval
+        adapter.window = window
+        if adapter.sock is None:
+          continue
+        ScanUtility.hci_disable_le_scan(adapter.sock)
+        ScanUtility.hci_le_set_scan_parameters(adapter.sock, interval, window,
+                                               adapter.active)
+        if not self.paused:
+          ScanUtility.hci_enable_le_scan(adapter.sock)
+    finally:
+      self.radioMutex.release()
+
+  #----------------------------------------------
+  #  Per adapter counters
+  #----------------------------------------------
+  def stats(self):
+    return {'adapters': {a.devId: {'packets': a.packets, 'unique': a.unique}
+                         for a in self.adapters},
+            'duplicates': self.duplicates}
+
+
+#-----------------------------------------------------------------------------
+#  main() - scan on the given dev ids, e.g. ./MultiScanner.py 0 1
+#-----------------------------------------------------------------------------
+def main(argv):
+  devIds = [int(a) for a in argv] or [0]
+  adapters = [{'devId': d, 'phase': i / len(devIds)} for i, d in enumerate(devIds)]
+
+  scanner = MultiScanner(adapters, callback=print)
+  scanner.start()
+  try:
+    while True:
+      time.sleep(1.0)
+  except KeyboardInterrupt:
+    pass
+  scanner.stop()
+  print(scanner.stats())
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
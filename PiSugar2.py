@@ -10,10 +10,19 @@
 from __future__ import annotations
 import socket
 import time 
-from collections import namedtuple
+import threading
+import queue
+from collections import namedtuple, deque
 from datetime import datetime, timedelta
 
 
+# Lines the server pushes to every client when the button is pressed
+BUTTON_PRESSES = ("single", "double", "long")
+
+# Presses kept by Netcat for get_button_press; older ones are dropped
+EVENT_QUEUE_SIZE = 16
+
+
 #---------------------------------------------------------------------------
 #
 #  Netcat like object for reading/writing to sockets
@@ -26,8 +35,13 @@ class Netcat:
     #
     #  Constructor
     #
+    #  timeout = seconds to wait for a reply line
+    #
     #------------------------------------------------
-    def __init__(self, ip: str, port: int):
+    def __init__(self, ip: str, port: int, timeout: float = 1.0):
+      self.timeout = timeout
+      self.mutex = threading.Lock()
+      self.events = deque(maxlen=EVENT_QUEUE_SIZE)
       self.open(ip, port)
 
     #------------------------------------------------
@@ -36,28 +50,55 @@ class Netcat:
     def open(self, ip: str, port: int):
       self.ip = ip
       self.port = port
+      self.buffer = b""
+      self.stale = False
       self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-      self.socket.settimeout(0.01)
+      self.socket.settimeout(self.timeout)
       self.socket.connect((self.ip, self.port))
+      self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     #------------------------------------------------
     #
-    #  Read 1024 bytes off the socket
+    #  Return the next complete line, without the
+    #  trailing whitespace, as soon as it is in.
+    #
+    #  Replies may arrive split over several recv()
+    #  calls or several in one; what follows the
+    #  line stays buffered for the next call.
     #
-    #  Decode the returned byte string to a string 
-    #  and strip trailing whitespace
+    #  Returns None if no full line arrives within
+    #  'timeout' seconds
     #
     #------------------------------------------------
-    def read(self, length: int = 1024) -> str:
-      done = False
-      result = ""
-      while not done:
+    def readline(self, timeout: float = None) -> str:
+      if timeout is None:
+        timeout = self.timeout
+      deadline = time.monotonic() + timeout
+
+      while b"\n" not in self.buffer:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return None
+        self.socket.settimeout(remaining)
         try:
-          data = self.socket.recv(length)
-          result = data.decode('utf-8')
-        except socket.error as e:
-          done = True
-      return result.rstrip()
+          data = self.socket.recv(4096)
+        except socket.timeout:
+          return None
+        if not data:
+          raise ConnectionResetError(f"pisugar-server at {self.ip}:{self.port} closed the connection")
+        self.buffer = self.buffer + data
+
+      line, self.buffer = self.buffer.split(b"\n", 1)
+      return line.decode('utf-8').rstrip()
+
+    #------------------------------------------------
+    #
+    #  Read one line off the socket, "" if none
+    #
+    #------------------------------------------------
+    def read(self, length: int = 1024) -> str:
+      line = self.readline()
+      return line if line is not None else ""
 
     #------------------------------------------------
     #
@@ -76,6 +117,76 @@ class Netcat:
     def close(self) -> None:
       self.socket.close()
 
+    #------------------------------------------------
+    #
+    #  Key the server puts in front of the reply to
+    #  a command, e.g. "get battery" -> "battery",
+    #  "rtc_pi2rtc" -> "rtc_pi2rtc"
+    #
+    #------------------------------------------------
+    def reply_key(self, command: str) -> str:
+      words = command.split()
+      if words[0] == "get" and len(words) > 1:
+        return words[1]
+      return words[0]
+
+    #------------------------------------------------
+    #
+    #  Wait for the reply line starting with 'key:'.
+    #
+    #  Button presses pushed by the server are queued
+    #  in self.events.  Any other line without a key
+    #  (e.g. "Invalid request.") is the server's
+    #  answer to this request and gives "".
+    #
+    #  Returns "" on timeout.  The late reply would
+    #  be taken for the next request with the same
+    #  key, so the connection is then marked stale
+    #  and re-opened before the next request; later
+    #  replies of the same pipeline give "" at once.
+    #
+    #------------------------------------------------
+    def reply(self, key: str) -> str:
+      if self.stale:
+        return ""
+      deadline = time.monotonic() + self.timeout
+      while True:
+        line = self.readline(max(0.0, deadline - time.monotonic()))
+        if line is None:
+          self.stale = True
+          return ""
+        if line.startswith(key + ":"):
+          return line
+        if line in BUTTON_PRESSES:
+          self.events.append(line)
+        elif line and ":" not in line:
+          return ""
+
+    #------------------------------------------------
+    #  Re-open a connection that has a reply in
+    #  flight from a timed out request
+    #------------------------------------------------
+    def _fresh(self):
+      if self.stale:
+        self.close()
+        self.open(self.ip, self.port)
+
+    #------------------------------------------------
+    #
+    #  Send several commands in one write and return
+    #  their replies in order ("" for a reply that
+    #  did not arrive in time)
+    #
+    #------------------------------------------------
+    def pipeline(self, commands: list) -> list:
+      self.mutex.acquire()
+      try:
+        self._fresh()
+        self.write("".join(c + "\n" for c in commands))
+        return [self.reply(self.reply_key(c)) for c in commands]
+      finally:
+        self.mutex.release()
+
     #------------------------------------------------
     #
     #  Query the server by sending a command string
@@ -84,8 +195,36 @@ class Netcat:
     # 
     #------------------------------------------------
     def query(self, data: str) -> str:
-      self.write(data)
-      return self.read()
+      self.mutex.acquire()
+      try:
+        self._fresh()
+        self.write(data + "\n")
+        return self.reply(self.reply_key(data))
+      finally:
+        self.mutex.release()
+
+
+#---------------------------------------------------------------------------
+#
+#  Battery snapshot returned by PiSugar2.get_status()
+#
+#    battery   float  percent
+#    voltage   float  V
+#    amperage  float  A
+#    charging  bool
+#    plugged   bool   charging usb plugged (new model only)
+#
+#  A field is None if its reply did not arrive
+#
+#---------------------------------------------------------------------------
+PiSugarStatus = namedtuple('PiSugarStatus',
+                           ['battery', 'voltage', 'amperage', 'charging', 'plugged'])
+
+STATUS_QUERIES = [("get battery", float),
+                  ("get battery_v", float),
+                  ("get battery_i", float),
+                  ("get battery_charging", lambda v: v == "true"),
+                  ("get battery_power_plugged", lambda v: v == "true")]
 
 
 #---------------------------------------------------------------------------
@@ -182,6 +321,21 @@ class PiSugar2:
       tup = output.split(": ", 1)
       return tup[1] == "true"
 
+    #------------------------------------------------
+    #
+    #  Returns battery level, voltage, amperage,
+    #  charging and plugged state as a PiSugarStatus
+    #  in a single round trip
+    #
+    #------------------------------------------------
+    def get_status(self) -> PiSugarStatus:
+      outputs = self.netcat.pipeline([q for q, _ in STATUS_QUERIES])
+      values = []
+      for output, (_, convert) in zip(outputs, STATUS_QUERIES):
+        tup = output.split(": ", 1)
+        values.append(convert(tup[1]) if len(tup) == 2 else None)
+      return PiSugarStatus(*values)
+
     #------------------------------------------------
     #
     #  Returns the RTC time value with a datetime object 
@@ -354,7 +508,7 @@ class PiSugar2:
     #------------------------------------------------
     def set_rtc_alarm(self, time: datetime.datetime, repeat: list = [0, 0, 0, 0, 0, 0, 0]) -> bool:
       timestr = datetime.isoformat(time)
-      if not datetime.utcoffset(time):
+      if datetime.utcoffset(time) is None:
           timestr += "-06:00"
       # Build repeat string
       s = str()
@@ -454,11 +608,10 @@ class PiSugar2:
     #------------------------------------------------
     def get_button_press(self) -> str:
       output = self.netcat.query("get button_press")
-      tup = output.split(": ", 1)
-      if len(tup) == 1:
-        return tup[0] 
-      else:
-        return tup[1]
+      # A press pushed by the server while we waited
+      if self.netcat.events:
+        return self.netcat.events.popleft()
+      return output.partition(":")[2].strip()
  
  
     #------------------------------------------------
@@ -482,6 +635,95 @@ class PiSugar2:
       return tup[1] == "done" 
 
 
+#---------------------------------------------------------------------------
+#
+#  Button events pushed by pisugar-server
+#
+#  The server writes "single", "double" or "long" to every connected TCP
+#  client when the button is pressed.  ButtonEvents keeps one connection
+#  of its own and a listener thread blocked on it, and hands each press
+#  on as a ButtonEvent through a queue and an optional callback.  Nothing
+#  is sent to the server, so an idle listener costs no CPU.
+#
+#---------------------------------------------------------------------------
+ButtonEvent = namedtuple('ButtonEvent', ['press', 'timestamp'])
+
+class ButtonEvents:
+
+    #------------------------------------------------
+    #  Constructor
+    #
+    #  callback(event) is called from the listener
+    #  thread for every press
+    #------------------------------------------------
+    def __init__(self, ip="127.0.0.1", port=8423, callback=None):
+      self.ip = ip
+      self.port = port
+      self.callback = callback
+      self.queue = queue.Queue()
+      self.netcat = None
+      self.thread = None
+      self.exit = True
+      self.reconnects = 0
+
+    #------------------------------------------------
+    #  Listener thread; reconnects with backoff if
+    #  the server goes away
+    #------------------------------------------------
+    def _listen(self):
+      backoff = 0.1
+      while not self.exit:
+        try:
+          if self.netcat is None:
+            self.netcat = Netcat(self.ip, self.port)
+            backoff = 0.1
+          line = self.netcat.readline(1.0)
+        except OSError as e:
+          if self.netcat is not None:
+            self.netcat.close()
+            self.netcat = None
+          print(f"Button events: {e}, reconnecting in {backoff:.1f}s")
+          self.reconnects = self.reconnects + 1
+          time.sleep(backoff)
+          backoff = min(backoff * 2, 5.0)
+          continue
+
+        if line in BUTTON_PRESSES:
+          event = ButtonEvent(line, time.monotonic())
+          self.queue.put(event)
+          if self.callback is not None:
+            self.callback(event)
+
+      if self.netcat is not None:
+        self.netcat.close()
+        self.netcat = None
+
+    #------------------------------------------------
+    #  Start/stop the listener
+    #------------------------------------------------
+    def start(self):
+      self.exit = False
+      self.thread = threading.Thread(target=self._listen)
+      self.thread.setDaemon(True)
+      self.thread.start()
+
+    def stop(self):
+      self.exit = True
+      if self.thread is not None:
+        self.thread.join()
+        self.thread = None
+
+    #------------------------------------------------
+    #  Block until the next press; None after
+    #  'timeout' seconds without one
+    #------------------------------------------------
+    def get(self, timeout: float = None) -> ButtonEvent:
+      try:
+        return self.queue.get(timeout=timeout)
+      except queue.Empty:
+        return None
+
+
 #------------------------------------------------
 #  Wake after function
 #------------------------------------------------
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+#============================================================================
+#
+#  PiSugar2 telemetry cache
+#
+#  Battery level, voltage and model change slowly; readers that ask for
+#  them every frame or report get the cached value, and a background
+#  thread refreshes each field shortly before its TTL runs out.  Plugging
+#  or unplugging the charger invalidates the battery fields.
+#
+#  Methods not cached here are passed through to the PiSugar2 object, so
+#  a PiSugarCache can stand in for it.
+#
+#============================================================================
+
+from __future__ import annotations
+import time
+import threading
+from PiSugar2 import PiSugar2, PiSugarStatus
+
+
+#---------------------------------------------------------------------------
+#
+#  Cached fields: PiSugar2 getter and TTL in seconds (None = never expires)
+#
+#  The first five are also the fields of PiSugar2.get_status(); when
+#  several of them are due they are refreshed in one round trip.
+#
+#---------------------------------------------------------------------------
+CACHE_FIELDS = {
+  'battery'  : ('get_battery_percentage', 30.0),
+  'voltage'  : ('get_voltage', 10.0),
+  'amperage' : ('get_amperage', 5.0),
+  'charging' : ('get_charging_status', 5.0),
+  'plugged'  : ('get_battery_power_plugged', 2.0),
+  'model'    : ('get_model', None),
+}
+
+STATUS_FIELDS = ['battery', 'voltage', 'amperage', 'charging', 'plugged']
+
+# Fields that are stale once the charger is plugged or unplugged
+PLUG_FIELDS = ['battery', 'voltage', 'amperage', 'charging']
+
+
+#---------------------------------------------------------------------------
+#
+#  PiSugarCache
+#
+#---------------------------------------------------------------------------
+
+class PiSugarCache:
+
+    #------------------------------------------------
+    #
+    #  Constructor
+    #
+    #  pisugar  PiSugar2 object (created if None)
+    #  ttls     {field: seconds} overrides, or None
+    #  ahead    refresh when this fraction of the
+    #           TTL is used up
+    #
+    #------------------------------------------------
+    def __init__(self, pisugar: PiSugar2 = None, ttls: dict = None,
+                 ahead: float = 0.8, tick: float = 0.5):
+      self.pisugar = pisugar if pisugar is not None else PiSugar2()
+      ttls = ttls or {}
+      self.ttls = {f: ttls.get(f, ttl) for f, (_, ttl) in CACHE_FIELDS.items()}
+      self.ahead = ahead
+      self.tick = tick
+
+      self.mutex = threading.Lock()
+      self.values = {}
+      self.fetched = {}
+      self.hits = 0
+      self.misses = 0
+
+      self.thread = None
+      self.exit = True
+
+    #------------------------------------------------
+    #  Is a field missing or due for refresh
+    #------------------------------------------------
+    def _due(self, field: str, now: float, fraction: float = 1.0) -> bool:
+      if field not in self.values:
+        return True
+      ttl = self.ttls[field]
+      return ttl is not None and now - self.fetched[field] >= ttl * fraction
+
+    #------------------------------------------------
+    #  Store fresh values; a plug change invalidates
+    #  the battery fields that were not just read
+    #------------------------------------------------
+    def _store(self, values: dict):
+      now = time.monotonic()
+      self.mutex.acquire()
+      if 'plugged' in values and 'plugged' in self.values and \
+         values['plugged'] != self.values['plugged']:
+        for f in PLUG_FIELDS:
+          if f not in values:
+            self.values.pop(f, None)
+      for f, v in values.items():
+        if v is not None:
+          self.values[f] = v
+          self.fetched[f] = now
+      self.mutex.release()
+
+    #------------------------------------------------
+    #  Read fields from the PiSugar
+    #------------------------------------------------
+    def _fetch(self, fields: list):
+      status = [f for f in fields if f in STATUS_FIELDS]
+      if len(status) > 1:
+        snapshot = self.pisugar.get_status()
+        self._store({f: getattr(snapshot, f) for f in STATUS_FIELDS})
+        fields = [f for f in fields if f not in STATUS_FIELDS]
+      for f in fields:
+        self._store({f: getattr(self.pisugar, CACHE_FIELDS[f][0])()})
+
+    #------------------------------------------------
+    #  _fetch for readers: a PiSugar2 getter that
+    #  times out (IndexError/ValueError on an empty
+    #  reply) or a lost socket leaves the cached
+    #  values as they are
+    #------------------------------------------------
+    def _tryFetch(self, fields: list):
+      try:
+        self._fetch(fields)
+      except (OSError, IndexError, ValueError) as e:
+        print(f"PiSugar refresh failed: {e}")
+
+    #------------------------------------------------
+    #
+    #  Value of a field; fetched now only if it is
+    #  missing or expired.  If the fetch fails the
+    #  last cached value is returned (None if there
+    #  is none)
+    #
+    #------------------------------------------------
+    def get(self, field: str):
+      self.mutex.acquire()
+      fresh = not self._due(field, time.monotonic())
+      value = self.values.get(field)
+      if fresh:
+        self.hits = self.hits + 1
+      else:
+        self.misses = self.misses + 1
+      self.mutex.release()
+
+      if fresh:
+        return value
+
+      self._tryFetch([field])
+      self.mutex.acquire()
+      value = self.values.get(field)
+      self.mutex.release()
+      return value
+
+    #------------------------------------------------
+    #
+    #  Drop cached fields (all if none given), e.g.
+    #  after a power event; the next read fetches
+    #
+    #------------------------------------------------
+    def invalidate(self, *fields):
+      self.mutex.acquire()
+      for f in (fields or list(self.values)):
+        self.values.pop(f, None)
+      self.mutex.release()
+
+    #------------------------------------------------
+    #  Background refresh
+    #------------------------------------------------
+    def _refreshLoop(self):
+      while not self.exit:
+        now = time.monotonic()
+        self.mutex.acquire()
+        due = [f for f in CACHE_FIELDS if self._due(f, now, self.ahead)]
+        self.mutex.release()
+
+        if due:
+          self._tryFetch(due)
+        time.sleep(self.tick)
+
+    #------------------------------------------------
+    #  Start/stop the background refresh
+    #------------------------------------------------
+    def start(self):
+      self.exit = False
+      self.thread = threading.Thread(target=self._refreshLoop)
+      self.thread.setDaemon(True)
+      self.thread.start()
+
+    def stop(self):
+      self.exit = True
+      if self.thread is not None:
+        self.thread.join()
+        self.thread = None
+
+    #------------------------------------------------
+    #  Cached PiSugar2 getters
+    #------------------------------------------------
+    def get_battery_percentage(self) -> float:
+      return self.get('battery')
+
+    def get_voltage(self) -> float:
+      return self.get('voltage')
+
+    def get_amperage(self) -> float:
+      return self.get('amperage')
+
+    def get_charging_status(self) -> bool:
+      return self.get('charging')
+
+    def get_battery_power_plugged(self) -> bool:
+      return self.get('plugged')
+
+    def get_model(self) -> str:
+      return self.get('model')
+
+    def get_status(self) -> PiSugarStatus:
+      self.mutex.acquire()
+      now = time.monotonic()
+      due = [f for f in STATUS_FIELDS if self._due(f, now)]
+      if due:
+        self.misses = self.misses + 1
+      else:
+        self.hits = self.hits + 1
+      self.mutex.release()
+      if due:
+        self._tryFetch(due)
+      self.mutex.acquire()
+      values = [self.values.get(f) for f in STATUS_FIELDS]
+      self.mutex.release()
+      return PiSugarStatus(*values)
+
+    #------------------------------------------------
+    #  Everything else goes to the PiSugar2 object
+    #------------------------------------------------
+    def __getattr__(self, name):
+      return getattr(self.__dict__['pisugar'], name)
+
+    #------------------------------------------------
+    #  Reads served from memory vs from the socket
+    #------------------------------------------------
+    def stats(self) -> dict:
+      self.mutex.acquire()
+      stats = {'hits': self.hits, 'misses': self.misses}
+      self.mutex.release()
+      return stats
@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+#============================================================================
+#
+#  Local stand-in for pisugar-server
+#
+#  Speaks the pisugar-server text protocol on a TCP port ("get battery",
+#  "rtc_alarm_set ...", button pushes) from a scriptable state, so
+#  PiSugar2, the UI button loop and the vBeacon sleep/wake logic can be
+#  run and benchmarked without the hardware.
+#
+#  Usage:  ./PiSugarStub.py [--port 8423] [--latency ms] [--jitter ms]
+#                           [--buttons 1.0:single,2.5:long] [--battery 84.5]
+#                           [--drop-after n] [--silent p] [--split]
+#
+#============================================================================
+
+from __future__ import annotations
+import sys
+import time
+import random
+import argparse
+import threading
+import socketserver
+from datetime import datetime
+
+
+#---------------------------------------------------------------------------
+#
+#  Initial state, keyed like the replies ("battery: 84.5")
+#
+#---------------------------------------------------------------------------
+DEFAULT_STATE = {
+  'model'                     : 'PiSugar 2',
+  'battery'                   : 84.5,
+  'battery_v'                 : 4.015,
+  'battery_i'                 : 0.004,
+  'battery_charging'          : False,
+  'battery_power_plugged'     : False,
+  'battery_allow_charging'    : True,
+  'battery_led_amount'        : 2,
+  'rtc_alarm_enabled'         : False,
+  'rtc_alarm_time'            : '2020-01-01T00:00:00+00:00',
+  'rtc_alarm_flag'            : False,
+  'alarm_repeat'              : 0,
+  'safe_shutdown_level'       : 0.0,
+  'safe_shutdown_delay'       : 0.0,
+  'button_press'              : '',
+}
+
+
+#---------------------------------------------------------------------------
+#  One client connection
+#---------------------------------------------------------------------------
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+      stub = self.server.stub
+      stub._addClient(self.wfile)
+      try:
+        for raw in self.rfile:
+          line = raw.decode('utf-8').strip()
+          if not line:
+            continue
+          if not stub._respond(self.wfile, line):
+            break
+      except OSError:
+        pass
+      finally:
+        stub._removeClient(self.wfile)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+#---------------------------------------------------------------------------
+#
+#  PiSugarStub
+#
+#  state       reply values, change freely while running
+#  latency     seconds before each reply, plus up to 'jitter'
+#  faults      dropAfter  close a connection after n requests
+#              silent     probability of not answering a request
+#              split      send every reply in two writes
+#
+#  Actions are counted in 'actions' (e.g. actions['force_shutdown']) and
+#  the last alarm set is kept in state, so sleep/wake logic can be
+#  checked after the fact.
+#
+#---------------------------------------------------------------------------
+class PiSugarStub:
+
+    #------------------------------------------------
+    #  Constructor
+    #------------------------------------------------
+    def __init__(self, ip="127.0.0.1", port=8423, state: dict = {},
+                 latency: float = 0.0, jitter: float = 0.0, faults: dict = {}):
+      self.state = dict(DEFAULT_STATE, **state)
+      self.buttonEnable = {'single': True, 'double': True, 'long': True}
+      self.buttonShell = {'single': '', 'double': '', 'long': ''}
+      self.latency = latency
+      self.jitter = jitter
+      self.faults = dict(faults)
+
+      self.mutex = threading.Lock()
+      self.clients = []
+      self.requests = 0
+      self.actions = {}
+
+      self.server = _Server((ip, port), _Handler)
+      self.server.stub = self
+      self.port = self.server.server_address[1]
+      self.thread = None
+
+    #------------------------------------------------
+    #  Client bookkeeping (button pushes go to all)
+    #------------------------------------------------
+    def _addClient(self, wfile):
+      self.mutex.acquire()
+      self.clients.append([wfile, 0])
+      self.mutex.release()
+
+    def _removeClient(self, wfile):
+      self.mutex.acquire()
+      self.clients = [c for c in self.clients if c[0] is not wfile]
+      self.mutex.release()
+
+    def _send(self, wfile, text):
+      data = (text + "\n").encode('utf-8')
+      self.mutex.acquire()
+      try:
+        if self.faults.get('split') and len(data) > 1:
+          half = len(data) // 2
+          wfile.write(data[:half])
+          wfile.flush()
+          time.sleep(0.001)
+          wfile.write(data[half:])
+        else:
+          wfile.write(data)
+        wfile.flush()
+      finally:
+        self.mutex.release()
+
+    #------------------------------------------------
+    #  Format a state value the way the server does
+    #------------------------------------------------
+    def _format(self, value):
+      if isinstance(value, bool):
+        return "true" if value else "false"
+      return str(value)
+
+    #------------------------------------------------
+    #
+    #  Reply for one request line, None for no reply
+    #
+    #------------------------------------------------
+    def _reply(self, line):
+      words = line.split()
+      cmd = words[0]
+      args = words[1:]
+
+      if cmd == "get" and args:
+        key = args[0]
+        if key == "rtc_time":
+          return f"rtc_time: {datetime.now().astimezone().isoformat()}"
+        if key == "button_enable" and len(args) > 1:
+          return f"button_enable: {args[1]} {self._format(self.buttonEnable.get(args[1], False))}"
+        if key == "button_shell" and len(args) > 1:
+          return f"button_shell: {args[1]} {self.buttonShell.get(args[1], '')}"
+        if key in self.state:
+          return f"{key}: {self._format(self.state[key])}"
+        return "Invalid request."
+
+      self.actions[cmd] = self.actions.get(cmd, 0) + 1
+
+      if cmd == "rtc_alarm_set" and len(args) == 2:
+        self.state['rtc_alarm_time'] = args[0]
+        self.state['alarm_repeat'] = int(args[1])
+        self.state['rtc_alarm_enabled'] = True
+      elif cmd == "rtc_alarm_disable":
+        self.state['rtc_alarm_enabled'] = False
+      elif cmd == "set_button_enable" and len(args) == 2:
+        self.buttonEnable[args[0]] = args[1] == "1"
+      elif cmd == "set_button_shell" and args:
+        self.buttonShell[args[0]] = " ".join(args[1:])
+      elif cmd == "set_safe_shutdown_level" and args:
+        self.state['safe_shutdown_level'] = float(args[0])
+      elif cmd == "set_safe_shutdown_delay" and args:
+        self.state['safe_shutdown_delay'] = float(args[0])
+      elif cmd not in ("rtc_pi2rtc", "rtc_rtc2pi", "rtc_web",
+                       "rtc_test_wake", "force_shutdown"):
+        return "Invalid request."
+      return f"{cmd}: done"
+
+    #------------------------------------------------
+    #  Handle one request; False closes the client
+    #------------------------------------------------
+    def _respond(self, wfile, line):
+      self.mutex.acquire()
+      self.requests = self.requests + 1
+      client = next((c for c in self.clients if c[0] is wfile), None)
+      if client is not None:
+        client[1] = client[1] + 1
+        served = client[1]
+      else:
+        served = 0
+      self.mutex.release()
+
+      dropAfter = self.faults.get('dropAfter')
+      if dropAfter is not None and served > dropAfter:
+        return False
+      if random.random() < self.faults.get('silent', 0.0):
+        return True
+
+      delay = self.latency + random.uniform(0.0, self.jitter)
+      if delay > 0:
+        time.sleep(delay)
+
+      reply = self._reply(line)
+      if reply is not None:
+        self._send(wfile, reply)
+      return True
+
+    #------------------------------------------------
+    #
+    #  Push a button press ("single", "double" or
+    #  "long") to every client, as the server does
+    #
+    #------------------------------------------------
+    def press(self, press: str):
+      if not self.buttonEnable.get(press, False):
+        return
+      self.state['button_press'] = press
+      self.mutex.acquire()
+      clients = [c[0] for c in self.clients]
+      self.mutex.release()
+      for wfile in clients:
+        try:
+          self._send(wfile, press)
+        except OSError:
+          pass
+
+    #------------------------------------------------
+    #  Play [(delay seconds, press), ...] in the
+    #  background, delays relative to the previous
+    #------------------------------------------------
+    def playButtons(self, script: list):
+      def play():
+        for delay, press in script:
+          time.sleep(delay)
+          self.press(press)
+      t = threading.Thread(target=play)
+      t.setDaemon(True)
+      t.start()
+      return t
+
+    #------------------------------------------------
+    #  Start/stop serving
+    #------------------------------------------------
+    def start(self):
+      self.thread = threading.Thread(target=self.server.serve_forever)
+      self.thread.setDaemon(True)
+      self.thread.start()
+      return self
+
+    def stop(self):
+      self.server.shutdown()
+      self.server.server_close()
+      if self.thread is not None:
+        self.thread.join()
+        self.thread = None
+
+
+#------------------------------------------------
+#  Parse "1.0:single,2.5:long"
+#------------------------------------------------
+def _parseButtons(text):
+  script = []
+  for item in text.split(','):
+    delay, press = item.split(':')
+    script.append((float(delay), press))
+  return script
+
+
+#------------------------------------------------
+#  Main
+#------------------------------------------------
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=8423)
+  parser.add_argument('--latency', type=float, default=0.0, help="ms per reply")
+  parser.add_argument('--jitter', type=float, default=0.0, help="ms of extra random delay")
+  parser.add_argument('--buttons', default=None, help="e.g. 1.0:single,2.5:long")
+  parser.add_argument('--battery', type=float, default=DEFAULT_STATE['battery'])
+  parser.add_argument('--drop-after', type=int, default=None)
+  parser.add_argument('--silent', type=float, default=0.0)
+  parser.add_argument('--split', action='store_true')
+  args = parser.parse_args(argv)
+
+  faults = {'dropAfter': args.drop_after, 'silent': args.silent, 'split': args.split}
+  stub = PiSugarStub(port=args.port, state={'battery': args.battery},
+                     latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                     faults=faults).start()
+  print(f"PiSugar stand-in on port {stub.port}")
+  if args.buttons:
+    stub.playButtons(_parseButtons(args.buttons))
+
+  try:
+    while True:
+      time.sleep(1.0)
+  except KeyboardInterrupt:
+    pass
+  stub.stop()
+  print(f"requests={stub.requests} actions={stub.actions}")
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
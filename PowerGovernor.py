@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  PowerGovernor.py
+#
+#  Pick a power tier from the PiSugar battery level and charging state.
+#  A tier sets how hard the tracker works: radio plan, advertising
+#  interval, on/wake times, check period, display refresh and buzzer.
+#
+#  Author: E-Motion Inc
+#
+#  Copyright (c) 2020, E-Motion, Inc.  All Rights Researcved
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#=============================================================================
+
+
+#-----------------------------------------------------------------------------
+#
+#  Power tiers, highest first
+#
+#  minBattery      percent needed to stay in the tier
+#  radioPlan       RadioScheduler plan
+#  advertInterval  ms
+#  onTime/wakeTime s, None keeps the settings values
+#  checkPeriod     s between social distance checks
+#  refresh         s minimum between e-paper refreshes (0 = no limit)
+#  buzzer          alerts sound
+#  current         average draw while on in mA, for the runtime projection
+#
+#-----------------------------------------------------------------------------
+POWER_TIERS = [
+  {'name': 'full',     'minBattery': 50.0, 'radioPlan': 'continuous',
+   'advertInterval': 100.0,  'onTime': None,   'wakeTime': None,
+   'checkPeriod': 1,  'refresh': 0.0,  'buzzer': True,  'current': 180.0},
+  {'name': 'saver',    'minBattery': 25.0, 'radioPlan': 'interleaved',
+   'advertInterval': 300.0,  'onTime': 1800.0, 'wakeTime': 3600.0,
+   'checkPeriod': 2,  'refresh': 1.0,  'buzzer': True,  'current': 140.0},
+  {'name': 'low',      'minBattery': 10.0, 'radioPlan': 'lowpower',
+   'advertInterval': 1000.0, 'onTime': 600.0,  'wakeTime': 3600.0,
+   'checkPeriod': 5,  'refresh': 5.0,  'buzzer': False, 'current': 110.0},
+  {'name': 'critical', 'minBattery': 0.0,  'radioPlan': 'lowpower',
+   'advertInterval': 1000.0, 'onTime': 60.0,   'wakeTime': 7200.0,
+   'checkPeriod': 10, 'refresh': 30.0, 'buzzer': False, 'current': 100.0},
+]
+
+
+#-----------------------------------------------------------------------------
+#
+#  PowerGovernor
+#
+#  update() takes a PiSugarStatus and returns the tier.  A lower tier is
+#  entered as soon as the battery drops below its threshold; a higher one
+#  only once the battery is 'hysteresis' percent above that tier's
+#  threshold, so a level hovering at a threshold does not flip tiers.
+#  With the charger plugged in the highest tier is used.
+#
+#-----------------------------------------------------------------------------
+class PowerGovernor:
+
+  #----------------------------------------------
+  #  Constructor
+  #
+  #  capacity  battery capacity in mAh
+  #  onTime/wakeTime  the settings values, used
+  #            where a tier does not set them
+  #----------------------------------------------
+  def __init__(self, capacity=1200.0, onTime=3000.0, wakeTime=3000.0,
+               tiers=POWER_TIERS, hysteresis=5.0):
+    self.capacity = capacity
+    self.onTime = onTime
+    self.wakeTime = wakeTime
+    self.tiers = tiers
+    self.hysteresis = hysteresis
+    self.index = 0
+    self.listeners = []
+
+  #----------------------------------------------
+  #  Call listener(tier) on every tier change
+  #----------------------------------------------
+  def addListener(self, listener):
+    self.listeners.append(listener)
+
+  #----------------------------------------------
+  #  On and wake time of a tier
+  #----------------------------------------------
+  def times(self, tier):
+    onTime = tier['onTime'] if tier['onTime'] is not None else self.onTime
+    wakeTime = tier['wakeTime'] if tier['wakeTime'] is not None else self.wakeTime
+    return onTime, wakeTime
+
+  #----------------------------------------------
+  #  Hours left at 'battery' percent if the
+  #  device stayed in 'tier'; asleep it draws
+  #  nothing (the PiSugar cuts power)
+  #----------------------------------------------
+  def projectedRuntime(self, tier, battery):
+    onTime, wakeTime = self.times(tier)
+    duty = onTime / max(onTime, wakeTime)
+    return self.capacity * battery / 100.0 / (tier['current'] * duty)
+
+  #----------------------------------------------
+  #  Pick the tier for a PiSugarStatus
+  #----------------------------------------------
+  def update(self, status):
+    battery = status.battery
+    if battery is None:
+      return self.tiers[self.index]
+
+    if status.charging or status.plugged:
+      index = 0
+    else:
+      index = self.index
+      # Down as soon as the level is below the threshold
+      while index < len(self.tiers) - 1 and battery < self.tiers[index]['minBattery']:
+        index = index + 1
+      # Up only with margin
+      while index > 0 and battery >= self.tiers[index - 1]['minBattery'] + self.hysteresis:
+        index = index - 1
+
+    tier = self.tiers[index]
+    projection = ", ".join(f"{t['name']} {self.projectedRuntime(t, battery):.1f}h"
+                           for t in self.tiers)
+    print(f"Battery {battery:.1f}% tier {tier['name']}, runtime {projection}")
+
+    if index != self.index:
+      print(f"Power tier {self.tiers[self.index]['name']} -> {tier['name']}")
+      self.index = index
+      for listener in self.listeners:
+        listener(tier)
+    return tier
+
+  #----------------------------------------------
+  #  Continue in a saved tier (e.g. across a
+  #  sleep cycle) so hysteresis carries over.
+  #  Unknown names are ignored.
+  #----------------------------------------------
+  def restore(self, name):
+    for index, tier in enumerate(self.tiers):
+      if tier['name'] == name and index != self.index:
+        print(f"Power tier {self.tiers[self.index]['name']} -> {name} (restored)")
+        self.index = index
+        for listener in self.listeners:
+          listener(tier)
+    return self.tiers[self.index]
+
+  #----------------------------------------------
+  #  Current tier
+  #----------------------------------------------
+  def tier(self):
+    return self.tiers[self.index]
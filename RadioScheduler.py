@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  RadioScheduler.py
+#
+#  Duty-cycle the radio inside an on-period: repeat a plan of scan,
+#  advertise, both and off windows, and count how long scanning and
+#  advertising were really on
+#
+#  Author: E-Motion Inc
+#
+#  Copyright (c) 2020, E-Motion, Inc.  All Rights Researcved
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#=============================================================================
+import time
+import threading
+
+
+#-----------------------------------------------------------------------------
+#
+#  Radio plans - windows repeated for the whole on-period
+#
+#  mode  'scan', 'advertise', 'both' or 'off'
+#  ms    window length
+#
+#  A plan can also be given directly in the 'radioPlan' setting as a list
+#  of windows.
+#
+#-----------------------------------------------------------------------------
+RADIO_PLANS = {
+  'continuous'  : [{'mode': 'both', 'ms': 1000}],
+  'interleaved' : [{'mode': 'scan', 'ms': 800}, {'mode': 'advertise', 'ms': 200}],
+  'lowpower'    : [{'mode': 'both', 'ms': 500}, {'mode': 'off', 'ms': 1500}],
+}
+
+RADIO_MODES = {
+  'scan'      : (True,  False),
+  'advertise' : (False, True),
+  'both'      : (True,  True),
+  'off'       : (False, False),
+}
+
+
+#-----------------------------------------------------------------------------
+#
+#  RadioScheduler
+#
+#  Calls startScan/stopScan and startAdvert/stopAdvert only when a window
+#  changes what is on.  Counters are in seconds.
+#
+#-----------------------------------------------------------------------------
+class RadioScheduler:
+
+  #----------------------------------------------
+  #  Constructor
+  #
+  #  plan is a RADIO_PLANS name or a list of windows
+  #----------------------------------------------
+  def __init__(self, plan, startScan, stopScan, startAdvert, stopAdvert):
+    self.plan = self._checkPlan(plan)
+    self.startScan = startScan
+    self.stopScan = stopScan
+    self.startAdvert = startAdvert
+    self.stopAdvert = stopAdvert
+
+    self.mutex = threading.Lock()
+    self.wakeup = threading.Event()
+    self.thread = None
+    self.exit = True
+
+    self.scanning = False
+    self.advertising = False
+    self.scanSince = 0.0
+    self.advertSince = 0.0
+    self.started = 0.0
+    self.scanOn = 0.0
+    self.advertOn = 0.0
+    self.windows = 0
+    self.cycles = 0
+
+  #----------------------------------------------
+  #  Resolve a plan name and check its windows
+  #----------------------------------------------
+  def _checkPlan(self, plan):
+    if isinstance(plan, str):
+      plan = RADIO_PLANS[plan]
+    for window in plan:
+      if window['mode'] not in RADIO_MODES or window['ms'] <= 0:
+        raise ValueError(f"bad radio window {window}")
+    return plan
+
+  #----------------------------------------------
+  #  Switch to another plan at the end of the
+  #  current cycle
+  #----------------------------------------------
+  def setPlan(self, plan):
+    self.plan = self._checkPlan(plan)
+
+  #----------------------------------------------
+  #  Switch scan/advertise to what 'mode' wants
+  #----------------------------------------------
+  def _apply(self, mode):
+    scan, advert = RADIO_MODES[mode]
+    now = time.monotonic()
+
+    if scan != self.scanning:
+      if scan:
+        self.startScan()
+      else:
+        self.stopScan()
+      self.mutex.acquire()
+      if scan:
+        self.scanSince = now
+      else:
+        self.scanOn = self.scanOn + now - self.scanSince
+      self.scanning = scan
+      self.mutex.release()
+
+    if advert != self.advertising:
+      if advert:
+        self.startAdvert()
+      else:
+        self.stopAdvert()
+      self.mutex.acquire()
+      if advert:
+        self.advertSince = now
+      else:
+        self.advertOn = self.advertOn + now - self.advertSince
+      self.advertising = advert
+      self.mutex.release()
+
+  #----------------------------------------------
+  #  Scheduler thread
+  #----------------------------------------------
+  def _run(self):
+    while not self.exit:
+      for window in self.plan:
+        if self.exit:
+          break
+        self._apply(window['mode'])
+        self.windows = self.windows + 1
+        self.wakeup.wait(window['ms'] / 1000.0)
+      else:
+        self.cycles = self.cycles + 1
+
+    self._apply('off')
+
+  #----------------------------------------------
+  #  Start running the plan
+  #----------------------------------------------
+  def start(self):
+    self.exit = False
+    self.wakeup.clear()
+    self.started = time.monotonic()
+    self.thread = threading.Thread(target=self._run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  #----------------------------------------------
+  #  Stop, leaving scan and advertise off
+  #----------------------------------------------
+  def stop(self):
+    self.exit = True
+    self.wakeup.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+
+  #----------------------------------------------
+  #  Radio-on counters, including the window
+  #  that is currently open
+  #----------------------------------------------
+  def stats(self):
+    now = time.monotonic()
+    self.mutex.acquire()
+    scanOn = self.scanOn + (now - self.scanSince if self.scanning else 0.0)
+    advertOn = self.advertOn + (now - self.advertSince if self.advertising else 0.0)
+    self.mutex.release()
+
+    elapsed = now - self.started if self.started else 0.0
+    return {'elapsed': round(elapsed, 3),
+            'scanOn': round(scanOn, 3),
+            'advertOn': round(advertOn, 3),
+            'scanDuty': round(scanOn / elapsed, 3) if elapsed else 0.0,
+            'advertDuty': round(advertOn / elapsed, 3) if elapsed else 0.0,
+            'windows': self.windows,
+            'cycles': self.cycles}
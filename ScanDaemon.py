@@ -0,0 +1,456 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  ScanDaemon.py
+#
+#  Long running scanner that owns the HCI adapters and serves sightings to
+#  any number of local subscribers over a Unix domain socket.
+#
+#  Author: E-Motion Inc
+#
+#  Copyright (c) 2020, E-Motion, Inc.  All Rights Researcved
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#=============================================================================
+#
+#  Protocol
+#
+#  Subscriber -> daemon: one filter expression per line (utf-8).  Sending
+#  a new line replaces the previous filter.  An empty line matches all.
+#
+#      uuid=2f234454-cf6d-4a0f-adf2-f4911ba9ffa6;major=100-199;rssi>=-70
+#
+#    terms:  type=<name>  uuid=<uuid>  mac=<address>
+#            major=<n>|<lo>-<hi>  minor=<n>|<lo>-<hi>  rssi>=<dBm>
+#
+#  Daemon -> subscriber: frames of
+#
+#      length  H   (little endian, size of kind + payload)
+#      kind    B   FRAME_SIGHTING, FRAME_ACK or FRAME_ERROR
+#      payload     SightingRing record (48 bytes) or utf-8 text
+#
+#  Filters are evaluated in the daemon, so a subscriber only receives
+#  (and wakes up for) the sightings it asked for.
+#
+#=============================================================================
+import os
+import sys
+import time
+import struct
+import socket
+import argparse
+import selectors
+import threading
+import SightingRing
+
+
+DEFAULT_SOCKET_PATH = "/tmp/vbeacon-scan.sock"
+
+FRAME          = struct.Struct("<HB")
+FRAME_SIGHTING = 0
+FRAME_ACK      = 1
+FRAME_ERROR    = 2
+
+
+#-----------------------------------------------------------------------------
+#
+#  ScanFilter - parsed subscriber filter expression
+#
+#-----------------------------------------------------------------------------
+class ScanFilter:
+
+  #----------------------------------------------
+  #  Constructor - raises ValueError on a bad
+  #  expression
+  #----------------------------------------------
+  def __init__(self, expr=""):
+    self.expr = expr.strip()
+    self.type = None
+    self.uuid = None
+    self.mac = None
+    self.major = None
+    self.minor = None
+    self.rssi = None
+
+    for term in self.expr.replace(' ', '').split(';'):
+      if not term:
+        continue
+      if term.startswith('rssi>='):
+        self.rssi = int(term[6:])
+        continue
+
+      key, sep, value = term.partition('=')
+      if not sep:
+        raise ValueError(f"bad filter term '{term}'")
+
+      if key == 'type':
+        self.type = value
+      elif key == 'uuid':
+        self.uuid = value.lower().strip('{}')
+      elif key == 'mac':
+        self.mac = value.lower()
+      elif key in ('major', 'minor'):
+        lo, _, hi = value.partition('-')
+        setattr(self, key, (int(lo), int(hi or lo)))
+      else:
+        raise ValueError(f"unknown filter key '{key}'")
+
+  #----------------------------------------------
+  #  Returns True if the beacon passes the filter
+  #----------------------------------------------
+  def match(self, beacon):
+    if self.type is not None and beacon['type'] != self.type:
+      return False
+    if self.uuid is not None and beacon.get('uuid') != self.uuid:
+      return False
+    if self.mac is not None and beacon.get('macAddress') != self.mac:
+      return False
+    if self.rssi is not None and beacon.get('rssi', -128) < self.rssi:
+      return False
+    if self.major is not None:
+      if not (self.major[0] <= beacon.get('major', -1) <= self.major[1]):
+        return False
+    if self.minor is not None:
+      if not (self.minor[0] <= beacon.get('minor', -1) <= self.minor[1]):
+        return False
+    return True
+
+
+#-----------------------------------------------------------------------------
+#  Build one frame
+#-----------------------------------------------------------------------------
+def _frame(kind, payload):
+  return FRAME.pack(len(payload) + 1, kind) + payload
+
+
+#-----------------------------------------------------------------------------
+#
+#  Subscriber - one connected client
+#
+#-----------------------------------------------------------------------------
+class Subscriber:
+
+  def __init__(self, conn):
+    self.conn = conn
+    self.fd = conn.fileno()
+    self.filter = ScanFilter()
+    self.pending = b''
+    self.sent = 0
+    self.mutex = threading.Lock()
+
+  #----------------------------------------------
+  #  Send a frame; returns False if the client
+  #  is gone or too slow to keep up
+  #----------------------------------------------
+  def send(self, data):
+    self.mutex.acquire()
+    try:
+      self.conn.sendall(data)
+      self.sent = self.sent + 1
+      return True
+    except (socket.timeout, OSError):
+      return False
+    finally:
+      self.mutex.release()
+
+
+#-----------------------------------------------------------------------------
+#
+#  ScanDaemon
+#
+#-----------------------------------------------------------------------------
+class ScanDaemon:
+
+  #----------------------------------------------
+  #  Constructor
+  #
+  #  adapters = MultiScanner adapter configs
+  #  ringName = also publish into a SightingRing
+  #----------------------------------------------
+  def __init__(self, path=DEFAULT_SOCKET_PATH, adapters=None, ringName=None):
+    # Imported here so ScanClient users do not need pybluez
+    from MultiScanner import MultiScanner, DEFAULT_ADAPTERS
+
+    self.path = path
+    self.scanner = MultiScanner(adapters or DEFAULT_ADAPTERS, callback=self._onSighting)
+    self.ring = SightingRing.SightingRing(ringName) if ringName else None
+
+    self.selector = selectors.DefaultSelector()
+    self.server = None
+    self.subscribers = {}
+    self.mutex = threading.Lock()
+    self.thread = None
+    self.exitLoop = True
+
+  #----------------------------------------------
+  #  Scanner callback - fan the sighting out
+  #  to every subscriber whose filter matches
+  #----------------------------------------------
+  def _onSighting(self, beacon):
+    if self.ring is not None:
+      self.ring.publish(beacon)
+
+    self.mutex.acquire()
+    subscribers = list(self.subscribers.values())
+    self.mutex.release()
+
+    data = None
+    for sub in subscribers:
+      if not sub.filter.match(beacon):
+        continue
+      if data is None:
+        data = _frame(FRAME_SIGHTING, SightingRing.packSighting(beacon))
+      if not sub.send(data):
+        self._drop(sub)
+
+  #----------------------------------------------
+  #  Forget a subscriber
+  #----------------------------------------------
+  def _drop(self, sub):
+    self.mutex.acquire()
+    known = self.subscribers.pop(sub.fd, None)
+    self.mutex.release()
+    if known is not None:
+      try:
+        self.selector.unregister(sub.conn)
+      except (KeyError, ValueError):
+        pass
+      sub.conn.close()
+
+  #----------------------------------------------
+  #  New connection
+  #----------------------------------------------
+  def _accept(self):
+    conn, _ = self.server.accept()
+    # A subscriber that stops reading must not stall the scanner
+    conn.settimeout(0.1)
+    sub = Subscriber(conn)
+    self.mutex.acquire()
+    self.subscribers[sub.fd] = sub
+    self.mutex.release()
+    self.selector.register(conn, selectors.EVENT_READ, sub)
+
+  #----------------------------------------------
+  #  Filter line(s) from a subscriber
+  #----------------------------------------------
+  def _read(self, sub):
+    try:
+      data = sub.conn.recv(1024)
+    except (socket.timeout, OSError):
+      data = b''
+    if not data:
+      self._drop(sub)
+      return
+
+    sub.pending = sub.pending + data
+    while b'\n' in sub.pending:
+      line, sub.pending = sub.pending.split(b'\n', 1)
+      try:
+        sub.filter = ScanFilter(line.decode('utf-8'))
+        reply = _frame(FRAME_ACK, line)
+      except (ValueError, UnicodeDecodeError) as e:
+        reply = _frame(FRAME_ERROR, str(e).encode('utf-8'))
+      if not sub.send(reply):
+        self._drop(sub)
+        return
+
+  #----------------------------------------------
+  #  Socket loop
+  #----------------------------------------------
+  def _serveLoop(self):
+    while not self.exitLoop:
+      for key, _ in self.selector.select(timeout=0.5):
+        if key.data is None:
+          self._accept()
+        else:
+          self._read(key.data)
+
+  #----------------------------------------------
+  #  Start serving and scanning
+  #----------------------------------------------
+  def start(self):
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+    self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.server.bind(self.path)
+    self.server.listen(8)
+    self.selector.register(self.server, selectors.EVENT_READ, None)
+
+    self.exitLoop = False
+    self.thread = threading.Thread(target=self._serveLoop)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+    self.scanner.start()
+
+  #----------------------------------------------
+  #  Stop scanning and close all connections
+  #----------------------------------------------
+  def stop(self):
+    self.scanner.stop()
+
+    self.exitLoop = True
+    self.thread.join()
+    for sub in list(self.subscribers.values()):
+      self._drop(sub)
+    self.selector.unregister(self.server)
+    self.server.close()
+    os.unlink(self.path)
+
+    if self.ring is not None:
+      self.ring.close()
+
+
+#-----------------------------------------------------------------------------
+#
+#  ScanClient - subscribe to a running ScanDaemon
+#
+#  Same start()/stop()/callback surface as MultiScanner so callers can use
+#  either one.
+#
+#-----------------------------------------------------------------------------
+class ScanClient:
+
+  #----------------------------------------------
+  #  Constructor
+  #----------------------------------------------
+  def __init__(self, filter="", callback=None, path=DEFAULT_SOCKET_PATH):
+    self.path = path
+    self.filter = filter
+    self.callback = callback
+    self.sock = None
+    self.buffer = b''
+    self.received = 0
+    self.thread = None
+    self.exitLoop = True
+
+  #----------------------------------------------
+  #  Connect and send the filter
+  #----------------------------------------------
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self.path)
+    self.setFilter(self.filter)
+
+  #----------------------------------------------
+  #  Replace the filter on the daemon side
+  #----------------------------------------------
+  def setFilter(self, filter):
+    self.filter = filter
+    self.sock.sendall(filter.encode('utf-8') + b'\n')
+
+  #----------------------------------------------
+  #  Read the next frame, returns (kind, payload)
+  #  or None if the daemon went away
+  #----------------------------------------------
+  def readFrame(self):
+    while True:
+      if len(self.buffer) >= FRAME.size:
+        length, kind = FRAME.unpack_from(self.buffer)
+        end = 2 + length
+        if len(self.buffer) >= end:
+          payload = self.buffer[FRAME.size:end]
+          self.buffer = self.buffer[end:]
+          return (kind, payload)
+
+      try:
+        data = self.sock.recv(4096)
+      except socket.timeout:
+        if self.exitLoop:
+          return None
+        continue
+      if not data:
+        return None
+      self.buffer = self.buffer + data
+
+  #----------------------------------------------
+  #  Return the next matching sighting or None
+  #----------------------------------------------
+  def next(self):
+    while True:
+      frame = self.readFrame()
+      if frame is None:
+        return None
+      kind, payload = frame
+      if kind == FRAME_SIGHTING:
+        self.received = self.received + 1
+        return SightingRing.unpackSighting(payload)
+      elif kind == FRAME_ERROR:
+        print(f"ScanDaemon rejected filter '{self.filter}': {payload.decode('utf-8')}")
+
+  #----------------------------------------------
+  #  Receive loop
+  #----------------------------------------------
+  def _recvLoop(self):
+    while not self.exitLoop:
+      beacon = self.next()
+      if beacon is None:
+        break
+      if self.callback is not None:
+        self.callback(beacon)
+
+  #----------------------------------------------
+  #  Connect and start delivering to callback
+  #----------------------------------------------
+  def start(self):
+    self.connect()
+    self.sock.settimeout(0.5)
+    self.exitLoop = False
+    self.thread = threading.Thread(target=self._recvLoop)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  #----------------------------------------------
+  #  Stop and disconnect
+  #----------------------------------------------
+  def stop(self):
+    self.exitLoop = True
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    self.sock.close()
+
+  #----------------------------------------------
+  #  Counters
+  #----------------------------------------------
+  def stats(self):
+    return {'received': self.received}
+
+
+#-----------------------------------------------------------------------------
+#  main()
+#-----------------------------------------------------------------------------
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('dev_ids', nargs='*', type=int, default=[0],
+                      help="bluetooth devices to scan on (default: 0)")
+  parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                      help="unix socket path (default: " + DEFAULT_SOCKET_PATH + ")")
+  parser.add_argument('--ring', nargs='?', const=SightingRing.DEFAULT_RING_NAME,
+                      default=None, help="also publish into a shared memory ring")
+  args = parser.parse_args(argv)
+
+  adapters = [{'devId': d, 'phase': i / len(args.dev_ids)}
+              for i, d in enumerate(args.dev_ids)]
+  daemon = ScanDaemon(args.socket, adapters, args.ring)
+  daemon.start()
+  print(f"Serving sightings on {args.socket}")
+
+  try:
+    while True:
+      time.sleep(1.0)
+  except KeyboardInterrupt:
+    pass
+
+  daemon.stop()
+  print(daemon.scanner.stats())
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
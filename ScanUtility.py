@@ -30,14 +30,27 @@
 #==============================================================
 
 
+import os
 import sys
+import time
+import socket
 import struct
+import functools
 import bluetooth._bluetooth as bluez
 import codecs 
 
 OGF_LE_CTL=0x08
+OCF_LE_SET_SCAN_PARAMETERS=0x000B
 OCF_LE_SET_SCAN_ENABLE=0x000C
 
+# Scan interval/window are in units of 0.625 ms
+SCAN_TIME_UNIT_MS=0.625
+
+# Kernel receive timestamps (linux/include/net/bluetooth/hci_sock.h)
+SOL_HCI=0
+HCI_TIME_STAMP=3
+HCI_CMSG_TSTAMP=0x0002
+
 def hci_enable_le_scan(sock):
     hci_toggle_le_scan(sock, 0x01)
 
@@ -48,6 +61,17 @@ def hci_toggle_le_scan(sock, enable):
     cmd_pkt = struct.pack("<BB", enable, 0x00)
     bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
 
+def hci_le_set_scan_parameters(sock, interval_ms=100.0, window_ms=100.0, active=False):
+    """
+    Sets LE scan interval/window (in ms) and passive/active scanning.
+    Must be called while scanning is disabled.
+    """
+    interval = max(0x0004, min(0x4000, int(interval_ms / SCAN_TIME_UNIT_MS)))
+    window = max(0x0004, min(interval, int(window_ms / SCAN_TIME_UNIT_MS)))
+    scan_type = 0x01 if active else 0x00
+    cmd_pkt = struct.pack("<BHHBB", scan_type, interval, window, 0x00, 0x00)
+    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_PARAMETERS, cmd_pkt)
+
 def packetToString(packet):
     """
     Returns the string representation of a raw HCI packet.
@@ -57,7 +81,162 @@ def packetToString(packet):
     else:
         return ''.join('%02x' % struct.unpack("B", x)[0] for x in packet)
 
-def parse_events(sock, loop_count=100):
+#==============================================================
+#
+#  Decode plans
+#
+#  The bytes from the AD data length up to the Eddystone frame
+#  type (packet[13:26]) hold the AD layout, company ID and beacon
+#  type.  They form the 'signature' of a frame; the plan for a
+#  signature is worked out once and cached (LRU, so random junk
+#  can not grow the cache), after which decoding a packet is a
+#  lookup plus one precompiled Struct.unpack_from.
+#
+#==============================================================
+SIGNATURE_START=13
+SIGNATURE_END=26
+DECODE_CACHE_SIZE=256
+
+#  ptype, event, plen, (subevent, reports, evt type, addr type), mac
+_HEADER=">BBB4x6s"
+# iBeacon measured power is a signed byte (dBm at 1 m).  Before the decode
+# plans it was read as int(hex) - 256, which is the same for 0x80-0xff but
+# gave -256..-129 instead of 0..127 for 0x00-0x7f.
+IBEACON_LAYOUT=struct.Struct(_HEADER + "10x16sHHb")
+EDDYSTONE_UID_LAYOUT=struct.Struct(_HEADER + "14x10s6s")
+EDDYSTONE_URL_LAYOUT=struct.Struct(_HEADER + "14xB")
+EDDYSTONE_LAYOUT=struct.Struct(_HEADER)
+
+EDDYSTONE_TYPES={0x20: "Eddystone TLM",
+                 0x30: "Eddystone EID",
+                 0x40: "Eddystone RESERVED"}
+
+URL_PREFIXES=['http://www.', 'https://www.', 'http://', 'https://']
+
+def _mac(raw):
+    """
+    Returns the display form of a little endian 6 byte address
+    """
+    return raw[::-1].hex(':')
+
+def _rssi(packet):
+    rssi = packet[-1]
+    return rssi - 256 if rssi > 127 else rssi
+
+def _decode_ibeacon(packet):
+    ptype, event, plen, mac, uuid, major, minor, txPower = \
+        IBEACON_LAYOUT.unpack_from(packet)
+    h = uuid.hex()
+    return {"type": "iBeacon", "ptype" : ptype, "event": event, "plen" : plen,
+            "uuid": h[0:8] + "-" + h[8:12] + "-" + h[12:16] + "-" + h[16:20] + "-" + h[20:32],
+            "major": major,
+            "minor": minor,
+            "rssi": _rssi(packet),
+            "txPower": txPower,
+            "macAddress": _mac(mac),
+            "dataString" : packet[0:48].hex()}
+
+def _decode_eddystone_uid(packet):
+    ptype, event, plen, mac, namespace, instance = \
+        EDDYSTONE_UID_LAYOUT.unpack_from(packet)
+    return {"type": "Eddystone UID",
+            "namespace": namespace.hex().upper(),
+            "instance": instance.hex().upper(),
+            "rssi": _rssi(packet),
+            "macAddress": _mac(mac)}
+
+def _decode_eddystone_url(packet):
+    ptype, event, plen, mac, prefix = EDDYSTONE_URL_LAYOUT.unpack_from(packet)
+    if prefix < len(URL_PREFIXES):
+        prefix = URL_PREFIXES[prefix]
+    else:
+        prefix = ''
+    url = prefix + bytes(packet[EDDYSTONE_URL_LAYOUT.size:-1]).decode(errors='replace')
+    return {"type": "Eddystone URL", "url": url,
+            "rssi": _rssi(packet),
+            "macAddress": _mac(mac)}
+
+def _eddystone_decoder(type):
+    def _decode_eddystone(packet):
+        ptype, event, plen, mac = EDDYSTONE_LAYOUT.unpack_from(packet)
+        return {"type": type,
+                "rssi": _rssi(packet),
+                "macAddress": _mac(mac)}
+    return _decode_eddystone
+
+@functools.lru_cache(maxsize=DECODE_CACHE_SIZE)
+def decode_plan(signature):
+    """
+    Returns the decoder for a frame signature, or None if the
+    frame is not a beacon we know.
+    """
+    if signature[6:10] == b'\x4c\x00\x02\x15':
+        return _decode_ibeacon
+
+    if signature[4:8] == b'\x03\x03\xaa\xfe' and signature[9:12] == b'\x16\xaa\xfe':
+        frame = signature[12]
+        if frame == 0x00:
+            return _decode_eddystone_uid
+        elif frame == 0x10:
+            return _decode_eddystone_url
+        elif frame in EDDYSTONE_TYPES:
+            return _eddystone_decoder(EDDYSTONE_TYPES[frame])
+
+    return None
+
+def decode_packet(packet):
+    """
+    Decodes one raw HCI LE advertising report.  Returns the beacon
+    dict or None if the packet is not a beacon.
+    """
+    decoder = decode_plan(bytes(packet[SIGNATURE_START:SIGNATURE_END]))
+    if decoder is None:
+        return None
+    try:
+        return decoder(packet)
+    except struct.error:
+        # Truncated packet
+        return None
+
+def open_timestamped(sock):
+    """
+    Returns a socket sharing the HCI socket's file that delivers the
+    kernel receive timestamp of every packet, or None if this python
+    or kernel can not do it.  pybluez sockets have no recvmsg().
+    """
+    tsock = None
+    try:
+        tsock = socket.socket(fileno=os.dup(sock.fileno()))
+        tsock.setsockopt(SOL_HCI, HCI_TIME_STAMP, 1)
+        return tsock
+    except (OSError, ValueError):
+        if tsock is not None:
+            tsock.close()
+        return None
+
+def recv_timestamped(tsock, bufsize=255):
+    """
+    Receives one packet, returns (packet, monotonic ns it arrived at).
+    The kernel stamps packets with the wall clock, which is moved onto
+    the monotonic clock so it can be compared across processes and
+    does not jump with NTP or RTC updates.
+    """
+    packet, ancdata, flags, addr = tsock.recvmsg(bufsize, socket.CMSG_SPACE(16))
+    for level, type, data in ancdata:
+        if level == SOL_HCI and type == HCI_CMSG_TSTAMP:
+            # struct timeval, 32 or 64 bit depending on the ABI
+            fmt = "=qq" if len(data) >= 16 else "=ll"
+            sec, usec = struct.unpack_from(fmt, data)
+            offset = time.time_ns() - time.monotonic_ns()
+            return packet, sec * 1000000000 + usec * 1000 - offset
+    return packet, time.monotonic_ns()
+
+def parse_events(sock, loop_count=100, tsock=None):
+    """
+    Returns a list with the first beacon found in up to loop_count
+    packets.  Every beacon gets a 'timestamp' (monotonic ns); with a
+    tsock from open_timestamped() it is the kernel receive time.
+    """
     old_filter = sock.getsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, 14)
     flt = bluez.hci_filter_new()
     bluez.hci_filter_all_events(flt)
@@ -65,111 +244,15 @@ def parse_events(sock, loop_count=100):
     sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, flt )
     results = []
     for i in range(0, loop_count):
-        packet = sock.recv(255)
-        ptype, event, plen = struct.unpack("BBB", packet[:3])
-        packetOffset = 0
-        dataString = packetToString(packet)
-        """
-        If the bluetooth device is an beacon then show the beacon.
-        """
-        #print (dataString)
-        if dataString[34:50] == '0303aafe1516aafe' or '0303AAFE1116AAFE':
-            """
-            Selects parts of the bluetooth packets.
-            """
-            broadcastType = dataString[50:52]
-            if broadcastType == '00' :
-                type = "Eddystone UID"
-                namespace = dataString[54:74].upper()
-                instance = dataString[74:86].upper()
-                resultsArray = [
-                {"type": type, "namespace": namespace, "instance": instance}]
-                return resultsArray
-
-            elif broadcastType == '10':
-                type = "Eddystone URL"
-                urlprefix = dataString[54:56]
-                if urlprefix == '00':
-                    prefix = 'http://www.'
-                elif urlprefix == '01':
-                    prefix = 'https://www.'
-                elif urlprefix == '02':
-                    prefix = 'http://'
-                elif urlprefix == '03':
-                    prefix = 'https://'
-                hexUrl = dataString[56:][:-2]
-                #url = prefix + hexUrl.decode("hex")
-                url = prefix + bytearray.fromhex(hexUrl).decode()
-                #rssi, = struct.unpack("b", packet[packetOffset-1])
-                # LCL
-                rssi, = struct.unpack("b", packet[packetOffset-1:])
-                resultsArray = [{"type": type, "url": url}]
-                return resultsArray
-
-            elif broadcastType == '20':
-                type = "Eddystone TLM"
-                resultsArray = [{"type": type}]
-                return resultsArray
-
-            elif broadcastType == '30':
-                type = "Eddystone EID"
-                resultsArray = [{"type": type}]
-                return resultsArray
-
-            elif broadcastType == '40':
-                type = "Eddystone RESERVED"
-                resultsArray = [{"type": type}]
-                return resultsArray
-
-        if dataString[38:46] == '4c000215':
-            """
-            Selects parts of the bluetooth packets.
-            """
-            type = "iBeacon"
-            uuid = dataString[46:54] + "-" + dataString[54:58] + "-" + dataString[58:62] + "-" + dataString[62:66] + "-" + dataString[66:78]
-            major = dataString[78:82]
-            minor = dataString[82:86]
-            txPower = dataString[86:88]
-
-            majorVal = int("".join(major.split()[::-1]), 16)
-            minorVal = int("".join(minor.split()[::-1]), 16)
-            txPowerVal = int("".join(txPower.split()[::-1]), 16) - 256
-
-            """
-            Organises Mac Address to display properly
-            """
-            scrambledAddress = dataString[14:26]
-            fixStructure = iter("".join(reversed([scrambledAddress[i:i+2] for i in range(0, len(scrambledAddress), 2)])))
-            macAddress = ':'.join(a+b for a,b in zip(fixStructure, fixStructure))
-
-            '''
-            Get RSSI
-            '''
-            if sys.version_info[0] == 3:
-                rssi, = struct.unpack("b", bytes([packet[packetOffset-1]]))
-            else:
-                rssi, = struct.unpack("b", packet[packetOffset-1])
-
-            remain = dataString[0:96]
-            resultsArray = [{"type": type, "ptype" : ptype, "event": event, "plen" : plen, 
-                             "uuid": uuid, 
-                             "major": majorVal, 
-                             "minor": minorVal, 
-                             "rssi": rssi, 
-                             "txPower": txPowerVal, 
-                             "macAddress": macAddress, 
-                             "dataString" : remain}]
-
-            return resultsArray
-        ''' 
-        if dataString[38:42] == '4c00':
-            """
-            Selects parts of the bluetooth packets.
-            """
-            type = "Overflow"
-            remain = dataString[0:96]
-            resultsArray = [{"type": type, "ptype" : ptype, "event": event, "plen" : plen, "dataString" : remain}]
-            return resultsArray
-        ''' 
+        if tsock is not None:
+            packet, timestamp = recv_timestamped(tsock)
+        else:
+            packet = sock.recv(255)
+            timestamp = time.monotonic_ns()
+        beacon = decode_packet(packet)
+        if beacon is not None:
+            beacon['timestamp'] = timestamp
+            results.append(beacon)
+            return results
 
     return results
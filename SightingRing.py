@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  SightingRing.py
+#
+#  Single-producer, multi-consumer ring of decoded sightings in
+#  multiprocessing.shared_memory.  The scanner process publishes, any
+#  number of readers (UI, logger, uploader) follow with their own cursor.
+#
+#  Author: E-Motion Inc
+#
+#  Copyright (c) 2020, E-Motion, Inc.  All Rights Researcved
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#=============================================================================
+#
+#  Layout
+#
+#  Header (64 bytes)
+#    magic      4s  'SRNG'
+#    version    H
+#    recordSize H
+#    capacity   I
+#    owner      I   producer pid
+#    head       Q   records published
+#
+#  Slots (capacity x 48 bytes)
+#    seq        Q   2*n+1 while record n is written, 2*n+2 once complete
+#    timestamp  q   monotonic ns
+#    type       B   index into SIGHTING_TYPES
+#    adapter    B   hci dev id
+#    rssi       b
+#    txPower    b
+#    major      H
+#    minor      H
+#    mac        6s
+#    uuid       16s iBeacon uuid, or Eddystone namespace + instance
+#
+#  Readers take no locks: a reader checks the slot seq before and after copying the
+#  record, so a slot overwritten while it was being read is detected and
+#  skipped instead of returned torn.  A reader that falls more than
+#  'capacity' records behind jumps forward and counts what it dropped.
+#
+#=============================================================================
+import os
+import sys
+import time
+import struct
+import uuid
+import threading
+from multiprocessing import shared_memory, resource_tracker
+
+
+RING_MAGIC   = b'SRNG'
+RING_VERSION = 2
+
+HEADER       = struct.Struct("<4sHHIIQ40x")
+HEAD         = struct.Struct("<Q")
+HEAD_OFFSET  = struct.calcsize("<4sHHII")
+
+SEQ          = struct.Struct("<Q")
+RECORD       = struct.Struct("<QqBBbbHH6s16s2x")
+
+SIGHTING_TYPES = ["iBeacon", "Eddystone UID", "Eddystone URL",
+                  "Eddystone TLM", "Eddystone EID", "Eddystone RESERVED",
+                  "Other"]
+
+DEFAULT_RING_NAME = "vbeacon-sightings"
+
+
+#-----------------------------------------------------------------------------
+#  Convert 'aa:bb:cc:dd:ee:ff' to 6 bytes and back
+#-----------------------------------------------------------------------------
+def _macToBytes(mac):
+  if not mac:
+    return bytes(6)
+  return bytes.fromhex(mac.replace(':', ''))
+
+def _bytesToMac(b):
+  return ':'.join('%02x' % x for x in b)
+
+
+#-----------------------------------------------------------------------------
+#
+#  Pack a beacon dict (as returned by ScanUtility/MultiScanner) into the
+#  fixed size record body, and unpack it back into a dict
+#
+#-----------------------------------------------------------------------------
+def packSighting(beacon, seq=0):
+  btype = beacon.get('type', 'Other')
+  if btype not in SIGHTING_TYPES:
+    btype = 'Other'
+
+  if 'uuid' in beacon:
+    ident = uuid.UUID(beacon['uuid']).bytes
+  elif 'namespace' in beacon:
+    ident = bytes.fromhex(beacon['namespace'] + beacon['instance'])
+  else:
+    ident = bytes(16)
+
+  return RECORD.pack(seq,
+                     beacon.get('timestamp', time.monotonic_ns()),
+                     SIGHTING_TYPES.index(btype),
+                     beacon.get('adapter', 0),
+                     beacon.get('rssi', 0),
+                     beacon.get('txPower', 0),
+                     beacon.get('major', 0),
+                     beacon.get('minor', 0),
+                     _macToBytes(beacon.get('macAddress')),
+                     ident)
+
+def unpackSighting(data, offset=0):
+  (seq, timestamp, btype, adapter, rssi, txPower,
+   major, minor, mac, ident) = RECORD.unpack_from(data, offset)
+
+  beacon = {"type": SIGHTING_TYPES[btype],
+            "timestamp": timestamp,
+            "adapter": adapter,
+            "rssi": rssi,
+            "txPower": txPower,
+            "macAddress": _bytesToMac(mac)}
+
+  if btype == 0:
+    beacon["uuid"] = str(uuid.UUID(bytes=ident))
+    beacon["major"] = major
+    beacon["minor"] = minor
+  elif btype == 1:
+    beacon["namespace"] = ident[:10].hex().upper()
+    beacon["instance"] = ident[10:].hex().upper()
+
+  return beacon
+
+
+#-----------------------------------------------------------------------------
+#  Is a producer process still running
+#-----------------------------------------------------------------------------
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+#-----------------------------------------------------------------------------
+#
+#  SightingRing - the producer side.  Creates the shared memory segment.
+#
+#-----------------------------------------------------------------------------
+class SightingRing:
+
+  #----------------------------------------------
+  #  Constructor
+  #----------------------------------------------
+  def __init__(self, name=DEFAULT_RING_NAME, capacity=1024):
+    size = HEADER.size + capacity * RECORD.size
+    try:
+      self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+      # Only reclaim a ring left over by a producer that is gone
+      stale = shared_memory.SharedMemory(name=name)
+      magic, version, _, _, owner, _ = HEADER.unpack_from(stale.buf, 0)
+      if magic != RING_MAGIC or (version == RING_VERSION and _alive(owner)):
+        stale.close()
+        resource_tracker.unregister(stale._name, "shared_memory")
+        raise FileExistsError(f"sighting ring {name} is in use" +
+                              (f" by pid {owner}" if magic == RING_MAGIC else ""))
+      stale.close()
+      stale.unlink()
+      self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    self.name = name
+    self.capacity = capacity
+    self.head = 0
+    # Serializes publishers inside this process (one thread per adapter)
+    self.mutex = threading.Lock()
+    HEADER.pack_into(self.shm.buf, 0, RING_MAGIC, RING_VERSION,
+                     RECORD.size, capacity, os.getpid(), 0)
+
+  #----------------------------------------------
+  #  Publish one beacon
+  #----------------------------------------------
+  def publish(self, beacon):
+    with self.mutex:
+      n = self.head
+      # Pack first: a beacon that does not fit the record raises here,
+      # before the slot is marked as being written
+      record = packSighting(beacon, 2*n + 1)
+      offset = HEADER.size + (n % self.capacity) * RECORD.size
+      buf = self.shm.buf
+
+      SEQ.pack_into(buf, offset, 2*n + 1)
+      buf[offset:offset + RECORD.size] = record
+      SEQ.pack_into(buf, offset, 2*n + 2)
+
+      self.head = n + 1
+      HEAD.pack_into(buf, HEAD_OFFSET, self.head)
+
+  #----------------------------------------------
+  #  Remove the shared memory segment
+  #----------------------------------------------
+  def close(self):
+    self.shm.close()
+    self.shm.unlink()
+
+
+#-----------------------------------------------------------------------------
+#
+#  SightingReader - the consumer side.  Attaches to an existing ring.
+#
+#-----------------------------------------------------------------------------
+class SightingReader:
+
+  #----------------------------------------------
+  #  Constructor
+  #
+  #  fromStart = True to replay what is still in
+  #  the ring, False to only see new sightings
+  #----------------------------------------------
+  def __init__(self, name=DEFAULT_RING_NAME, fromStart=False):
+    self.shm = shared_memory.SharedMemory(name=name)
+    # Readers must not unlink the producer's segment on exit
+    resource_tracker.unregister(self.shm._name, "shared_memory")
+
+    magic, version, recordSize, capacity, _, _ = HEADER.unpack_from(self.shm.buf, 0)
+    if magic != RING_MAGIC or version != RING_VERSION or recordSize != RECORD.size:
+      self.shm.close()
+      raise ValueError(f"{name} is not a version {RING_VERSION} sighting ring")
+
+    self.capacity = capacity
+    self.dropped = 0
+    head = self._loadHead()
+    self.cursor = max(0, head - capacity) if fromStart else head
+
+  #----------------------------------------------
+  #  Read head until two reads agree; a 64 bit
+  #  store is not atomic on 32 bit ARM
+  #----------------------------------------------
+  def _loadHead(self):
+    head, = HEAD.unpack_from(self.shm.buf, HEAD_OFFSET)
+    while True:
+      again, = HEAD.unpack_from(self.shm.buf, HEAD_OFFSET)
+      if again == head:
+        return head
+      head = again
+
+  #----------------------------------------------
+  #  Return all sightings published since the
+  #  last call (at most 'limit')
+  #----------------------------------------------
+  def read(self, limit=None):
+    results = []
+    buf = self.shm.buf
+    head = self._loadHead()
+
+    if head - self.cursor > self.capacity:
+      self.dropped = self.dropped + (head - self.capacity - self.cursor)
+      self.cursor = head - self.capacity
+
+    while self.cursor < head:
+      if limit is not None and len(results) >= limit:
+        break
+
+      n = self.cursor
+      offset = HEADER.size + (n % self.capacity) * RECORD.size
+      expected = 2*n + 2
+
+      seq, = SEQ.unpack_from(buf, offset)
+      if seq == expected:
+        data = bytes(buf[offset:offset + RECORD.size])
+        seq, = SEQ.unpack_from(buf, offset)
+
+      if seq != expected:
+        # Overwritten by the producer while we were behind
+        self.dropped = self.dropped + 1
+      else:
+        results.append(unpackSighting(data))
+
+      self.cursor = n + 1
+
+    return results
+
+  #----------------------------------------------
+  #  Poll until at least one sighting is available
+  #----------------------------------------------
+  def wait(self, interval=0.05, timeout=None):
+    start = time.monotonic()
+    while True:
+      results = self.read()
+      if results:
+        return results
+      if timeout is not None and time.monotonic() - start >= timeout:
+        return results
+      time.sleep(interval)
+
+  #----------------------------------------------
+  #  Detach from the ring
+  #----------------------------------------------
+  def close(self):
+    self.shm.close()
+
+
+#-----------------------------------------------------------------------------
+#  main() - follow the ring and print every sighting
+#-----------------------------------------------------------------------------
+def main(argv):
+  name = argv[0] if argv else DEFAULT_RING_NAME
+  reader = SightingReader(name)
+  try:
+    while True:
+      for beacon in reader.wait():
+        print(beacon)
+  except KeyboardInterrupt:
+    pass
+  print(f"dropped={reader.dropped}")
+  reader.close()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  StateSnapshot.py
+#
+#  Save the beacon table before the device sleeps and map it back on wake
+#
+#  Author: E-Motion Inc
+#
+#  Copyright (c) 2020, E-Motion, Inc.  All Rights Researcved
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+#
+#=============================================================================
+#
+#  Layout
+#
+#  Header (32 bytes)
+#    magic 'VBST', version, record size, count, saved at (wall clock ns),
+#    power tier name (up to 8 bytes, NUL padded, empty without a governor)
+#
+#  Records (count x SightingRing.RECORD)
+#    the sighting record of the ring, with 'timestamp' holding the age of
+#    the entry in ns when the snapshot was saved
+#
+#  Monotonic time restarts with every boot, so ages are stored relative to
+#  the wall clock at save time (kept by the PiSugar RTC while powered off)
+#  and turned back into monotonic timestamps on restore.
+#
+#  The record has no room for an Eddystone URL, so URL entries are not
+#  saved.  TLM, EID and RESERVED sightings are decoded by the scanner to
+#  their address and rssi only, which the record keeps.
+#
+#=============================================================================
+import os
+import sys
+import mmap
+import time
+import struct
+from SightingRing import RECORD, packSighting, unpackSighting
+
+
+STATE_MAGIC   = b'VBST'
+STATE_VERSION = 1
+
+HEADER = struct.Struct("<4sHHIQ8s")
+
+# Types whose payload packSighting does not keep
+UNSAVED_TYPES = ("Eddystone URL",)
+
+
+#-----------------------------------------------------------------------------
+#
+#  Save entries [(timestamp, beacon), ...] with monotonic ns timestamps
+#  and the current power tier name.  Returns the number of entries saved.
+#  Written to a temporary file, synced and renamed, so a power cut leaves
+#  either the old or the new snapshot.
+#
+#-----------------------------------------------------------------------------
+def saveState(path, entries, tier=None):
+  tierName = (tier or '').encode()
+  if len(tierName) > 8:
+    raise ValueError(f"tier name {tier} is longer than 8 bytes")
+
+  now = time.monotonic_ns()
+  entries = [(t, b) for t, b in entries if b.get('type') not in UNSAVED_TYPES]
+  data = bytearray(HEADER.size + len(entries) * RECORD.size)
+  HEADER.pack_into(data, 0, STATE_MAGIC, STATE_VERSION, RECORD.size,
+                   len(entries), time.time_ns(), tierName)
+
+  offset = HEADER.size
+  for timestamp, beacon in entries:
+    aged = dict(beacon, timestamp=max(0, now - timestamp))
+    data[offset:offset + RECORD.size] = packSighting(aged)
+    offset = offset + RECORD.size
+
+  tmp = path + '.tmp'
+  fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  try:
+    os.write(fd, data)
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+  os.replace(tmp, path)
+
+  dirfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+  try:
+    os.fsync(dirfd)
+  finally:
+    os.close(dirfd)
+  return len(entries)
+
+
+#-----------------------------------------------------------------------------
+#
+#  Load a snapshot.  Returns [(timestamp, beacon), ...] with timestamps
+#  moved back by the time spent asleep; entries older than maxAge seconds
+#  (which may be float('inf')) are dropped.  A missing or foreign file
+#  gives [].
+#
+#-----------------------------------------------------------------------------
+def loadState(path, maxAge=3600.0):
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except FileNotFoundError:
+    return []
+
+  try:
+    if os.fstat(fd).st_size < HEADER.size:
+      return []
+    buf = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+  finally:
+    os.close(fd)
+
+  try:
+    magic, version, recordSize, count, savedAt, _ = HEADER.unpack_from(buf, 0)
+    if (magic != STATE_MAGIC or version != STATE_VERSION or
+        recordSize != RECORD.size or len(buf) < HEADER.size + count * recordSize):
+      print(f"{path} is not a version {STATE_VERSION} state snapshot")
+      return []
+
+    now = time.monotonic_ns()
+    asleep = max(0, time.time_ns() - savedAt)
+    limit = maxAge * 1e9
+
+    entries = []
+    for i in range(count):
+      beacon = unpackSighting(buf, HEADER.size + i * RECORD.size)
+      age = beacon['timestamp'] + asleep
+      if age > limit:
+        continue
+      beacon['timestamp'] = now - age
+      entries.append((beacon['timestamp'], beacon))
+    return entries
+  finally:
+    buf.close()
+
+
+#-----------------------------------------------------------------------------
+#  Power tier saved with a snapshot, None if there is none
+#-----------------------------------------------------------------------------
+def loadTier(path):
+  try:
+    with open(path, 'rb') as f:
+      data = f.read(HEADER.size)
+  except FileNotFoundError:
+    return None
+  if len(data) < HEADER.size:
+    return None
+
+  magic, version, _, _, _, tierName = HEADER.unpack(data)
+  if magic != STATE_MAGIC or version != STATE_VERSION:
+    return None
+  return tierName.rstrip(b'\0').decode() or None
+
+
+#-----------------------------------------------------------------------------
+#  main() - print a snapshot, e.g. ./StateSnapshot.py vbeacon.state
+#-----------------------------------------------------------------------------
+def main(argv):
+  now = time.monotonic_ns()
+  print(f"tier {loadTier(argv[0])}")
+  for timestamp, beacon in loadState(argv[0], float('inf')):
+    print(f"{(now - timestamp) / 1e9:10.1f} s  {beacon}")
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -49,6 +49,10 @@ class ePaper:
     self.width = self.epd.height 
     self.height = self.epd.width 
 
+    self.shown = None      # sheet bytes on the panel, None if unknown
+    self.frames = 0
+    self.skipped = 0
+
     self.clear()
 
   #---------------------------------------------------------------------------
@@ -56,6 +60,7 @@ class ePaper:
   #---------------------------------------------------------------------------
   def clear(self):
     self.epd.Clear(0xFF)
+    self.shown = None
 
   #---------------------------------------------------------------------------
   #  Create a new sheet 
@@ -149,28 +154,69 @@ class ePaper:
     self.epd.init(self.epd.FULL_UPDATE)
     self.epd.displayPartBaseImage(self.epd.getbuffer(bkgnd))
     self.epd.init(self.epd.PART_UPDATE)
+    self.shown = self.frameKey(bkgnd)
 
   #---------------------------------------------------------------------------
   #  End partial update with option to clear screen 
   #---------------------------------------------------------------------------
   def endPartial(self, clear=True):
     self.epd.init(self.epd.FULL_UPDATE)
+    self.shown = None
     if clear:
       self.clear()
       
+  #---------------------------------------------------------------------------
+  #  Identity of a sheet's content - its raw bytes, about 4 KB for a 1-bit
+  #  sheet, so comparing is cheaper than a hash
+  #---------------------------------------------------------------------------
+  def frameKey(self, sheet):
+    return (sheet.mode, sheet.size, sheet.tobytes())
+
+  #---------------------------------------------------------------------------
+  #  Is this sheet what the panel already shows
+  #---------------------------------------------------------------------------
+  def showing(self, sheet):
+    return self.shown is not None and self.shown == self.frameKey(sheet)
+
+  #---------------------------------------------------------------------------
+  #  Commit a sheet with 'update' unless the panel already shows it.
+  #  Returns True if the panel was refreshed.  A panel stuck busy drops
+  #  the frame; the next one is written in full.
+  #---------------------------------------------------------------------------
+  def commit(self, sheet, update):
+    key = self.frameKey(sheet)
+    self.frames = self.frames + 1
+    if self.shown is not None and self.shown == key:
+      self.skipped = self.skipped + 1
+      return False
+    try:
+      update(self.epd.getbuffer(sheet))
+    except epd2in13_V2.BusyTimeout as e:
+      print(f"ePaper: {e}, frame dropped")
+      self.shown = None
+      self.epd.ram = None
+      return False
+    self.shown = key
+    return True
+
   #---------------------------------------------------------------------------
   #  Render the image 
   #---------------------------------------------------------------------------
   def render(self, sheet):
-    self.epd.display(self.epd.getbuffer(sheet))
-    # time.sleep(2)
+    return self.commit(sheet, self.epd.display)
 
   #---------------------------------------------------------------------------
   #  Render the image 
   #---------------------------------------------------------------------------
   def renderPartial(self, sheet):
-    self.epd.displayPartial(self.epd.getbuffer(sheet))
-    # time.sleep(2)
+    return self.commit(sheet, self.epd.displayPartial)
+
+  #---------------------------------------------------------------------------
+  #  Frames asked for, frames skipped as already shown and panel busy times
+  #---------------------------------------------------------------------------
+  def stats(self):
+    return {'frames': self.frames, 'skipped': self.skipped,
+            'busy': self.epd.busy_stats()}
  
   #---------------------------------------------------------------------------
   #  Sleep the display  
@@ -178,6 +224,7 @@ class ePaper:
   def sleep(self):
     self.epd.sleep()
     self.epd.Dev_exit()
+    self.shown = None
 
   #---------------------------------------------------------------------------
   #  Shutdown the display  
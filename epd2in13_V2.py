@@ -28,14 +28,26 @@
 #
 
 
+import time
 import logging
 import epdconfig
+from collections import deque
 import numpy as np
+from PIL import Image
 
 # Display resolution
 EPD_WIDTH       = 122
 EPD_HEIGHT      = 250
 
+# BUSY wait (ms): give up after BUSY_TIMEOUT, re-check the pin at least
+# every BUSY_SLICE while waiting for the falling edge
+BUSY_TIMEOUT    = 10000
+BUSY_SLICE      = 50
+
+# BUSY still high after BUSY_TIMEOUT; the panel must not be driven further
+class BusyTimeout(RuntimeError):
+    pass
+
 class EPD:
     def __init__(self):
         self.reset_pin = epdconfig.RST_PIN
@@ -44,6 +56,10 @@ class EPD:
         self.cs_pin = epdconfig.CS_PIN
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        self.ram = None             # frame last written to RAM 0x24
+        self.window = None          # RAM window of the last partial update
+        self.busy_edge = True       # BUSY edge detection usable
+        self.busy_times = {'full': deque(maxlen=32), 'part': deque(maxlen=32)}
         
     FULL_UPDATE = 0
     PART_UPDATE = 1
@@ -103,23 +119,102 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # send a block of data bytes in one SPI transfer
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
         
-    def ReadBusy(self):
+    # Wait for BUSY to go low.  Sleeps on the falling edge where the GPIO
+    # library supports it, otherwise polls (see busy_poll_ms).  'update'
+    # ('full' or 'part') records how long the refresh kept the panel busy.
+    # Raises BusyTimeout if BUSY is still high after BUSY_TIMEOUT.
+    def ReadBusy(self, update=None):
+        start = time.monotonic()
+        deadline = start + BUSY_TIMEOUT / 1000.0
         while(epdconfig.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            epdconfig.delay_ms(100)    
+            now = time.monotonic()
+            if now >= deadline:
+                logging.warning("e-Paper busy for more than %d ms", BUSY_TIMEOUT)
+                raise BusyTimeout(f"e-Paper busy for more than {BUSY_TIMEOUT} ms")
+            if self.busy_edge:
+                try:
+                    # short slices: an edge just before the wait is armed is
+                    # not seen, the next pin read catches it
+                    epdconfig.wait_falling(self.busy_pin, min(BUSY_SLICE, (deadline - now) * 1000))
+                    continue
+                except (RuntimeError, AttributeError) as e:
+                    logging.debug("BUSY edge detection unavailable (%s), polling", e)
+                    self.busy_edge = False
+            epdconfig.delay_ms(self.busy_poll_ms(update, now - start))
+
+        if update is not None:
+            self.busy_times[update].append(time.monotonic() - start)
+
+    # Poll interval: half the time left until the usual end of this kind of
+    # refresh, then at most a tenth of the time waited so far (1-10 ms)
+    def busy_poll_ms(self, update, elapsed):
+        times = self.busy_times.get(update)
+        if times:
+            remaining = sum(times) / len(times) - elapsed
+            if remaining > 0:
+                return min(max(remaining * 500, 1), 100)
+        return min(max(elapsed * 100, 1), 10)
+
+    # Busy time per update type in ms
+    def busy_stats(self):
+        stats = {}
+        for update, times in self.busy_times.items():
+            if times:
+                stats[update] = {'count': len(times),
+                                 'last': round(times[-1] * 1000, 1),
+                                 'mean': round(sum(times) / len(times) * 1000, 1),
+                                 'min': round(min(times) * 1000, 1),
+                                 'max': round(max(times) * 1000, 1)}
+        return stats
 
     def TurnOnDisplay(self):
         self.send_command(0x22)
         self.send_data(0xC7)
         self.send_command(0x20)        
-        self.ReadBusy()
+        self.ReadBusy('full')
         
     def TurnOnDisplayPart(self):
         self.send_command(0x22)
         self.send_data(0x0c)
         self.send_command(0x20)        
-        self.ReadBusy()
+        self.ReadBusy('part')
         
+    # RAM window from byte column x_start..x_end and buffer row
+    # y_start..y_end.  With data entry mode 0x01 buffer row 0 is RAM line
+    # height-1 and rows count down, as in init.
+    def SetWindow(self, x_start, x_end, y_start, y_end):
+        top = self.height - 1 - y_start
+        bottom = self.height - 1 - y_end
+
+        self.send_command(0x44) #set Ram-X address start/end position
+        self.send_data(x_start)
+        self.send_data(x_end)
+
+        self.send_command(0x45) #set Ram-Y address start/end position
+        self.send_data(top & 0xFF)
+        self.send_data(top >> 8)
+        self.send_data(bottom & 0xFF)
+        self.send_data(bottom >> 8)
+
+        self.send_command(0x4E) # set RAM x address count
+        self.send_data(x_start)
+        self.send_command(0x4F) # set RAM y address count
+        self.send_data(top & 0xFF)
+        self.send_data(top >> 8)
+
+    # frame buffer as a (height, linewidth) byte array
+    def frame(self, image, linewidth):
+        data = bytes(image[0 : linewidth * self.height])
+        return np.frombuffer(data, dtype=np.uint8).reshape(self.height, linewidth)
+
     def init(self, update):
         if (epdconfig.module_init() != 0):
             return -1
@@ -183,6 +278,9 @@ class EPD:
             self.send_data(0x00)
             self.ReadBusy()
         else:
+            self.send_command(0x11) #data entry mode, as for the full update;
+            self.send_data(0x01)    #SetWindow relies on it
+
             self.send_command(0x2C)     #VCOM Voltage
             self.send_data(0x26)
 
@@ -210,14 +308,39 @@ class EPD:
             self.send_data(0x01)
         return 0
 
+    # Panel buffer: one row of linewidth bytes per panel line, MSB first,
+    # 1 = white.  Packed by PIL in one pass; _getbuffer_pixels is the
+    # original per-pixel conversion and gives the same bytes.
     def getbuffer(self, image):
         if self.width%8 == 0:
             linewidth = int(self.width/8)
         else:
             linewidth = int(self.width/8) + 1
+
+        image_monocolor = image.convert('1')
+        imwidth, imheight = image_monocolor.size
+
+        if(imwidth == self.width and imheight == self.height and imwidth < linewidth * 8):
+            logging.debug("Vertical")
+            # pixel x lands on bit (imwidth - x): mirrored and shifted by one
+            canvas = Image.new('1', (linewidth * 8, imheight), 255)
+            canvas.paste(image_monocolor.transpose(Image.FLIP_LEFT_RIGHT), (1, 0))
+            return bytearray(canvas.tobytes())
+        elif(imwidth == self.height and imheight == self.width):
+            logging.debug("Horizontal")
+            # pixel (x, y) lands on line x, bit y
+            canvas = Image.new('1', (linewidth * 8, imwidth), 255)
+            canvas.paste(image_monocolor.transpose(Image.TRANSPOSE), (0, 0))
+            return bytearray(canvas.tobytes())
+        return self._getbuffer_pixels(image_monocolor)
+
+    def _getbuffer_pixels(self, image_monocolor):
+        if self.width%8 == 0:
+            linewidth = int(self.width/8)
+        else:
+            linewidth = int(self.width/8) + 1
          
         buf = [0xFF] * (linewidth * self.height)
-        image_monocolor = image.convert('1')
         imwidth, imheight = image_monocolor.size
         pixels = image_monocolor.load()
         
@@ -246,22 +369,42 @@ class EPD:
         else:
             linewidth = int(self.width/8) + 1
 
+        self.ram = self.frame(image, linewidth)
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(self.ram.tobytes())
         self.TurnOnDisplay()
         
+    # Only the byte-aligned rectangle that differs from what is already
+    # in RAM is written; the rest of RAM keeps the same bytes a full
+    # write would have sent.
     def displayPartial(self, image):
         if self.width%8 == 0:
             linewidth = int(self.width/8)
         else:
             linewidth = int(self.width/8) + 1
 
-        self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        frame = self.frame(image, linewidth)
+        if self.ram is None:
+            rows = [0, self.height - 1]
+            cols = [0, linewidth - 1]
+        else:
+            changed = frame != self.ram
+            rows = np.flatnonzero(changed.any(axis=1))
+            cols = np.flatnonzero(changed.any(axis=0))
+
+        if len(rows):
+            x_start, x_end = int(cols[0]), int(cols[-1])
+            y_start, y_end = int(rows[0]), int(rows[-1])
+            self.window = (x_start, x_end, y_start, y_end)
+            logging.debug("partial window x %d-%d y %d-%d", x_start, x_end, y_start, y_end)
+
+            self.SetWindow(x_start, x_end, y_start, y_end)
+            self.send_command(0x24)
+            self.send_data2(frame[y_start : y_end + 1, x_start : x_end + 1].tobytes())
+            self.SetWindow(0, linewidth - 1, 0, self.height - 1)
+            self.ram = frame
+        else:
+            self.window = None
                 
                 
         # self.send_command(0x26)
@@ -276,16 +419,13 @@ class EPD:
         else:
             linewidth = int(self.width/8) + 1
 
+        self.ram = self.frame(image, linewidth)
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(self.ram.tobytes())
                 
                 
         self.send_command(0x26)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])  
+        self.send_data2(self.ram.tobytes())
         self.TurnOnDisplay()
     
     def Clear(self, color):
@@ -295,10 +435,9 @@ class EPD:
             linewidth = int(self.width/8) + 1
         # logging.debug(linewidth)
         
+        self.ram = self.frame(bytes([color]) * (linewidth * self.height), linewidth)
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(color)   
+        self.send_data2(self.ram.tobytes())
         self.TurnOnDisplay()
 
     def sleep(self):
@@ -309,6 +448,7 @@ class EPD:
         self.send_command(0x10) #enter deep sleep
         self.send_data(0x01)
         epdconfig.delay_ms(100)
+        self.ram = None
 
     def Dev_exit(self):
         epdconfig.module_exit()
@@ -40,6 +40,9 @@ class RaspberryPi:
     CS_PIN          = 8
     BUSY_PIN        = 24
 
+    # spidev default bufsiz
+    SPI_CHUNK       = 4096
+
     def __init__(self):
         import spidev
         import RPi.GPIO
@@ -58,9 +61,21 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_falling(self, pin, timeout_ms):
+        # True on a falling edge, False on timeout
+        return self.GPIO.wait_for_edge(pin, self.GPIO.FALLING, timeout=max(int(timeout_ms), 1)) is not None
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
+    def spi_writebyte2(self, data):
+        if hasattr(self.SPI, 'writebytes2'):
+            self.SPI.writebytes2(data)
+        else:
+            # spidev < 3.3: writebytes takes a list of at most bufsiz bytes
+            for i in range(0, len(data), self.SPI_CHUNK):
+                self.SPI.writebytes(list(data[i : i + self.SPI_CHUNK]))
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
@@ -118,9 +133,18 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_falling(self, pin, timeout_ms):
+        # True on a falling edge, False on timeout
+        return self.GPIO.wait_for_edge(pin, self.GPIO.FALLING, timeout=max(int(timeout_ms), 1)) is not None
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
+    def spi_writebyte2(self, data):
+        transfer = self.SPI.SYSFS_software_spi_transfer
+        for byte in data:
+            transfer(byte)
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
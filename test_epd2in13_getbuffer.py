@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  test_epd2in13_getbuffer.py
+#
+#  EPD.getbuffer (PIL packing) against the original per-pixel conversion,
+#  EPD._getbuffer_pixels, for both panel orientations.  epdconfig is
+#  replaced in sys.modules so no SPI/GPIO hardware is needed.
+#
+#=============================================================================
+import sys
+import types
+import random
+import unittest
+
+sys.modules.setdefault('epdconfig', types.SimpleNamespace(
+  RST_PIN=17, DC_PIN=25, CS_PIN=8, BUSY_PIN=24))
+
+from PIL import Image, ImageDraw
+import epd2in13_V2
+
+
+#-----------------------------------------------------------------------------
+#  Random test sheet: noise plus a few solid shapes touching the edges
+#-----------------------------------------------------------------------------
+def randomSheet(size, mode, seed):
+  rnd = random.Random(seed)
+  image = Image.new('L', size, 255)
+  image.putdata([rnd.choice((0, 255, rnd.randint(0, 255)))
+                 for _ in range(size[0] * size[1])])
+  draw = ImageDraw.Draw(image)
+  draw.rectangle((0, 0, 7, size[1] - 1), fill=0)
+  draw.rectangle((size[0] - 3, 0, size[0] - 1, 9), fill=0)
+  return image.convert(mode)
+
+
+class GetBufferTest(unittest.TestCase):
+
+  def setUp(self):
+    self.epd = epd2in13_V2.EPD()
+
+  def check(self, size):
+    for mode in ('1', 'L', 'RGB'):
+      for seed in range(3):
+        image = randomSheet(size, mode, seed)
+        expected = bytes(self.epd._getbuffer_pixels(image.convert('1')))
+        with self.subTest(mode=mode, seed=seed):
+          self.assertEqual(bytes(self.epd.getbuffer(image)), expected)
+
+  def test_vertical(self):
+    self.check((epd2in13_V2.EPD_WIDTH, epd2in13_V2.EPD_HEIGHT))
+
+  def test_horizontal(self):
+    self.check((epd2in13_V2.EPD_HEIGHT, epd2in13_V2.EPD_WIDTH))
+
+  def test_blank_and_black(self):
+    for size in ((122, 250), (250, 122)):
+      for color in (0, 255):
+        image = Image.new('1', size, color)
+        expected = bytes(self.epd._getbuffer_pixels(image))
+        self.assertEqual(bytes(self.epd.getbuffer(image)), expected)
+
+  def test_other_size_is_blank(self):
+    buf = self.epd.getbuffer(Image.new('1', (100, 100), 0))
+    self.assertEqual(bytes(buf), b'\xff' * 4000)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,433 @@
+#!/usr/bin/python3
+#=============================================================================
+#
+#  test_pisugar_stub.py
+#
+#  PiSugar2 client (Netcat reply parsing, get_status, alarms/shutdown for
+#  sleep and wake), AsyncPiSugar2, ButtonEvents dispatch, the ui.py button
+#  loop and vBeacon sleep/wake against PiSugarStub on a local port, so no
+#  PiSugar hardware or pisugar-server is needed.  epdconfig and pybluez
+#  are replaced in sys.modules for the tests that import ui and vbeacon.
+#
+#=============================================================================
+import sys
+import time
+import types
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+from PIL import Image, ImageFont
+# Imported here, outside the patched sys.modules, so restoring it after a
+# ui test does not unload numpy (it cannot be loaded twice)
+import numpy
+
+from PiSugarStub import PiSugarStub
+from PiSugar2 import Netcat, PiSugar2, PiSugarStatus, ButtonEvents, EVENT_QUEUE_SIZE
+from AsyncPiSugar2 import AsyncPiSugar2
+
+
+#-----------------------------------------------------------------------------
+#  Base: one stub per test on a free port
+#-----------------------------------------------------------------------------
+class StubTest(unittest.TestCase):
+
+  state = {}
+  faults = {}
+
+  def setUp(self):
+    self.stub = PiSugarStub(port=0, state=self.state, faults=self.faults).start()
+
+  #  Wait until the stub has registered n client connections
+  def waitClients(self, n=1):
+    deadline = time.monotonic() + 2.0
+    while len(self.stub.clients) < n and time.monotonic() < deadline:
+      time.sleep(0.01)
+
+  #  Poll until n pushed presses have been read into netcat.events;
+  #  Netcat only reads while it waits for a reply
+  def waitEvents(self, netcat, n=1):
+    deadline = time.monotonic() + 2.0
+    while len(netcat.events) < n and time.monotonic() < deadline:
+      netcat.query("get model")
+
+  def tearDown(self):
+    self.stub.stop()
+
+
+#-----------------------------------------------------------------------------
+#  Netcat reply parsing
+#-----------------------------------------------------------------------------
+class NetcatTest(StubTest):
+
+  def setUp(self):
+    super().setUp()
+    self.netcat = Netcat("127.0.0.1", self.stub.port)
+    self.waitClients()
+
+  def tearDown(self):
+    self.netcat.close()
+    super().tearDown()
+
+  def test_query_returns_keyed_reply(self):
+    self.assertEqual(self.netcat.query("get battery"), "battery: 84.5")
+    self.assertEqual(self.netcat.query("rtc_pi2rtc"), "rtc_pi2rtc: done")
+
+  def test_pipeline_keeps_order(self):
+    replies = self.netcat.pipeline(["get model", "get battery_v", "get battery_charging"])
+    self.assertEqual(replies, ["model: PiSugar 2", "battery_v: 4.015",
+                               "battery_charging: false"])
+
+  def test_pushed_press_is_queued_not_returned(self):
+    self.stub.press("double")
+    self.waitEvents(self.netcat)
+    self.assertEqual(self.netcat.query("get battery"), "battery: 84.5")
+    self.assertEqual(list(self.netcat.events), ["double"])
+
+  def test_silent_server_times_out(self):
+    self.stub.faults['silent'] = 1.0
+    self.netcat.timeout = 0.1
+    self.assertEqual(self.netcat.query("get battery"), "")
+
+  def test_invalid_request_is_not_an_event(self):
+    self.assertEqual(self.netcat.query("get no_such_key"), "")
+    self.assertEqual(list(self.netcat.events), [])
+    self.assertEqual(self.netcat.query("get battery"), "battery: 84.5")
+
+  def test_late_reply_not_taken_for_next_request(self):
+    self.stub.latency = 0.3
+    self.netcat.timeout = 0.1
+    self.assertEqual(self.netcat.query("get battery"), "")
+    self.stub.latency = 0.0
+    self.stub.state['battery'] = 50.0
+    self.netcat.timeout = 1.0
+    self.assertEqual(self.netcat.query("get battery"), "battery: 50.0")
+
+  def test_event_queue_is_bounded(self):
+    for _ in range(EVENT_QUEUE_SIZE + 4):
+      self.stub.press("single")
+    self.assertEqual(self.netcat.query("get model"), "model: PiSugar 2")
+    self.assertEqual(len(self.netcat.events), EVENT_QUEUE_SIZE)
+
+
+class SplitReplyTest(NetcatTest):
+
+  faults = {'split': True}
+
+  def test_split_replies_are_joined(self):
+    for _ in range(5):
+      self.assertEqual(self.netcat.query("get battery_i"), "battery_i: 0.004")
+
+
+#-----------------------------------------------------------------------------
+#  PiSugar2 - status and the calls vBeacon uses to sleep and wake
+#-----------------------------------------------------------------------------
+class PiSugar2Test(StubTest):
+
+  state = {'battery': 42.0, 'battery_power_plugged': True}
+
+  def setUp(self):
+    super().setUp()
+    self.pisugar = PiSugar2(port=self.stub.port)
+    self.waitClients()
+
+  def tearDown(self):
+    self.pisugar.netcat.close()
+    super().tearDown()
+
+  def test_connect_syncs_rtc(self):
+    self.assertEqual(self.stub.actions.get('rtc_pi2rtc'), 1)
+
+  def test_get_status(self):
+    self.assertEqual(self.pisugar.get_status(),
+                     PiSugarStatus(42.0, 4.015, 0.004, False, True))
+    self.stub.state['battery'] = 12.5
+    self.stub.state['battery_charging'] = True
+    status = self.pisugar.get_status()
+    self.assertEqual(status.battery, 12.5)
+    self.assertTrue(status.charging)
+
+  def test_status_field_none_without_reply(self):
+    self.stub.faults['silent'] = 1.0
+    self.pisugar.netcat.timeout = 0.1
+    self.assertEqual(self.pisugar.get_status(), PiSugarStatus(None, None, None, None, None))
+
+  def test_alarm_and_shutdown(self):
+    wake = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(seconds=600)
+    self.assertTrue(self.pisugar.set_rtc_alarm(wake, [1, 1, 1, 1, 1, 1, 1]))
+    self.assertTrue(self.stub.state['rtc_alarm_enabled'])
+    self.assertEqual(self.stub.state['rtc_alarm_time'], wake.isoformat())
+    self.assertEqual(self.stub.state['alarm_repeat'], 127)
+    self.assertTrue(self.pisugar.get_alarm_enabled())
+
+    self.assertTrue(self.pisugar.force_shutdown())
+    self.assertEqual(self.stub.actions.get('force_shutdown'), 1)
+
+  def test_get_button_press_prefers_pushed_press(self):
+    self.stub.press("long")
+    self.waitEvents(self.pisugar.netcat)
+    self.assertEqual(self.pisugar.get_button_press(), "long")
+    self.assertEqual(self.pisugar.get_button_press(), "long")   # from state
+
+
+#-----------------------------------------------------------------------------
+#  AsyncPiSugar2 - pipelining and reconnects.  The client is built outside
+#  the event loop, as a caller holding it across asyncio.run() would.
+#-----------------------------------------------------------------------------
+class AsyncPiSugar2Test(StubTest):
+
+  def setUp(self):
+    super().setUp()
+    self.pisugar = AsyncPiSugar2(port=self.stub.port, timeout=1.0)
+    self.pisugar.minBackoff = self.pisugar.backoff = 0.01
+
+  def run_async(self, coro):
+    async def run():
+      try:
+        return await coro
+      finally:
+        await self.pisugar.close()
+    return asyncio.run(run())
+
+  def test_pipeline_keeps_order(self):
+    replies = self.run_async(self.pisugar.pipeline(
+      ["get model", "get battery_v", "get battery_charging"]))
+    self.assertEqual(replies, ["model: PiSugar 2", "battery_v: 4.015",
+                               "battery_charging: false"])
+
+  def test_get_status(self):
+    self.assertEqual(self.run_async(self.pisugar.get_status()),
+                     PiSugarStatus(84.5, 4.015, 0.004, False, False))
+
+  def test_get_reconnects_after_drop(self):
+    self.stub.faults['dropAfter'] = 1
+    async def twice():
+      first = await self.pisugar.get_battery_percentage()
+      self.stub.state['battery'] = 33.0
+      return first, await self.pisugar.get_battery_percentage()
+    self.assertEqual(self.run_async(twice()), (84.5, 33.0))
+    self.assertEqual(self.pisugar.reconnects, 1)
+
+  def test_action_not_resent_after_drop(self):
+    self.stub.faults['dropAfter'] = 1
+    async def shutdown():
+      await self.pisugar.get_model()
+      return await self.pisugar.force_shutdown()
+    with self.assertRaises(ConnectionError):
+      self.run_async(shutdown())
+    self.assertEqual(self.stub.requests, 2)
+    self.assertIsNone(self.stub.actions.get('force_shutdown'))
+
+  def test_timeout_drops_late_reply(self):
+    self.stub.latency = 0.3
+    self.pisugar.timeout = 0.1
+    async def late():
+      with self.assertRaises(asyncio.TimeoutError):
+        await self.pisugar.get_battery_percentage()
+      self.stub.latency = 0.0
+      self.stub.state['battery'] = 50.0
+      self.pisugar.timeout = 1.0
+      return await self.pisugar.get_battery_percentage()
+    self.assertEqual(self.run_async(late()), 50.0)
+
+  def test_invalid_request_is_not_a_press(self):
+    async def press():
+      self.assertEqual(await self.pisugar.query("get no_such_key"), "")
+      self.stub.press("double")
+      return await self.pisugar.get_button_press()
+    self.assertEqual(self.run_async(press()), "double")
+    self.assertEqual(list(self.pisugar.events), [])
+
+
+#-----------------------------------------------------------------------------
+#  ButtonEvents dispatch
+#-----------------------------------------------------------------------------
+class ButtonEventsTest(StubTest):
+
+  def setUp(self):
+    super().setUp()
+    self.seen = []
+    self.called = threading.Event()
+    self.buttons = ButtonEvents(port=self.stub.port, callback=self.onPress)
+    self.buttons.start()
+    self.waitClients()
+
+  def tearDown(self):
+    self.buttons.stop()
+    super().tearDown()
+
+  def onPress(self, event):
+    self.seen.append(event.press)
+    self.called.set()
+
+  def test_presses_in_order(self):
+    self.stub.playButtons([(0.0, "single"), (0.05, "double"), (0.05, "long")]).join()
+    presses = [self.buttons.get(2.0) for _ in range(3)]
+    self.assertEqual([e.press for e in presses], ["single", "double", "long"])
+    self.assertTrue(presses[0].timestamp <= presses[1].timestamp <= presses[2].timestamp)
+    self.assertTrue(self.called.wait(1.0))
+    self.assertEqual(self.seen, ["single", "double", "long"])
+
+  def test_disabled_press_not_sent(self):
+    self.stub.buttonEnable['double'] = False
+    self.stub.press("double")
+    self.assertIsNone(self.buttons.get(0.2))
+
+  def test_no_press_times_out(self):
+    self.assertIsNone(self.buttons.get(0.1))
+
+
+#-----------------------------------------------------------------------------
+#  ui.py button loop: presses from ButtonEvents move the focus and render.
+#  The e-paper is replaced by FakeDisplay; ePaper and ui load their fonts
+#  at import, so truetype is patched while they are imported and used.
+#-----------------------------------------------------------------------------
+class FakeDisplay:
+
+  width = 250
+  height = 122
+
+  def __init__(self):
+    self.renders = 0
+
+  def newSheet(self):
+    return Image.new('1', (self.width, self.height), 255)
+
+  def startPartial(self, bkgnd):
+    pass
+
+  def endPartial(self, clear=True):
+    pass
+
+  def showing(self, sheet):
+    return False
+
+  def renderPartial(self, sheet):
+    self.renders = self.renders + 1
+    return True
+
+  def overlay(self, sheet, point, file):
+    pass
+
+  def drawRect(self, sheet, point, width, height, outline=0, fill=0):
+    pass
+
+
+def patchDisplayModules(test):
+  font = ImageFont.load_default()
+  epdconfig = types.SimpleNamespace(RST_PIN=17, DC_PIN=25, CS_PIN=8, BUSY_PIN=24)
+  for patcher in (mock.patch.dict(sys.modules, {'epdconfig': epdconfig}),
+                  mock.patch.object(ImageFont, 'truetype', return_value=font)):
+    patcher.start()
+    test.addCleanup(patcher.stop)
+  for name in ('ui', 'ePaper', 'epd2in13_V2'):
+    sys.modules.pop(name, None)
+
+
+class UIButtonLoopTest(StubTest):
+
+  def setUp(self):
+    super().setUp()
+    patchDisplayModules(self)
+    import ui
+
+    self.dispatched = []
+    self.handled = threading.Event()
+    test = self
+
+    class TwoRectUI(ui.UI):
+      def build(self):
+        self.first = self.addRect(pos=[0, 0], dim=[50, 25])
+        self.second = self.addRect(pos=[50, 0], dim=[50, 25])
+        self.firstFocusId = self.first.id
+
+      def dispatch(self, btnPress):
+        super().dispatch(btnPress)
+        test.dispatched.append(btnPress)
+        test.handled.set()
+
+    self.buttons = ButtonEvents(port=self.stub.port)
+    self.buttons.start()
+    self.waitClients()
+    self.display = FakeDisplay()
+    self.ui = TwoRectUI(self.display, btnEvents=self.buttons)
+
+  def tearDown(self):
+    self.ui.stop()
+    self.buttons.stop()
+    super().tearDown()
+
+  def press(self, press):
+    self.handled.clear()
+    self.stub.press(press)
+    self.assertTrue(self.handled.wait(2.0))
+
+  def test_single_moves_focus_and_renders(self):
+    self.ui.start()
+    deadline = time.monotonic() + 2.0
+    while self.display.renders == 0 and time.monotonic() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(self.ui.focusChildId, self.ui.first.id)
+    renders = self.display.renders
+
+    self.press("single")
+    self.assertEqual(self.ui.focusChildId, self.ui.second.id)
+    self.assertGreater(self.display.renders, renders)
+
+    self.press("long")
+    self.assertEqual(self.dispatched, ["single", "long"])
+
+  def test_stop_ends_loop(self):
+    self.ui.start()
+    self.ui.stop()
+    self.assertFalse(self.ui.mainThread.is_alive())
+
+
+#-----------------------------------------------------------------------------
+#  vBeacon sleep and wake: the RTC alarm and the shutdown reach the server.
+#  vbeacon imports the scanner, so pybluez is replaced in sys.modules.
+#-----------------------------------------------------------------------------
+class VBeaconSleepTest(StubTest):
+
+  def setUp(self):
+    super().setUp()
+    bluez = types.ModuleType('bluetooth._bluetooth')
+    bluetooth = types.ModuleType('bluetooth')
+    bluetooth._bluetooth = bluez
+    patcher = mock.patch.dict(sys.modules, {'bluetooth': bluetooth,
+                                            'bluetooth._bluetooth': bluez})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    for name in ('vbeacon', 'MultiScanner', 'ScanUtility'):
+      sys.modules.pop(name, None)
+    import vbeacon
+
+    self.beacon = vbeacon.vBeacon()
+    self.beacon.deviceSettings = {'pisugar': {'port': self.stub.port}}
+
+  def tearDown(self):
+    if self.beacon._pisugar is not None:
+      self.beacon._pisugar.netcat.close()
+    super().tearDown()
+
+  def test_wake_after_sets_alarm(self):
+    before = datetime.now(timezone.utc)
+    self.beacon.setWakeAfter(600)
+    after = datetime.now(timezone.utc)
+
+    self.assertTrue(self.stub.state['rtc_alarm_enabled'])
+    self.assertEqual(self.stub.state['alarm_repeat'], 127)
+    alarm = datetime.fromisoformat(self.stub.state['rtc_alarm_time'])
+    self.assertIsNotNone(alarm.utcoffset())
+    self.assertTrue(before + timedelta(seconds=599) <= alarm <= after + timedelta(seconds=601))
+
+  def test_goto_sleep_shuts_down(self):
+    self.beacon.setWakeAfter(60)
+    self.beacon.gotoSleep()
+    self.assertEqual(self.stub.actions.get('rtc_alarm_set'), 1)
+    self.assertEqual(self.stub.actions.get('force_shutdown'), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -23,12 +23,15 @@
 #=============================================================================
 import sys
 import os
+import json
 import time
 import threading
 from collections import deque
 from PIL import Image,ImageDraw,ImageFont
 from ePaper import ePaper 
-from PiSugar2 import PiSugar2 
+from PiSugar2 import PiSugar2, ButtonEvents 
+from PowerGovernor import POWER_TIERS
+from StateSnapshot import loadTier
 
 #-----------------------------------------------------------------------------
 #  Return truetype font of given size
@@ -672,7 +675,7 @@ class UI(Widget):
   #----------------------------------------------
   #  Constructor
   #----------------------------------------------
-  def __init__(self, display, btnFunc):
+  def __init__(self, display, btnFunc=None, btnEvents=None):
     super().__init__() 
     self.idgen = 0
     self.firstFocusId = -1
@@ -683,8 +686,12 @@ class UI(Widget):
     self.dim=[self.display.width, self.display.height] 
     self.page = self.display.newSheet() 
     self.btnFunc = btnFunc 
+    self.btnEvents = btnEvents 
     
     self.renderLock = threading.Lock() 
+    self.refreshInterval = 0.0
+    self.lastRefresh = 0.0
+    self.refreshTimer = None
     self.mainThread = threading.Thread(target=self.mainLoop) 
     self.mainThread.setDaemon(True)
     self.exitLoop = False
@@ -815,9 +822,30 @@ class UI(Widget):
     print("UI renderDisplay()")
 
     self.renderLock.acquire()    
-    self.display.renderPartial(self.page)
+    wait = self.lastRefresh + self.refreshInterval - time.monotonic()
+    if wait > 0 and not self.display.showing(self.page):
+      # Too soon: one deferred refresh shows whatever the page is by then
+      if self.refreshTimer is None:
+        self.refreshTimer = threading.Timer(wait, self._deferredRefresh)
+        self.refreshTimer.setDaemon(True)
+        self.refreshTimer.start()
+    elif self.display.renderPartial(self.page):
+      self.lastRefresh = time.monotonic()
     self.renderLock.release()    
 
+  def _deferredRefresh(self):
+    self.renderLock.acquire()    
+    self.refreshTimer = None
+    self.renderLock.release()    
+    self.renderDisplay()
+
+  #----------------------------------------------
+  #  Minimum seconds between display refreshes,
+  #  e.g. from the power governor (0 = no limit)
+  #----------------------------------------------
+  def setRefreshInterval(self, seconds):
+    self.refreshInterval = seconds
+
   #----------------------------------------------
   #  Render 
   #----------------------------------------------
@@ -953,9 +981,15 @@ class UI(Widget):
     # Start the loop
     self.exitLoop = False
     while not self.exitLoop:
-      btnPress = self.btnFunc()
-      self.dispatch(btnPress)
-      time.sleep(0.05)
+      if self.btnEvents is not None:
+        # Blocks until a press; the timeout only bounds how long stop() waits
+        event = self.btnEvents.get(timeout=0.5)
+        if event is not None:
+          self.dispatch(event.press)
+      else:
+        btnPress = self.btnFunc()
+        self.dispatch(btnPress)
+        time.sleep(0.05)
 
     self.display.endPartial(self.page)
 
@@ -975,25 +1009,59 @@ class UI(Widget):
     self.exitLoop = True
     self.mainThread.join()
 
+    self.renderLock.acquire()    
+    if self.refreshTimer is not None:
+      self.refreshTimer.cancel()
+      self.refreshTimer = None
+    self.renderLock.release()    
+
     # Remove all children
-    for child in self.children:
-      self.delChild(child.id)
+    for child_id in list(self.children):
+      self.delChild(child_id)
  
     return
 
 
 #-----------------------------------------------------------------------------
-#  main()
+#  Follow the power tier vbeacon saves in its state snapshot: set the
+#  refresh interval of the tier whenever the snapshot changes.  Returns
+#  the snapshot mtime, to pass back in as 'seen' on the next call.
+#-----------------------------------------------------------------------------
+def followTier(ui, stateFile, seen=None):
+  try:
+    mtime = os.stat(stateFile).st_mtime_ns
+  except FileNotFoundError:
+    return seen
+  if mtime != seen:
+    name = loadTier(stateFile)
+    for tier in POWER_TIERS:
+      if tier['name'] == name:
+        print(f"UI power tier {name}, refresh {tier['refresh']} s")
+        ui.setRefreshInterval(tier['refresh'])
+  return mtime
+
+#-----------------------------------------------------------------------------
+#  main() - ./ui.py [settings.json]; with vbeacon's settings the display
+#  refresh follows its power tier
 #-----------------------------------------------------------------------------
-def main():
-  pisugar = PiSugar2()
+def main(argv):
+  stateFile = None
+  if argv:
+    with open(argv[0]) as f:
+      stateFile = json.load(f).get('stateFile')
+
+  buttons = ButtonEvents()
+  buttons.start()
   paper = ePaper()
-  ui = UI(paper, pisugar.get_button_press)
+  ui = UI(paper, btnEvents=buttons)
   print(f"UI dimension (WxH) = {ui.dim[0]}x{ui.dim[1]}")
   ui.start()
 
+  seen = None
   while not ui.exitLoop:
+    if stateFile:
+      seen = followTier(ui, stateFile, seen)
     time.sleep(1.0)
  
 if __name__=='__main__':
-  main()
+  main(sys.argv[1:])
@@ -30,191 +30,46 @@ import json
 import getopt 
 import uuid 
 import threading
-import dbus
-import dbus.exceptions
-import dbus.mainloop.glib
-import dbus.service
-import bluetooth._bluetooth as bluez
-import ScanUtility
-from PiSugar2 import PiSugar2
-from Buzzer import Buzzer
+from AdvertSets import iBeaconData, iBeaconSet, eddystoneUidSet, \
+                       eddystoneTlmSet, eddystoneTlmFrame, customSet, \
+                       EDDYSTONE_UUID
+from MultiScanner import MultiScanner, DEFAULT_ADAPTERS
 
+# Everything the first advert and scan do not need (dbus/GLib, PiSugar,
+# GPIO, the optional scan/radio helpers) is imported where it is used
 
-try:
-    from gi.repository import GLib  # python3
-except ImportError:
-    import gobject as GLib  # python2
 
-
-BLUEZ_SERVICE_NAME = 'org.bluez'
-LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
-DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
-DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
-
-LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
-
-
-#=======================================================================
+#=============================================================================
 #
-#   Exception handling classes
+#  Startup trace - ms since the process was exec'd, so interpreter start
+#  and imports are included in time-to-first-advert
 #
-#=======================================================================
-class InvalidArgsException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
-
-
-class NotSupportedException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.NotSupported'
-
-
-class NotPermittedException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.NotPermitted'
-
-
-class InvalidValueLengthException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.InvalidValueLength'
-
+#=============================================================================
+def _processStart():
+  try:
+    with open('/proc/self/stat') as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+    started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    with open('/proc/uptime') as f:
+      uptime = float(f.read().split()[0])
+    return time.monotonic() - (uptime - started)
+  except (OSError, ValueError, IndexError):
+    return time.monotonic()
+
+class StartupTrace:
 
-class FailedException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.Failed'
+    def __init__(self):
+        self.origin = _processStart()
+        self.marks = []
 
+    def mark(self, label):
+      ms = (time.monotonic() - self.origin) * 1000.0
+      self.marks.append((label, ms))
+      return ms
 
-#=======================================================================
-#
-#   BLE Advertisement Class
-#
-#=======================================================================
-class Advertisement(dbus.service.Object):
-  PATH_BASE = '/org/bluez/example/advertisement'
-
-  #--------------------------------------------------------------
-  #  Constrctor
-  #--------------------------------------------------------------
-  def __init__(self, bus, index, advertising_type):
-    self.path = self.PATH_BASE + str(index)
-    self.bus = bus
-    self.ad_type = advertising_type
-    self.service_uuids = None
-    self.manufacturer_data = None
-    self.solicit_uuids = None
-    self.service_data = None
-    self.local_name = None
-    self.include_tx_power = None
-    self.data = None
-    dbus.service.Object.__init__(self, bus, self.path)
-    
-  #--------------------------------------------------------------
-  #  Get properties
-  #--------------------------------------------------------------
-  def get_properties(self):
-    properties = dict()
-    properties['Type'] = self.ad_type
-
-    if self.service_uuids is not None:
-      properties['ServiceUUIDs'] = dbus.Array(
-            self.service_uuids, signature='s')
-
-    if self.solicit_uuids is not None:
-      properties['SolicitUUIDs'] = dbus.Array(
-            self.solicit_uuids, signature='s')
-                
-    if self.manufacturer_data is not None:
-      properties['ManufacturerData'] = dbus.Dictionary(
-            self.manufacturer_data, signature='qv')
-                
-    if self.service_data is not None:
-      properties['ServiceData'] = dbus.Dictionary(
-            self.service_data, signature='sv')
-                
-    if self.local_name is not None:
-      properties['LocalName'] = dbus.String(
-            self.local_name)
-            
-    if self.include_tx_power is not None:
-      properties['IncludeTxPower'] = dbus.Boolean(
-            self.include_tx_power)
-                
-    if self.data is not None:
-      properties['Data'] = dbus.Dictionary(
-            self.data, signature='yv')
-                
-    return {LE_ADVERTISEMENT_IFACE: properties}
-
-
-  #--------------------------------------------------------------
-  #  Get path 
-  #--------------------------------------------------------------
-  def get_path(self):
-    return dbus.ObjectPath(self.path)
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def add_service_uuid(self, uuid):
-    if not self.service_uuids:
-      self.service_uuids = []
-    self.service_uuids.append(uuid)
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def add_solicit_uuid(self, uuid):
-    if not self.solicit_uuids:
-      self.solicit_uuids = []
-    self.solicit_uuids.append(uuid)
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def add_manufacturer_data(self, manuf_code, data):
-    if not self.manufacturer_data:
-      self.manufacturer_data = dbus.Dictionary({}, signature='qv')
-    self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
-
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def add_service_data(self, uuid, data):
-    if not self.service_data:
-      self.service_data = dbus.Dictionary({}, signature='sv')
-    self.service_data[uuid] = dbus.Array(data, signature='y')
-
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def add_local_name(self, name):
-    if not self.local_name:
-      self.local_name = ""
-    self.local_name = dbus.String(name)
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def add_data(self, ad_type, data):
-    if not self.data:
-      self.data = dbus.Dictionary({}, signature='yv')
-    self.data[ad_type] = dbus.Array(data, signature='y')
-
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  @dbus.service.method(DBUS_PROP_IFACE,
-                       in_signature='s',
-                       out_signature='a{sv}')
-                         
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def GetAll(self, interface):
-    if interface != LE_ADVERTISEMENT_IFACE:
-      raise InvalidArgsException()
-    return self.get_properties()[LE_ADVERTISEMENT_IFACE]
-
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  @dbus.service.method(LE_ADVERTISEMENT_IFACE,
-                      in_signature='',
-                      out_signature='')
-                       
-  #--------------------------------------------------------------
-  #--------------------------------------------------------------
-  def Release(self):
-    print('%s: Released!' % self.path)
+    def report(self):
+      for label, ms in self.marks:
+        print(f"  {ms:8.1f} ms  {label}")
 
 
 #=============================================================================
@@ -230,13 +85,23 @@ class vBeacon():
     #  Initializer
     #-------------------------------------------------------------------------
     def __init__(self):
-        self.advertLoop = None
+        self.trace = StartupTrace()
+        self.trace.mark('imports done')
+
         self.advertiser = None
-        self.ad_manager = None
-        self.advertThread = None
+        self.firstAdvert = True
+        self.advertStart = None
+        self.tlmSets = []
     
-        self.scanThread = None
-        self.scanExit = True 
+        self.scanner = None
+        self.scanAdapters = DEFAULT_ADAPTERS
+        self.sightingRing = None
+        self.radioScheduler = None
+        self.rateController = None
+        self.governor = None
+        self.checkPeriod = 1
+        self.buzzerEnabled = True
+        self.sightings = 0
         self.scanMutex = threading.Lock()
         self.beaconList = {}
    
@@ -248,37 +113,46 @@ class vBeacon():
         self.minor = 0 
 
         self.deviceSettings = {}
-        self.pisugar = PiSugar2()
-        self.buzzer = Buzzer(16)
-
-    #-------------------------------------------------------------------------
-    #  Advertiser registration callback
-    #-------------------------------------------------------------------------
-    def register_ad_cb(self):
-      return
-
-
-    #-------------------------------------------------------------------------
-    #  Advertiser registration error callback
-    #-------------------------------------------------------------------------
-    def register_ad_error_cb(self, error):
-      print('Failed to register advertisement: ' + str(error))
-      self.advertLoop.quit()
-
+        self.deferMutex = threading.Lock()
+        self._pisugar = None
+        self._buzzer = None
 
     #-------------------------------------------------------------------------
-    #  Find adaptor
+    #  PiSugar (RTC sync on connect) and Buzzer (GPIO PWM setup) are not
+    #  needed for the first advert; they are created by _deferredInit()
+    #  after the radio is up, or on first use
     #-------------------------------------------------------------------------
-    def find_adapter(self, bus):
-      remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'),
-                               DBUS_OM_IFACE)
-      objects = remote_om.GetManagedObjects()
-
-      for o, props in objects.items():
-        if LE_ADVERTISING_MANAGER_IFACE in props:
-            return o
-      return None
-
+    @property
+    def pisugar(self):
+      self.deferMutex.acquire()
+      try:
+        if self._pisugar is None:
+          from PiSugar2 import PiSugar2
+          # {"ip": ..., "port": ...} e.g. to point at a PiSugarStub off-device
+          self._pisugar = PiSugar2(**self.deviceSettings.get('pisugar', {}))
+      finally:
+        self.deferMutex.release()
+      return self._pisugar
+
+    @property
+    def buzzer(self):
+      self.deferMutex.acquire()
+      try:
+        if self._buzzer is None:
+          from Buzzer import Buzzer
+          self._buzzer = Buzzer(16)
+      finally:
+        self.deferMutex.release()
+      return self._buzzer
+
+    def _deferredInit(self):
+      try:
+        self.pisugar
+        self.trace.mark('pisugar connected, rtc synced')
+      except OSError as e:
+        print(f"PiSugar not available: {e}")
+      self.buzzer
+      self.trace.mark('buzzer ready')
 
     #-------------------------------------------------------------------------
     #  Given a beacon return device ID string by concatenating 
@@ -298,136 +172,271 @@ class vBeacon():
 
 
     #-------------------------------------------------------------------------
-    #  Stop advertisement
+    #  Stop advertisement (the advertiser stays connected for the next start)
     #-------------------------------------------------------------------------
     def stopAdvert(self):
-      self.advertLoop.quit()
+      self.advertiser.stop()
 
-      self.advertThread.join()
-      self.ad_manager.UnregisterAdvertisement(self.advertiser)
-      dbus.service.Object.remove_from_connection(self.advertiser)
-     
-      self.advertiser = None
-      self.advertLoop = None
-      print('Stopped advertising')
-  
+
+    #-------------------------------------------------------------------------
+    #  Manufacturer data for the current identity
+    #-------------------------------------------------------------------------
+    def _advertData(self):
+      return iBeaconData(self.beacon_type, self.uuid, self.major, self.minor,
+                         self.tx_power)
 
 
     #-------------------------------------------------------------------------
+    #  Build the advertisement sets: our iBeacon plus any extra sets from
+    #  the 'advertSets' setting, e.g.
     #
-    #  Start advertisement for 'timeout' seconds  
-    #
-    #     timeout = 0, continuous advertisement
-    #     timeout > 0, stop advertisement after 'timeout' seconds
-    #
+    #    {"name": "uid", "kind": "eddystone-uid", "priority": 1,
+    #     "namespace": "2f234454f4911ba9ffa6", "instance": "000010e1223d"}
     #-------------------------------------------------------------------------
-    def startAdvert(self):
+    def _buildAdvertSets(self):
+      self.advertiser.addSet(iBeaconSet('ibeacon', self.uuid, self.major, self.minor,
+                                        self.tx_power, priority=0))
+
+      for cfg in self.deviceSettings.get('advertSets', []):
+        cfg = dict(cfg)
+        name = cfg.pop('name')
+        kind = cfg.pop('kind')
+        if kind == 'eddystone-uid':
+          self.advertiser.addSet(eddystoneUidSet(name, **cfg))
+        elif kind == 'eddystone-tlm':
+          telemetry = self._telemetry(cfg.get('interval', 100))
+          self.advertiser.addSet(eddystoneTlmSet(name, **telemetry, **cfg))
+          self.tlmSets.append(name)
+        elif kind == 'custom':
+          cfg['data'] = bytes.fromhex(cfg['data'])
+          self.advertiser.addSet(customSet(name, **cfg))
+        else:
+          print(f"Unknown advertisement set kind '{kind}'")
 
-      if self.advertiser is not None:
-        return False
 
-      dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    #-------------------------------------------------------------------------
+    #  Start advertisement
+    #-------------------------------------------------------------------------
+    def startAdvert(self):
+      if self.advertStart is None:
+        self.advertStart = time.monotonic()
+      if not self.advertiser.sets:
+        self._buildAdvertSets()
+      started = self.advertiser.start()
 
-      bus = dbus.SystemBus()
-      adapter = self.find_adapter(bus)
-      if not adapter:
-        print('LEAdvertisingManager1 interface not found')
-        return
+      if self.firstAdvert:
+        self.firstAdvert = False
+        t = threading.Thread(target=self._traceFirstAdvert)
+        t.setDaemon(True)
+        t.start()
+      return started
 
-      adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                                   "org.freedesktop.DBus.Properties")
-      adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
-      self.ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                                   LE_ADVERTISING_MANAGER_IFACE)
 
-      self.advertiser = Advertisement(bus, 0, 'peripheral')
-      self.advertiser.add_manufacturer_data(self.company_id, 
-                                            self.beacon_type + 
-                                            list(self.uuid.bytes) + 
-                                            [self.major/256, self.major%256] + 
-                                            [self.minor/256, self.minor%256] + 
-                                            self.tx_power)
+    #-------------------------------------------------------------------------
+    #  Eddystone-TLM values: battery mV (PiSugar, once it is up), SoC
+    #  temperature, uptime, and the adverts sent so far estimated from the
+    #  time advertising and the set's interval.  Unknown values use the
+    #  TLM "not supported" codes.
+    #-------------------------------------------------------------------------
+    def _telemetry(self, interval):
+      voltage = 0
+      if self._pisugar is not None:
+        try:
+          voltage = int(self._pisugar.get_voltage() * 1000)
+        except (OSError, ValueError, IndexError):
+          pass
 
-      self.advertLoop = GLib.MainLoop()
+      try:
+        with open('/sys/class/thermal/thermal_zone0/temp') as f:
+          temperature = int(f.read()) / 1000.0
+      except (OSError, ValueError):
+        temperature = -128.0
+
+      try:
+        with open('/proc/uptime') as f:
+          uptime = float(f.read().split()[0])
+      except (OSError, ValueError, IndexError):
+        uptime = 0
+
+      if self.radioScheduler is not None:
+        advertising = self.radioScheduler.stats()['advertOn']
+      elif self.advertStart is not None:
+        advertising = time.monotonic() - self.advertStart
+      else:
+        advertising = 0.0
+
+      return {'voltage_mv': min(voltage, 0xffff),
+              'temperature': temperature,
+              'adv_count': int(advertising * 1000.0 / interval) & 0xffffffff,
+              'uptime_s': uptime}
+
+    def updateTelemetry(self):
+      for name in self.tlmSets:
+        interval = self.advertiser.sets[name].interval
+        frame = eddystoneTlmFrame(**self._telemetry(interval))
+        self.advertiser.update(name, service=(EDDYSTONE_UUID, frame))
 
 
-      self.ad_manager.RegisterAdvertisement(self.advertiser.get_path(), {},
-                                     reply_handler=self.register_ad_cb,
-                                     error_handler=self.register_ad_error_cb)
+    #-------------------------------------------------------------------------
+    #  Mark when the iBeacon set is accepted (D-Bus replies asynchronously)
+    #-------------------------------------------------------------------------
+    def _traceFirstAdvert(self, timeout=2.0):
+      advertSet = self.advertiser.sets['ibeacon']
+      start = time.monotonic()
+      while advertSet.status == 'pending' and time.monotonic() - start < timeout:
+        time.sleep(0.001)
+      ms = self.trace.mark(f"first advert {advertSet.status}")
+      print(f"Time to first advert {ms:.1f} ms")
 
 
-      self.advertThread = threading.Thread(target=self.advertLoop.run)
-      self.advertThread.setDaemon(True)
-      self.advertThread.start()
-      print("Start advertising")
-      return True
+    #-------------------------------------------------------------------------
+    #  Change major/minor/tx power while advertising, e.g. to rotate the
+    #  identifiers, without tearing the advertiser down
+    #-------------------------------------------------------------------------
+    def updateAdvert(self, major=None, minor=None, tx_power=None):
+      if major is not None:
+        self.major = major
+      if minor is not None:
+        self.minor = minor
+      if tx_power is not None:
+        self.tx_power = [tx_power & 0xff]
+      return self.advertiser.update('ibeacon',
+                                    manufacturer=(self.company_id, self._advertData()))
 
 
 
     #-------------------------------------------------------------------------
-    #  Scan loop
+    #  Sighting callback - called by the scanner for every new sighting
+    #  merged from all adapters
     #-------------------------------------------------------------------------
-    def _scanLoop(self):
+    def _onSighting(self, beacon):
+
+      # Share every sighting with the UI, logger and uploader processes
+      if self.sightingRing is not None:
+        self.sightingRing.publish(beacon)
+
+      if beacon['type'] == 'iBeacon':
+        if beacon['uuid'] == str(self.uuid):
+          self.scanMutex.acquire()
+          # Kernel receive time of this packet, monotonic ns
+          self.beaconList[self._deviceKey(beacon)] = (beacon['timestamp'], beacon) 
+          self.sightings = self.sightings + 1
+          self.scanMutex.release()
 
-      #Set bluetooth device. Default 0.
-      dev_id = 0
-      try:
-        sock = bluez.hci_open_dev(dev_id)
-      except:
-        print ("Error accessing bluetooth")
 
-      ScanUtility.hci_enable_le_scan(sock)
+    #-------------------------------------------------------------------------
+    #  Stop scanning 
+    #-------------------------------------------------------------------------
+    def stopScanning(self):
+      self.scanner.stop()
+      print(f"Stopped scanning {self.scanner.stats()}")
+      self.scanner = None
 
-      self.scanExit = False 
+      if self.sightingRing is not None:
+        self.sightingRing.close()
+        self.sightingRing = None
 
+
+    #-------------------------------------------------------------------------
+    #  Start scanning on all configured adapters
+    #-------------------------------------------------------------------------
+    def startScanning(self):
       self.scanMutex.acquire()
       self.beaconList = {}
       self.scanMutex.release()
 
-      while not self.scanExit:
-        beacons = ScanUtility.parse_events(sock, 10)
+      ringName = self.deviceSettings.get('sightingRing')
+      if ringName:
+        from SightingRing import SightingRing
+        self.sightingRing = SightingRing(ringName)
+
+      # Share the scan of a running ScanDaemon instead of opening the adapters
+      scanDaemon = self.deviceSettings.get('scanDaemon')
+      if scanDaemon:
+        from ScanDaemon import ScanClient
+        self.scanner = ScanClient(f"type=iBeacon;uuid={str(self.uuid)}",
+                                  self._onSighting, scanDaemon)
+      else:
+        self.scanner = MultiScanner(self.scanAdapters, callback=self._onSighting)
+      self.scanner.start()
+      print("Start scanning")
+
 
-        currTime = datetime.datetime.now()
+    #-------------------------------------------------------------------------
+    #  Scan windows of the radio plan.  A ScanDaemon owns its adapters, so
+    #  with a daemon client scanning stays on.
+    #-------------------------------------------------------------------------
+    def pauseScanning(self):
+      if isinstance(self.scanner, MultiScanner):
+        self.scanner.pause()
 
-        self.scanMutex.acquire()
-        for beacon in beacons:
-          if beacon['type'] == 'iBeacon':
-            if beacon['uuid'] == str(self.uuid):
-              self.beaconList[self._deviceKey(beacon)] = (currTime, beacon) 
-          '''
-          elif beacon['type'] == 'Overflow':
-            if beacon['uuid'] == '2f234454-cf6d-4a0f-adf2-f4911ba9ffa6':
-              print("Overflow:-------------")
-              print(beacon)
-              print("")
-          '''
-        self.scanMutex.release()
+    def resumeScanning(self):
+      if isinstance(self.scanner, MultiScanner):
+        self.scanner.resume()
 
 
     #-------------------------------------------------------------------------
-    #  Stop scanning 
+    #  Control surfaces of the adaptive rate controller
     #-------------------------------------------------------------------------
-    def stopScanning(self):
-      self.scanExit = True 
-      self.scanThread.join()
-      print("Stopped scanning")
+    def _setScan(self, interval, window):
+      if isinstance(self.scanner, MultiScanner):
+        self.scanner.setScanParameters(interval, window)
+
+    def _setAdvertInterval(self, interval):
+      self.advertiser.setInterval('ibeacon', interval)
 
 
     #-------------------------------------------------------------------------
-    #  Start scanning 
+    #  Feed the adaptive rate controller: peers heard in the last
+    #  'age' seconds and sightings per second since the last call
     #-------------------------------------------------------------------------
-    def startScanning(self):
-      self.scanThread = threading.Thread(target=self._scanLoop)
-      self.scanThread.setDaemon(True)
-      self.scanThread.start()
-      print("Start scanning")
+    def adaptRate(self, elapsed, age=10.0):
+      oldest = time.monotonic_ns() - int(age * 1e9)
+
+      self.scanMutex.acquire()
+      neighbors = sum(1 for (t, b) in self.beaconList.values() if t >= oldest)
+      sightings = self.sightings
+      self.sightings = 0
+      self.scanMutex.release()
+
+      self.rateController.update(neighbors, sightings / elapsed)
+
+
+    #-------------------------------------------------------------------------
+    #  Keep the beacon table and power tier across sleep cycles in
+    #  'stateFile'.  Restored entries are aged by the time asleep and never
+    #  replace a sighting made since the wake.  They are marked 'restored'
+    #  so the distance check ignores them until the peer is heard again.
+    #-------------------------------------------------------------------------
+    def saveState(self):
+      from StateSnapshot import saveState
+      self.scanMutex.acquire()
+      entries = list(self.beaconList.values())
+      self.scanMutex.release()
+      tier = self.governor.tier()['name'] if self.governor is not None else None
+      saved = saveState(self.deviceSettings['stateFile'], entries, tier)
+      print(f"Saved {saved} beacons, tier {tier}")
+
+    def restoreState(self):
+      from StateSnapshot import loadState
+      entries = loadState(self.deviceSettings['stateFile'],
+                          self.deviceSettings.get('stateMaxAge', 3600.0))
+      self.scanMutex.acquire()
+      for t, b in entries:
+        key = self._deviceKey(b)
+        if key not in self.beaconList:
+          b['restored'] = True
+          self.beaconList[key] = (t, b)
+      self.scanMutex.release()
+      self.trace.mark(f"restored {len(entries)} beacons")
 
 
     #-------------------------------------------------------------------------
     #  Wake after function
     #-------------------------------------------------------------------------
     def setWakeAfter(self, seconds):
-      now = datetime.datetime.now()
+      # Local time with its offset; a naive time would be sent as -06:00
+      now = datetime.datetime.now().astimezone()
       res = self.pisugar.set_rtc_alarm(now + datetime.timedelta(0, seconds), [1, 1, 1, 1, 1, 1, 1] )
 
 
@@ -450,15 +459,82 @@ class vBeacon():
       self.scanMutex.acquire()
       for key in self.beaconList:
         (t, b) = self.beaconList[key]
+        if b.get('restored'):
+          continue
         if (b['rssi'] > dist):  
           inViolation = True 
       self.scanMutex.release()
      
       if inViolation: 
         print("Social distance violation!!!") 
-        self.buzzer.play(sound=self.buzzer.alert, repeat=0)
+        if self.buzzerEnabled:
+          self.buzzer.play(sound=self.buzzer.alert, repeat=0)
+
+
+    #-------------------------------------------------------------------------
+    #  Read the battery and switch power tier if needed
+    #-------------------------------------------------------------------------
+    def governPower(self):
+      try:
+        status = self.pisugar.get_status()
+      except OSError as e:
+        print(f"PiSugar not available: {e}")
+        return
+      self.governor.update(status)
+
+    #-------------------------------------------------------------------------
+    #  Apply a power tier (PowerGovernor listener)
+    #-------------------------------------------------------------------------
+    def _applyTier(self, tier):
+      if self.radioScheduler is not None:
+        self.radioScheduler.setPlan(tier['radioPlan'])
+
+      if self.rateController is not None:
+        bounds = self.rateController.bounds
+        bounds['minAdvertInterval'] = min(tier['advertInterval'], bounds['maxAdvertInterval'])
+      else:
+        self._setAdvertInterval(tier['advertInterval'])
+
+      self.onTime, self.wakeTime = self.governor.times(tier)
+      self.checkPeriod = tier['checkPeriod']
+      self.buzzerEnabled = tier['buzzer']
+
+      # ui.py runs in its own process and follows the tier saved in the
+      # snapshot for its e-paper refresh interval
+      if self.deviceSettings.get('stateFile'):
+        self.saveState()
 
    
+    #-------------------------------------------------------------------------
+    #  Bring up advertising and scanning.  Connecting the advertiser
+    #  (system bus, adapter lookup) and opening the scan adapters run in
+    #  parallel.  Without a 'radioPlan' both stay on for the whole
+    #  on-period, with one the scheduler switches them.
+    #-------------------------------------------------------------------------
+    def _startRadio(self, radioPlan):
+      def advertStartup():
+        self.advertiser.open()
+        self.trace.mark('advertiser open')
+        if not radioPlan:
+          self.startAdvert()
+
+      advertThread = threading.Thread(target=advertStartup)
+      advertThread.start()
+
+      self.startScanning()
+      self.trace.mark('scanning')
+      if radioPlan:
+        self.pauseScanning()
+      advertThread.join()
+
+      if radioPlan:
+        from RadioScheduler import RadioScheduler
+        self.radioScheduler = RadioScheduler(radioPlan,
+                                             self.resumeScanning, self.pauseScanning,
+                                             self.startAdvert, self.stopAdvert)
+        self.radioScheduler.start()
+
+
     #-------------------------------------------------------------------------
     #  Run the App
     #-------------------------------------------------------------------------
@@ -475,12 +551,60 @@ class vBeacon():
       self.onTime     = self.deviceSettings['onTime']
       self.wakeTime   = self.deviceSettings['wakeTime']
       self.socialDist = self.deviceSettings['socialDist']
+      self.scanAdapters = self.deviceSettings.get('scanAdapters', DEFAULT_ADAPTERS)
+
+      self.trace.mark('settings loaded')
+
+      # 'hci' programs the controller directly instead of going through bluetoothd
+      if self.deviceSettings.get('advertBackend', 'dbus') == 'hci':
+        from HciAdvertiser import HciAdvertiser
+        self.advertiser = HciAdvertiser(self.deviceSettings.get('advertDevId', 0))
+      else:
+        from Advertiser import AdvertisingManager
+        self.advertiser = AdvertisingManager()
 
       print(f"uuid={str(self.uuid)}")
 
-      self.startAdvert()
-      self.startScanning()
+      self._startRadio(self.deviceSettings.get('radioPlan'))
+      if self.deviceSettings.get('stateFile'):
+        self.restoreState()
+
+      deferred = threading.Thread(target=self._deferredInit)
+      deferred.setDaemon(True)
+      deferred.start()
+
+      # 'adaptiveRate' (bounds, may be {}) scales scan window and
+      # advertising interval with the number of neighbors
+      rateBounds = self.deviceSettings.get('adaptiveRate')
+      if rateBounds is not None:
+        from AdaptiveRate import AdaptiveRate
+        self.rateController = AdaptiveRate(self._setScan, self._setAdvertInterval,
+                                           rateBounds)
+
+      # 'powerGovernor' ({"capacity": mAh, "period": s, "hysteresis": %})
+      # picks a power tier from the battery at startup and every 'period'
+      # seconds, continuing from the tier saved in 'stateFile'
+      governor = self.deviceSettings.get('powerGovernor')
+      governPeriod = 0
+      if governor is not None:
+        from PowerGovernor import PowerGovernor
+        governPeriod = governor.get('period', 60)
+        if governPeriod <= 0:
+          raise ValueError(f"powerGovernor period must be > 0, not {governPeriod}")
+        self.governor = PowerGovernor(governor.get('capacity', 1200.0),
+                                      self.onTime, self.wakeTime,
+                                      hysteresis=governor.get('hysteresis', 5.0))
+        self.governor.addListener(self._applyTier)
+        if self.deviceSettings.get('stateFile'):
+          from StateSnapshot import loadTier
+          self.governor.restore(loadTier(self.deviceSettings['stateFile']))
+        self.governPower()
  
+      # 'tlmPeriod' s between Eddystone-TLM refreshes
+      tlmPeriod = self.deviceSettings.get('tlmPeriod', 10)
+      if tlmPeriod <= 0:
+        raise ValueError(f"tlmPeriod must be > 0, not {tlmPeriod}")
+
       done = False
       seconds = 0
 
@@ -492,15 +616,39 @@ class vBeacon():
         # Report to backend
         # Log to file
    
-        self.checkSocialDistancing(self.socialDist)
+        if seconds % self.checkPeriod == 0:
+          self.checkSocialDistancing(self.socialDist)
+
+        if self.rateController is not None:
+          self.adaptRate(1.0)
+
+        if self.governor is not None and seconds % governPeriod == 0:
+          self.governPower()
+
+        if self.tlmSets and seconds % tlmPeriod == 0:
+          self.updateTelemetry()
 
         if seconds >= self.onTime : 
           break
 
 
       print("Shutting down....")
+      if self.rateController is not None:
+        print(f"Rate {self.rateController.stats()}")
+        self.rateController = None
+      if self.radioScheduler is not None:
+        self.radioScheduler.stop()
+        print(f"Radio {self.radioScheduler.stats()}")
+        self.radioScheduler = None
       self.stopScanning()
       self.stopAdvert()
+      self.advertiser.close()
+      if self.deviceSettings.get('stateFile'):
+        self.saveState()
+
+      if self.deviceSettings.get('startupTrace'):
+        print("Startup trace")
+        self.trace.report()
 
       print(f"Wake after {self.wakeTime - seconds}")
       #self.setWakeAfter(self.wakeTime - seconds)